@@ -1,14 +1,12 @@
 # api_clients.py
 
-import openai
 import os
 from dotenv import load_dotenv
-import anthropic
-from groq import Groq
-import google.generativeai as genai
-from google.api_core import exceptions
-import requests
-import time
+import httpx
+from providers import consume_stream, get_provider
+from endpoint_pool import get_endpoint_pool
+from credentials import CredentialsExhausted
+from rate_limiter import RATE_LIMITED, CircuitOpenError, call_with_retries, classify_error, estimate_prompt_tokens
 
 # Load environment variables from a .env file
 load_dotenv()
@@ -18,10 +16,11 @@ openai_api_key = os.getenv('OPENAI_API_KEY')
 claude_api_key = os.getenv('CLAUDE_API_KEY')
 groq_api_key = os.getenv('GROQ_API_KEY')
 gemini_api_key = os.getenv('GEMINI_API_KEY')
+openrouter_api_key = os.getenv('OPENROUTER_API_KEY')
 local_api_url = os.getenv('LOCAL_API_URL')
 local_api_model = os.getenv('LOCAL_API_MODEL')
 
-def generate_response_openai(conversation_history, role, message, model_id, temperature, max_tokens):
+def generate_response_openai(conversation_history, role, message, model_id, temperature, max_tokens, system_prompt=None, stream_options=None):
     """
     Generate a response using OpenAI's API.
 
@@ -32,24 +31,27 @@ def generate_response_openai(conversation_history, role, message, model_id, temp
         model_id (str): The model ID for OpenAI.
         temperature (float): Sampling temperature.
         max_tokens (int): Maximum number of tokens to generate.
+        system_prompt (str, optional): Static system prompt sent ahead of the conversation.
+        stream_options (StreamOptions, optional): Stream the response with these options instead of waiting for it whole.
 
     Returns:
         str: The generated response.
     """
-    openai.api_key = openai_api_key
     try:
-        response = openai.ChatCompletion.create(
-            model=model_id,
-            messages=conversation_history + [{"role": role, "content": message}],
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
-        return response.choices[0].message['content']
+        messages = conversation_history + [{"role": role, "content": message}]
+        if stream_options is not None:
+            make_request = lambda api_key: get_provider("openai", api_key).generate_stream(messages, model_id, temperature, max_tokens, system_prompt, stream_options)
+        else:
+            make_request = lambda api_key: get_provider("openai", api_key).generate(messages, model_id, temperature, max_tokens, system_prompt)
+        return call_with_retries("openai", make_request, estimate_prompt_tokens(messages, system_prompt), max_tokens)
+    except CredentialsExhausted:
+        # Stops the note instead of cutting its conversations short
+        raise
     except Exception as e:
         print(f"Error generating response from OpenAI: {str(e)}")
         return None
 
-def generate_response_claude(conversation_history, role, message, model_id, temperature, max_tokens):
+def generate_response_claude(conversation_history, role, message, model_id, temperature, max_tokens, system_prompt=None, stream_options=None):
     """
     Generate a response using Claude's API.
 
@@ -60,28 +62,30 @@ def generate_response_claude(conversation_history, role, message, model_id, temp
         model_id (str): The model ID for Claude.
         temperature (float): Sampling temperature.
         max_tokens (int): Maximum number of tokens to generate.
+        system_prompt (str, optional): Static system prompt sent ahead of the conversation.
+        stream_options (StreamOptions, optional): Stream the response with these options instead of waiting for it whole.
 
     Returns:
         str: The generated response.
     """
-    client = anthropic.Client(api_key=claude_api_key)
     try:
         # Prepare the messages for Claude API
         claude_messages = [{"role": msg["role"], "content": msg["content"]} for msg in conversation_history]
         claude_messages.append({"role": role, "content": message})
 
-        response = client.messages.create(
-            model=model_id,
-            messages=claude_messages,
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
-        return response.content[0].text
+        if stream_options is not None:
+            make_request = lambda api_key: get_provider("claude", api_key).generate_stream(claude_messages, model_id, temperature, max_tokens, system_prompt, stream_options)
+        else:
+            make_request = lambda api_key: get_provider("claude", api_key).generate(claude_messages, model_id, temperature, max_tokens, system_prompt)
+        return call_with_retries("claude", make_request, estimate_prompt_tokens(claude_messages, system_prompt), max_tokens)
+    except CredentialsExhausted:
+        # Stops the note instead of cutting its conversations short
+        raise
     except Exception as e:
         print(f"Error generating response from Claude: {str(e)}")
         return None
 
-def generate_response_groq(conversation_history, role, message, model_id, temperature, max_tokens):
+def generate_response_groq(conversation_history, role, message, model_id, temperature, max_tokens, system_prompt=None, stream_options=None):
     """
     Generate a response using Groq's API.
 
@@ -92,62 +96,96 @@ def generate_response_groq(conversation_history, role, message, model_id, temper
         model_id (str): The model ID for Groq.
         temperature (float): Sampling temperature.
         max_tokens (int): Maximum number of tokens to generate.
+        system_prompt (str, optional): Static system prompt sent ahead of the conversation.
+        stream_options (StreamOptions, optional): Stream the response with these options instead of waiting for it whole.
 
     Returns:
         str: The generated response.
     """
-    client = Groq(api_key=groq_api_key)
     try:
-        response = client.chat.completions.create(
-            model=model_id,
-            messages=[{"role": message["role"], "content": message["content"]} for message in conversation_history] + [{"role": role, "content": message}],
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
-        return response.choices[0].message.content
+        groq_messages = [{"role": msg["role"], "content": msg["content"]} for msg in conversation_history]
+        groq_messages.append({"role": role, "content": message})
+
+        if stream_options is not None:
+            make_request = lambda api_key: get_provider("groq", api_key).generate_stream(groq_messages, model_id, temperature, max_tokens, system_prompt, stream_options)
+        else:
+            make_request = lambda api_key: get_provider("groq", api_key).generate(groq_messages, model_id, temperature, max_tokens, system_prompt)
+        return call_with_retries("groq", make_request, estimate_prompt_tokens(groq_messages, system_prompt), max_tokens)
+    except CredentialsExhausted:
+        # Stops the note instead of cutting its conversations short
+        raise
     except Exception as e:
         print(f"Error generating response from Groq: {str(e)}")
         return None
 
-def generate_response_gemini(message, model, max_retries=3, initial_delay=1):
+def generate_response_openrouter(conversation_history, role, message, model_id, temperature, max_tokens, system_prompt=None, stream_options=None):
+    """
+    Generate a response using OpenRouter's API.
+
+    Args:
+        conversation_history (list): History of the conversation.
+        role (str): Role of the responder (e.g., user, assistant).
+        message (str): The message to generate a response for.
+        model_id (str): The model ID on OpenRouter (e.g., meta-llama/llama-3-70b-instruct).
+        temperature (float): Sampling temperature.
+        max_tokens (int): Maximum number of tokens to generate.
+        system_prompt (str, optional): Static system prompt sent ahead of the conversation.
+        stream_options (StreamOptions, optional): Stream the response with these options instead of waiting for it whole.
+
+    Returns:
+        str: The generated response.
+    """
+    try:
+        openrouter_messages = [{"role": msg["role"], "content": msg["content"]} for msg in conversation_history]
+        openrouter_messages.append({"role": role, "content": message})
+
+        if stream_options is not None:
+            make_request = lambda api_key: get_provider("openrouter", api_key).generate_stream(openrouter_messages, model_id, temperature, max_tokens, system_prompt, stream_options)
+        else:
+            make_request = lambda api_key: get_provider("openrouter", api_key).generate(openrouter_messages, model_id, temperature, max_tokens, system_prompt)
+        return call_with_retries("openrouter", make_request, estimate_prompt_tokens(openrouter_messages, system_prompt), max_tokens)
+    except CredentialsExhausted:
+        # Stops the note instead of cutting its conversations short
+        raise
+    except Exception as e:
+        print(f"Error generating response from OpenRouter: {str(e)}")
+        return None
+
+def generate_response_gemini(message, model):
     """
     Generate a response using Gemini's API.
 
+    Requests are spread over the Gemini API keys in the environment, paced by
+    the rate limiter of each key, and rate limit errors are retried with
+    backoff, as configured in the 'rate_limits' and 'retry' sections of the config.
+
     Args:
         message (str): The message to generate a response for.
-        model (GenerativeModel): The GenerativeModel object for Gemini.
-        max_retries (int): Maximum number of retries.
-        initial_delay (int): Initial delay between retries.
+        model (str or GenerativeModel): The Gemini model ID, or a GenerativeModel object.
 
     Returns:
         str: The generated response.
     """
-    retries = 0
-    delay = initial_delay
-    genai.configure(api_key=gemini_api_key)
-
-    while retries < max_retries:
-        try:
-            response_text = model.generate_content(message).text
-            print(f"Successfully generated response with Gemini API")
-            time.sleep(1)
-            return response_text
-        except exceptions.ResourceExhausted:
-            print(f"Rate limit exceeded for Gemini API. Retrying...")
-            retries += 1
-            time.sleep(delay)
-            delay *= 5
-        except Exception as e:
+    try:
+        response_text = call_with_retries("gemini", lambda api_key: get_provider("gemini", api_key).generate_content(model, message), estimate_prompt_tokens([{"content": message}]))
+        print(f"Successfully generated response with Gemini API")
+        return response_text
+    except CredentialsExhausted:
+        raise
+    except Exception as e:
+        if classify_error(e)[0] == RATE_LIMITED:
+            print("Reached maximum retries. Please try again later.")
+        else:
             print(f"An unexpected error occurred while generating response from Gemini API: {str(e)}")
-            return None
-
-    print("Reached maximum retries. Please try again later.")
-    return None
+        return None
 
-def generate_response_local(conversation_history, role, message, config, max_tokens=None, response_type=None):
+def generate_response_local(conversation_history, role, message, config, max_tokens=None, response_type=None, system_prompt=None, stream_options=None, model_id=None):
     """
     Generate a response using a local API.
 
+    Each attempt goes to the least loaded healthy endpoint of the local endpoint
+    pool, so a retry after a server failure can land on another server.
+
     Args:
         conversation_history (list): History of the conversation.
         role (str): Role of the responder (e.g., user, assistant).
@@ -155,34 +193,91 @@ def generate_response_local(conversation_history, role, message, config, max_tok
         config (dict): Configuration settings.
         max_tokens (int, optional): Maximum number of tokens to generate.
         response_type (str, optional): The type of response to generate.
+        system_prompt (str, optional): Static system prompt sent ahead of the conversation. Defaults to the Professor Synapse system prompt.
+        stream_options (StreamOptions, optional): Stream the response with these options instead of waiting for it whole.
+        model_id (str, optional): The model ID. Defaults to LOCAL_API_MODEL from the environment.
 
     Returns:
         str: The generated response.
     """
-    url = local_api_url
     if max_tokens is None:
         max_tokens = config['generation_parameters']['max_tokens']['default']
 
     mapped_conversation_history = [{"role": msg["role"], "content": msg["content"]} for msg in conversation_history]
+    messages = mapped_conversation_history + [{"role": role, "content": message}]
+    system_prompt = system_prompt or config['system_prompts']['synapse_system_prompt']
+
+    pool = get_endpoint_pool()
+    if not pool.endpoints:
+        print("No local model endpoint configured: set LOCAL_API_URL or the 'local_endpoints' section of the config.")
+        return None
 
-    payload = {
-        "model": local_api_model,
-        "messages": [{"role": "system", "content": config['system_prompts']['synapse_system_prompt']}] + mapped_conversation_history + [{"role": role, "content": message}],
-        "temperature": config['generation_parameters']['temperature'],
-        "max_tokens": max_tokens,
-        "stream": False
-    }
+    def send(endpoint):
+        provider = endpoint.provider()
+        payload = provider.build_payload(messages, endpoint.model_id or model_id or local_api_model, config['generation_parameters']['temperature'], max_tokens, system_prompt)
+        if stream_options is not None:
+            return consume_stream(provider.stream(payload), stream_options)
+        return provider.post(payload)
 
+    prompt_tokens = estimate_prompt_tokens(messages, system_prompt)
+    response_data = None
     try:
-        response = requests.post(url, headers={"Content-Type": "application/json"}, json=payload)
-        response.raise_for_status()
-        response_data = response.json()
+        response_data = call_with_retries("local", lambda api_key: pool.request(send), prompt_tokens, max_tokens)
+        if stream_options is not None:
+            return response_data
         generated_response = response_data['choices'][0]['message']['content']
         return generated_response
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, CircuitOpenError) as e:
         print(f"Error generating response from local model for {role} ({response_type}): {str(e)}")
         return None
     except KeyError as e:
         print(f"KeyError in response data: {str(e)}")
         print(f"Response data: {response_data}")
         return None
+
+def _chat_response(generate_function):
+    def generate(model_id, conversation_history, role, message, config, temperature, max_tokens, response_type=None, system_prompt=None, stream_options=None):
+        return generate_function(conversation_history, role, message, model_id, temperature, max_tokens, system_prompt, stream_options)
+    return generate
+
+def _gemini_response(model_id, conversation_history, role, message, config, temperature, max_tokens, response_type=None, system_prompt=None, stream_options=None):
+    # Gemini takes a single prompt, so the static system prompt leads it
+    return generate_response_gemini(f"{system_prompt}\n\n{message}" if system_prompt else message, model_id)
+
+def _local_response(model_id, conversation_history, role, message, config, temperature, max_tokens, response_type=None, system_prompt=None, stream_options=None):
+    return generate_response_local(conversation_history, role, message, config, max_tokens, response_type, system_prompt, stream_options, model_id)
+
+# Response generator of each provider, all called with the same arguments
+RESPONSE_GENERATORS = {
+    "openai": _chat_response(generate_response_openai),
+    "claude": _chat_response(generate_response_claude),
+    "groq": _chat_response(generate_response_groq),
+    "openrouter": _chat_response(generate_response_openrouter),
+    "gemini": _gemini_response,
+    "local": _local_response,
+}
+
+def generate_provider_response(provider, model_id, conversation_history, role, message, config, temperature, max_tokens, response_type=None, system_prompt=None, stream_options=None):
+    """
+    Generate a response with a provider looked up by name.
+
+    Args:
+        provider (str): The provider name, a key of RESPONSE_GENERATORS.
+        model_id (str): The model ID.
+        conversation_history (list): History of the conversation.
+        role (str): Role of the responder (e.g., user, assistant).
+        message (str): The message to generate a response for.
+        config (dict): Configuration settings.
+        temperature (float): Sampling temperature.
+        max_tokens (int): Maximum number of tokens to generate.
+        response_type (str, optional): The type of response to generate.
+        system_prompt (str, optional): Static system prompt sent ahead of the conversation.
+        stream_options (StreamOptions, optional): Stream the response with these options instead of waiting for it whole.
+
+    Returns:
+        str: The generated response, or None if generation failed.
+    """
+    generate = RESPONSE_GENERATORS.get(provider)
+    if generate is None:
+        raise ValueError(f"Unknown provider: {provider}")
+    return generate(model_id, conversation_history, role, message, config, temperature, max_tokens, response_type, system_prompt, stream_options)
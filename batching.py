@@ -0,0 +1,453 @@
+# batching.py
+
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from budget import budget_governor
+from conversation import generate_response, generation_settings, lookup_response_cache
+from credentials import API_KEY_VARIABLES, CredentialsExhausted, load_api_keys
+from history import count_tokens
+from providers import pool_settings, prompt_cache_settings, run_sync
+from rate_limiter import estimate_prompt_tokens
+from response_cache import get_response_cache
+from router import active_router
+from scheduler import provider_limiter
+from stats import run_stats
+
+# Statuses after which a provider batch will not change any more
+_OPENAI_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+class OpenAIBatchClient:
+    """
+    Client for the OpenAI Batch API: upload the requests as a JSONL file, create a batch and poll it.
+    """
+
+    def __init__(self, base_url, api_key, poll_interval=10.0):
+        """
+        Initialize the client.
+
+        Args:
+            base_url (str): The API base URL, e.g. https://api.openai.com/v1.
+            api_key (str): The API key.
+            poll_interval (float): Seconds between batch status checks.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.poll_interval = poll_interval
+
+    async def run(self, bodies):
+        """
+        Run chat completion requests as one batch and wait for the results.
+
+        Args:
+            bodies (list): Chat completions request bodies.
+
+        Returns:
+            list: The response text of each request, None for requests that failed.
+        """
+        lines = "\n".join(
+            json.dumps({"custom_id": str(index), "method": "POST", "url": "/v1/chat/completions", "body": body}, ensure_ascii=False)
+            for index, body in enumerate(bodies)
+        )
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        async with httpx.AsyncClient(base_url=self.base_url, headers=headers, timeout=pool_settings["timeout"]) as client:
+            upload = await client.post("/files", data={"purpose": "batch"}, files={"file": ("batch.jsonl", lines.encode('utf-8'), "application/jsonl")})
+            upload.raise_for_status()
+            response = await client.post("/batches", json={"input_file_id": upload.json()["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"})
+            response.raise_for_status()
+            batch = response.json()
+            while batch["status"] not in _OPENAI_FINAL_STATUSES:
+                await asyncio.sleep(self.poll_interval)
+                response = await client.get(f"/batches/{batch['id']}")
+                response.raise_for_status()
+                batch = response.json()
+
+            results = [None] * len(bodies)
+            if batch.get("output_file_id"):
+                response = await client.get(f"/files/{batch['output_file_id']}/content")
+                response.raise_for_status()
+                for line in response.text.splitlines():
+                    if not line.strip():
+                        continue
+                    item = json.loads(line)
+                    item_response = item.get("response") or {}
+                    if item_response.get("status_code") == 200:
+                        results[int(item["custom_id"])] = item_response["body"]["choices"][0]["message"]["content"]
+            return results
+
+class AnthropicBatchClient:
+    """
+    Client for the Anthropic Message Batches API: create a batch, poll it and stream its results.
+    """
+
+    def __init__(self, base_url, api_key, poll_interval=10.0):
+        """
+        Initialize the client.
+
+        Args:
+            base_url (str): The API base URL, e.g. https://api.anthropic.com/v1.
+            api_key (str): The API key.
+            poll_interval (float): Seconds between batch status checks.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.poll_interval = poll_interval
+
+    async def run(self, bodies):
+        """
+        Run Messages API requests as one batch and wait for the results.
+
+        Args:
+            bodies (list): Messages API request parameters.
+
+        Returns:
+            list: The response text of each request, None for requests that failed.
+        """
+        headers = {"x-api-key": self.api_key, "anthropic-version": "2023-06-01"}
+        async with httpx.AsyncClient(base_url=self.base_url, headers=headers, timeout=pool_settings["timeout"]) as client:
+            response = await client.post("/messages/batches", json={"requests": [{"custom_id": str(index), "params": body} for index, body in enumerate(bodies)]})
+            response.raise_for_status()
+            batch = response.json()
+            while batch["processing_status"] != "ended":
+                await asyncio.sleep(self.poll_interval)
+                response = await client.get(f"/messages/batches/{batch['id']}")
+                response.raise_for_status()
+                batch = response.json()
+
+            results = [None] * len(bodies)
+            if batch.get("results_url"):
+                response = await client.get(batch["results_url"])
+                response.raise_for_status()
+                for line in response.text.splitlines():
+                    if not line.strip():
+                        continue
+                    item = json.loads(line)
+                    result = item.get("result") or {}
+                    if result.get("type") == "succeeded":
+                        results[int(item["custom_id"])] = "".join(block.get("text", "") for block in result["message"]["content"])
+            return results
+
+# Batch API client class and default base URL per provider
+BATCH_API_CLIENTS = {
+    "openai": (OpenAIBatchClient, "https://api.openai.com/v1"),
+    "claude": (AnthropicBatchClient, "https://api.anthropic.com/v1"),
+}
+
+class BatchGenerator:
+    """
+    Generate the requests of one round of conversation steps together.
+
+    With the batch API enabled and a single OpenAI or Claude backend, requests
+    are submitted as one provider batch. Otherwise the requests are sent
+    concurrently, which OpenAI-compatible local servers such as vLLM and
+    llama.cpp with parallel slots batch on the GPU. Responses already in the
+    response cache are never sent.
+    """
+
+    def __init__(self, config, use_openai=False, use_claude=False, use_groq=False, use_gemini=False, use_local=False):
+        """
+        Initialize the generator.
+
+        Without a provider flag, requests are routed through the router set up with configure_router().
+
+        Args:
+            config (dict): Configuration settings.
+            use_openai (bool): Flag to use OpenAI.
+            use_claude (bool): Flag to use Claude.
+            use_groq (bool): Flag to use Groq.
+            use_gemini (bool): Flag to use Gemini.
+            use_local (bool): Flag to use local model.
+        """
+        self.config = config
+        self.flags = (use_openai, use_claude, use_groq, use_gemini, use_local)
+        router = active_router(config, *self.flags)
+        # A provider batch holds the requests of one model, so the batch API needs a single backend
+        self.backend = router.backends[0] if len(router.backends) == 1 else None
+        self.provider = self.backend.provider if self.backend is not None else None
+        self.model_id = self.backend.model_id if self.backend is not None else None
+        batching = config.get('batching') or {}
+        self.batch_size = max(1, batching.get('batch_size', 16))
+        self.batch_client = None
+        if batching.get('use_batch_api') and self.provider in BATCH_API_CLIENTS:
+            client_class, default_url = BATCH_API_CLIENTS[self.provider]
+            base_url = (batching.get('api_base_urls') or {}).get(self.provider) or default_url
+            keys = load_api_keys(self.provider)
+            api_key = keys[0] if keys else os.getenv(API_KEY_VARIABLES[self.provider])
+            self.batch_client = client_class(base_url, api_key, batching.get('poll_interval', 10.0))
+        self._executor = ThreadPoolExecutor(max_workers=self.batch_size, thread_name_prefix="synthgen-batch")
+
+    def generate(self, requests):
+        """
+        Generate a response for every request.
+
+        Args:
+            requests (list): GenerationRequest objects.
+
+        Returns:
+            list: For each request, the response text, None if generation failed, or the exception it raised.
+        """
+        run_stats.add('batches')
+        run_stats.add('batched_requests', len(requests))
+        # Requests with the same share key, such as the opening of conversation variants, are sent once
+        unique = []
+        positions = []
+        shared = {}
+        for request in requests:
+            if request.share_key is not None and request.share_key in shared:
+                positions.append(shared[request.share_key])
+                continue
+            if request.share_key is not None:
+                shared[request.share_key] = len(unique)
+            positions.append(len(unique))
+            unique.append(request)
+        if len(unique) < len(requests):
+            run_stats.add('shared_requests', len(requests) - len(unique))
+
+        if self.batch_client is not None:
+            results = self._generate_with_batch_api(unique)
+        else:
+            futures = [self._executor.submit(self._generate_one, request) for request in unique]
+            results = []
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(e)
+        return [results[position] for position in positions]
+
+    def _generate_one(self, request):
+        return generate_response(request.role, request.prompt, request.response_type, request.history, self.config, *self.flags, None, request.system_prompt, request.on_delta, request.cache_scope)
+
+    def _request_body(self, request, max_tokens, temperature):
+        messages = [{"role": message["role"], "content": message["content"]} for message in request.history]
+        messages.append({"role": request.role, "content": request.prompt})
+        body = {"model": self.model_id, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+        if request.system_prompt:
+            if self.provider == "claude":
+                system_block = {"type": "text", "text": request.system_prompt}
+                if prompt_cache_settings["enabled"]:
+                    system_block["cache_control"] = {"type": "ephemeral"}
+                body["system"] = [system_block]
+            else:
+                body["messages"] = [{"role": "system", "content": request.system_prompt}] + messages
+        return body
+
+    def _generate_with_batch_api(self, requests):
+        results = [None] * len(requests)
+        response_cache = get_response_cache(self.config)
+        pending = []
+        for index, request in enumerate(requests):
+            max_tokens, temperature = generation_settings(self.config, request.role, request.response_type)
+            cache_keys, cached_response = lookup_response_cache(self.config, [self.backend], request.role, request.prompt, request.history, request.system_prompt, max_tokens, temperature, request.cache_scope)
+            if cached_response is not None:
+                results[index] = cached_response
+            elif cache_keys is not None and response_cache.mode == "replay":
+                print(f"No cached response for {request.role} ({request.response_type}) in replay mode.")
+            else:
+                pending.append((index, cache_keys[0] if cache_keys is not None else None, self._request_body(request, max_tokens, temperature)))
+        if not pending:
+            return results
+
+        try:
+            budget_governor.check()
+            with provider_limiter.slot(self.provider):
+                responses = run_sync(self.batch_client.run([body for _, _, body in pending]))
+        except httpx.HTTPError as e:
+            print(f"Error running {self.provider} batch of {len(pending)} requests: {str(e)}")
+            return results
+        except Exception as e:
+            # Ends the pending conversations, as the per-request path does; an exhausted budget keeps their checkpoints
+            if not isinstance(e, CredentialsExhausted):
+                print(f"Error running {self.provider} batch of {len(pending)} requests: {str(e)}")
+            for index, _, _ in pending:
+                results[index] = e
+            return results
+        for (index, cache_key, body), response in zip(pending, responses):
+            results[index] = response
+            # Batch results carry no usage, so the ledger gets the tokenizer's counts
+            system_prompt = body["system"][0]["text"] if "system" in body else None
+            budget_governor.record(self.provider, self.model_id, estimate_prompt_tokens(body["messages"], system_prompt), count_tokens(response) if response else 0, batch_api=True)
+            if cache_key is not None and response is not None:
+                response_cache.put(cache_key, response)
+        return results
+
+    def close(self):
+        """
+        Stop the worker threads.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+class _ActiveConversation:
+    __slots__ = ("steps", "on_finish", "request")
+
+    def __init__(self, steps, on_finish):
+        self.steps = steps
+        self.on_finish = on_finish
+        self.request = None
+
+# Sentinel telling the batch runner that no more conversations will be queued
+_DONE = object()
+
+class BatchRunner:
+    """
+    Advance many conversations in lockstep, one step per round.
+
+    Every round collects the next request of each active conversation and
+    generates them as one batch. Conversations that end drop out of the batch
+    and queued ones take their place. When the batch is not full, the runner
+    waits up to max_wait seconds for more conversations before sending it.
+    """
+
+    def __init__(self, generator, batch_size=16, max_wait=2.0, queue_size=64):
+        """
+        Initialize the runner.
+
+        Args:
+            generator (BatchGenerator): Generates each round of requests.
+            batch_size (int): Maximum number of conversations advanced together.
+            max_wait (float): Seconds to wait for more conversations before sending a partial batch.
+            queue_size (int): Maximum number of conversations waiting for a slot.
+        """
+        self.generator = generator
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait
+        self.stop_event = threading.Event()
+        # Set by Ctrl-C, so callers can tell a stopped run from a finished one
+        self.interrupted = False
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._active = []
+        self._source_done = False
+        self._finished = 0
+
+    def _produce(self, conversations):
+        try:
+            for conversation in conversations:
+                while not self.stop_event.is_set():
+                    try:
+                        self._queue.put(conversation, timeout=0.2)
+                        break
+                    except queue.Full:
+                        continue
+                if self.stop_event.is_set():
+                    break
+        except Exception as e:
+            print(f"Error while preparing conversations: {str(e)}")
+        finally:
+            self._queue.put(_DONE)
+
+    def _advance(self, conversation, response):
+        # Feed the response to the conversation; returns False once it has ended
+        try:
+            conversation.request = conversation.steps.send(response)
+            return True
+        except StopIteration as stop:
+            self._finish(conversation, stop.value)
+        except Exception as e:
+            self._finish(conversation, None, e)
+        return False
+
+    def _finish(self, conversation, result, error=None):
+        conversation.steps.close()
+        self._finished += 1
+        conversation.on_finish(result, error)
+
+    def _fill(self):
+        deadline = time.monotonic() + self.max_wait
+        while len(self._active) < self.batch_size and not self._source_done and not self.stop_event.is_set():
+            if self._active:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+            else:
+                # Nothing to send yet, so wait for the first conversation
+                timeout = 0.2
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                self._source_done = True
+                break
+            conversation = _ActiveConversation(*item)
+            if self._advance(conversation, None):
+                self._active.append(conversation)
+
+    def _loop(self):
+        while True:
+            self._fill()
+            if not self._active:
+                if self._source_done or self.stop_event.is_set():
+                    return
+                continue
+            responses = self.generator.generate([conversation.request for conversation in self._active])
+            still_active = []
+            for conversation, response in zip(self._active, responses):
+                if isinstance(response, Exception):
+                    self._finish(conversation, None, response)
+                elif self._advance(conversation, response):
+                    still_active.append(conversation)
+            self._active = still_active
+
+    def run(self, conversations):
+        """
+        Run every conversation to the end.
+
+        The first Ctrl-C stops starting new conversations and lets the active
+        ones finish; a second Ctrl-C stops immediately.
+
+        Args:
+            conversations (iterable): Yields (steps, on_finish) pairs: a conversation step generator, and a callback called as on_finish(result, error) when it ends.
+
+        Returns:
+            int: The number of conversations that ended.
+        """
+        threading.Thread(target=self._produce, args=(conversations,), name="synthgen-batch-discovery", daemon=True).start()
+        try:
+            try:
+                self._loop()
+            except KeyboardInterrupt:
+                print("\nInterrupted: finishing active conversations. Press Ctrl-C again to stop immediately.")
+                self.interrupted = True
+                self.stop_event.set()
+                try:
+                    self._loop()
+                except KeyboardInterrupt:
+                    print("\nStopping immediately.")
+        finally:
+            self.stop_event.set()
+            for conversation in self._active:
+                conversation.steps.close()
+            self._active = []
+            self.generator.close()
+        return self._finished
+
+def create_batch_runner(config, use_openai=False, use_claude=False, use_groq=False, use_gemini=False, use_local=False):
+    """
+    Create a batch runner from the 'batching' section of the config.
+
+    Args:
+        config (dict): Configuration settings.
+        use_openai (bool): Flag to use OpenAI.
+        use_claude (bool): Flag to use Claude.
+        use_groq (bool): Flag to use Groq.
+        use_gemini (bool): Flag to use Gemini.
+        use_local (bool): Flag to use local model.
+
+    Returns:
+        BatchRunner: The configured runner.
+    """
+    batching = config.get('batching') or {}
+    generator = BatchGenerator(config, use_openai, use_claude, use_groq, use_gemini, use_local)
+    return BatchRunner(
+        generator,
+        batch_size=batching.get('batch_size', 16),
+        max_wait=batching.get('max_wait', 2.0),
+        queue_size=config.get('concurrency', {}).get('queue_size', 64),
+    )
@@ -0,0 +1,74 @@
+# benchmarks/bench_connection_pooling.py
+#
+# Compare one connection per request (the previous requests.post behaviour) with
+# the pooled provider client, against a local mock OpenAI-compatible server.
+#
+#   python benchmarks/bench_connection_pooling.py --requests 200 --connect-latency 0.02
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from mock_openai_server import start_mock_server
+
+def bench_unpooled(url, payload, count):
+    for _ in range(count):
+        response = requests.post(url, headers={"Content-Type": "application/json"}, json=payload)
+        response.raise_for_status()
+
+def bench_pooled_sync(provider, payload, count):
+    from providers import run_sync
+    for _ in range(count):
+        run_sync(provider.post(payload))
+
+def bench_pooled_concurrent(provider, payload, count, concurrency):
+    from providers import run_sync
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                await provider.post(payload)
+
+        await asyncio.gather(*(one() for _ in range(count)))
+
+    run_sync(run_all())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0, help="Mock server response latency in seconds")
+    parser.add_argument("--connect-latency", type=float, default=0.01, help="Mock cost of each new connection in seconds")
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    server = start_mock_server(latency=args.latency, connect_latency=args.connect_latency)
+    os.environ['LOCAL_API_URL'] = server.url
+    from providers import get_provider, close_providers
+
+    provider = get_provider("local")
+    payload = provider.build_payload([{"role": "user", "content": "Hello"}], "mock-model", 0.7, 16)
+
+    scenarios = [
+        ("unpooled requests.post", lambda: bench_unpooled(server.url, payload, args.requests)),
+        ("pooled provider, sequential", lambda: bench_pooled_sync(provider, payload, args.requests)),
+        (f"pooled provider, {args.concurrency} concurrent", lambda: bench_pooled_concurrent(provider, payload, args.requests, args.concurrency)),
+    ]
+    for name, scenario in scenarios:
+        connections_before = server.connections
+        start = time.perf_counter()
+        scenario()
+        elapsed = time.perf_counter() - start
+        print(f"{name:35s} {elapsed:8.3f}s  {args.requests / elapsed:9.1f} req/s  {server.connections - connections_before:5d} connections")
+
+    close_providers()
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
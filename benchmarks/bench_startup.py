@@ -0,0 +1,109 @@
+# benchmarks/bench_startup.py
+#
+# Measure the import time and memory footprint of SynthGen at startup, with no
+# provider backend loaded and with each SDK-backed backend loaded on demand.
+# With --against, "import main" is also measured on another commit for comparison.
+#
+#   python benchmarks/bench_startup.py --runs 5
+#   python benchmarks/bench_startup.py --against HEAD~1
+
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each snippet prints the seconds spent importing; provider instances load their backend module
+SCENARIOS = {
+    "import main": "import main",
+    "main + local provider": "import main; from providers import get_provider; get_provider('local')",
+    "main + claude backend": "import main; from providers import get_provider; get_provider('claude', 'key')",
+    "main + gemini backend": "import main; from providers import get_provider; get_provider('gemini', 'key')",
+}
+
+def measure(snippet, cwd, runs):
+    """
+    Run a snippet in fresh interpreters and measure its duration and peak RSS.
+
+    Args:
+        snippet (str): Python statements to time.
+        cwd (str): Directory holding the SynthGen modules.
+        runs (int): Number of fresh interpreters to start.
+
+    Returns:
+        dict: Median seconds and median peak RSS in MB.
+    """
+    code = f"import time; start = time.perf_counter(); {snippet}; print(time.perf_counter() - start)"
+    env = dict(os.environ, PYTHONPATH=cwd, PYTHONWARNINGS="ignore")
+    seconds = []
+    rss_mb = []
+    for _ in range(runs):
+        process = subprocess.Popen([sys.executable, "-c", code], cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output = process.stdout.read()
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            rss_mb.append((usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024) / (1024 * 1024))
+        else:
+            process.wait()
+        if process.returncode != 0:
+            return {"error": f"exited with status {process.returncode}"}
+        seconds.append(float(output.decode().strip().splitlines()[-1]))
+    result = {"seconds": statistics.median(seconds)}
+    if rss_mb:
+        result["peak_rss_mb"] = statistics.median(rss_mb)
+    return result
+
+def export_tree(revision, directory):
+    """
+    Extract the files of a commit into a directory.
+
+    Args:
+        revision (str): The git revision.
+        directory (str): The target directory.
+    """
+    archive = subprocess.run(["git", "archive", "--format=tar", revision], cwd=REPO_DIR, capture_output=True, check=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory)
+
+def print_result(name, result):
+    if "error" in result:
+        print(f"  {name:28s} {result['error']}")
+        return
+    rss = f"{result['peak_rss_mb']:8.1f} MB" if "peak_rss_mb" in result else ""
+    print(f"  {name:28s} {result['seconds'] * 1000:8.0f} ms {rss}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure SynthGen's startup time and import footprint.")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per scenario; the median is reported")
+    parser.add_argument("--against", help="Also measure 'import main' on this git revision")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {}
+    print("Current tree:")
+    for name, snippet in SCENARIOS.items():
+        results[name] = measure(snippet, REPO_DIR, args.runs)
+        print_result(name, results[name])
+
+    if args.against:
+        with tempfile.TemporaryDirectory(prefix="synthgen-startup-") as directory:
+            export_tree(args.against, directory)
+            results[f"import main @ {args.against}"] = measure(SCENARIOS["import main"], directory, args.runs)
+        print(f"{args.against}:")
+        print_result("import main", results[f"import main @ {args.against}"])
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f"Wrote results to {args.output}")
+
+if __name__ == "__main__":
+    main()
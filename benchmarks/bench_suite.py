@@ -0,0 +1,460 @@
+# benchmarks/bench_suite.py
+#
+# Benchmark SynthGen's own overhead against a local mock OpenAI-compatible
+# server and a synthetic vault. Every scenario runs in a fresh process, so its
+# CPU time and peak RSS are measured on their own. Results are written as JSON
+# and can be compared with the results of another commit.
+#
+#   python benchmarks/bench_suite.py --output results.json
+#   python benchmarks/bench_suite.py --scenarios end_to_end --latency 0.2 --tokens-per-second 80
+#   python benchmarks/bench_suite.py --scenarios end_to_end --latency 0.2 --mock-servers 3
+#   python benchmarks/bench_suite.py --scenarios distributed --workers 3 --shards 6 --interrupt-after 2
+#   python benchmarks/bench_suite.py --output new.json --compare baseline.json
+
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from synthetic_vault import generate_vault
+
+def _run_dir(args, name):
+    # Start every scenario from an empty directory, so state from an earlier run is not reused
+    run_dir = os.path.join(args.work_dir, name)
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    return run_dir
+
+def _load_config(run_dir, args):
+    """
+    Build the run configuration from the repository config.yaml, pointed at the benchmark's vault, mock server and run directory.
+    """
+    import yaml
+    with open(os.path.join(REPO_DIR, "config.yaml"), 'r', encoding='utf-8') as file:
+        config = yaml.safe_load(file)
+    config['file_paths']['obsidian_vault_path'] = os.path.join(args.work_dir, "vault")
+    config['file_paths']['state_store'] = os.path.join(run_dir, "state.db")
+    config['conversation_generation'] = dict(config.get('conversation_generation') or {}, num_conversations=args.conversations, fused_turns=args.fused)
+    config['output'] = dict(config.get('output') or {}, directory=os.path.join(run_dir, "output"), export_json=False, sink=args.sink)
+    config['response_cache'] = dict(config.get('response_cache') or {}, mode="off")
+    config['streaming'] = dict(config.get('streaming') or {}, enabled=args.stream)
+    config['metrics'] = {"enabled": True, "write_file": True, "prometheus_port": None}
+    config['batching'] = dict(config.get('batching') or {}, enabled=args.batching)
+    return config
+
+def _metrics_records(run_dir):
+    records = []
+    for path in glob.glob(os.path.join(run_dir, "output", "*.metrics.jsonl")):
+        with open(path, 'r', encoding='utf-8') as file:
+            records.extend(json.loads(line) for line in file if line.strip())
+    return records
+
+def scenario_end_to_end(args):
+    """
+    Run main.main() over the whole synthetic vault.
+    """
+    import yaml
+    run_dir = _run_dir(args, "end_to_end")
+    with open(os.path.join(run_dir, "config.yaml"), 'w', encoding='utf-8') as file:
+        yaml.safe_dump(_load_config(run_dir, args), file, allow_unicode=True)
+
+    import main
+    from output_sinks import iter_jsonl_records
+    os.chdir(run_dir)
+    start = time.perf_counter()
+    main.main(["--provider", "local", "--non-interactive"])
+    elapsed = time.perf_counter() - start
+
+    conversation_ids = set()
+    messages = 0
+    for path in glob.glob(os.path.join(run_dir, "output", "*.jsonl")) + glob.glob(os.path.join(run_dir, "output", "*", "manifest.jsonl")):
+        if path.endswith((".metrics.jsonl", ".partial.jsonl")):
+            continue
+        for record in iter_jsonl_records(path):
+            conversation_ids.add(record.get("conversation_id"))
+            # Manifest lines stand for a conversation frame of several records
+            messages += record.get("records", 1) if path.endswith("manifest.jsonl") else 1
+    records = _metrics_records(run_dir)
+    return {
+        "wall_seconds": elapsed,
+        "conversations": len(conversation_ids),
+        "conversations_per_minute": len(conversation_ids) / elapsed * 60,
+        "messages": messages,
+        "requests": len(records) + sum(record["retries"] for record in records),
+        "failed_requests": sum(1 for record in records if record["error"]),
+    }
+
+def scenario_append_output(args):
+    """
+    Append message records through append_conversation_to_json until the output reaches its full size.
+    """
+    from conversation import append_conversation_to_json
+    from output_sinks import create_sink
+    from mock_openai_server import make_response_text
+
+    run_dir = _run_dir(args, "append_output")
+    config = _load_config(run_dir, args)
+    content = make_response_text(args.response_words)
+    sink = create_sink(config, "bench")
+    start = time.perf_counter()
+    for index in range(args.records):
+        conversation_id = f"conversation-{index // 20}"
+        append_conversation_to_json({"role": "assistant", "name": "Professor", "content": content, "conversation_id": conversation_id, "turn": index % 20, "token_count": 0}, sink, conversation_id)
+        if index % 20 == 19:
+            sink.end_conversation(conversation_id)
+    sink.close()
+    elapsed = time.perf_counter() - start
+    if os.path.isdir(sink.path):
+        size = sum(os.path.getsize(os.path.join(sink.path, name)) for name in os.listdir(sink.path))
+    else:
+        size = os.path.getsize(sink.path)
+    megabytes = size / (1024 * 1024)
+    return {
+        "wall_seconds": elapsed,
+        "records": args.records,
+        "records_per_second": args.records / elapsed,
+        "output_mb": megabytes,
+        "mb_per_second": megabytes / elapsed,
+    }
+
+def scenario_vault_discovery(args):
+    """
+    Index the synthetic vault from scratch, again unchanged, and again after editing one note in a hundred.
+    """
+    from state_store import StateStore
+    from vault_index import VaultIndex
+
+    run_dir = _run_dir(args, "vault_discovery")
+    vault_path = os.path.join(args.work_dir, "vault")
+    index = VaultIndex(StateStore(os.path.join(run_dir, "state.db")))
+
+    start = time.perf_counter()
+    notes = index.refresh(vault_path)
+    cold_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index.refresh(vault_path)
+    warm_seconds = time.perf_counter() - start
+
+    for note_path in notes[::100]:
+        with open(note_path, 'a', encoding='utf-8') as file:
+            file.write("\nEdited for the benchmark.\n")
+    start = time.perf_counter()
+    index.refresh(vault_path)
+    incremental_seconds = time.perf_counter() - start
+    return {
+        "wall_seconds": cold_seconds + warm_seconds + incremental_seconds,
+        "notes": len(notes),
+        "cold_seconds": cold_seconds,
+        "cold_notes_per_second": len(notes) / cold_seconds,
+        "warm_seconds": warm_seconds,
+        "incremental_seconds": incremental_seconds,
+    }
+
+def scenario_prompt_construction(args):
+    """
+    Generate conversations one after another with generate_conversation and measure the time spent outside model requests.
+    """
+    from conversation import generate_conversation
+    from file_utils import read_obsidian_note
+    from metrics import configure_metrics, request_metrics
+    from output_sinks import create_sink
+    from providers import close_providers, configure_providers
+    from rate_limiter import configure_rate_limits
+    from vault_index import scan_notes
+
+    run_dir = _run_dir(args, "prompt_construction")
+    config = _load_config(run_dir, args)
+    configure_providers(config)
+    configure_rate_limits(config)
+    configure_metrics(config, "bench")
+    sink = create_sink(config, "bench")
+    note_paths = sorted(scan_notes(config['file_paths']['obsidian_vault_path']))[:args.prompt_notes]
+
+    start = time.perf_counter()
+    for note_path in note_paths:
+        generate_conversation(read_obsidian_note(note_path), sink, config, False, False, False, False, True)
+    elapsed = time.perf_counter() - start
+    sink.close()
+    request_metrics.close()
+    close_providers()
+
+    records = _metrics_records(run_dir)
+    request_seconds = sum(record["wall_seconds"] for record in records)
+    return {
+        "wall_seconds": elapsed,
+        "conversations": len(note_paths),
+        "requests": len(records),
+        "request_seconds": request_seconds,
+        "overhead_ms_per_request": (elapsed - request_seconds) / len(records) * 1000 if records else None,
+    }
+
+def scenario_distributed(args):
+    """
+    Plan a round, run it with several worker processes on this machine and merge it.
+
+    With --interrupt-after, the first worker is interrupted that many seconds
+    in and started again, so a released shard is picked up by the workers and
+    the merge is checked against output written by more than one run.
+    """
+    import yaml
+    import sharding
+    from dataset_export import iter_conversations
+    run_dir = _run_dir(args, "distributed")
+    config = _load_config(run_dir, args)
+    config['distributed'] = dict(config.get('distributed') or {}, work_dir=os.path.join(run_dir, "synth_distributed"))
+    with open(os.path.join(run_dir, "config.yaml"), 'w', encoding='utf-8') as file:
+        yaml.safe_dump(config, file, allow_unicode=True)
+
+    leases_path = os.path.join(run_dir, "leases.db")
+    start = time.perf_counter()
+    sharding.plan_round(config, leases_path, args.shards)
+
+    def start_worker(worker_id):
+        command = [sys.executable, os.path.join(REPO_DIR, "main.py"), "--provider", "local", "--non-interactive",
+                   "--coordinator", leases_path, "--worker-id", worker_id]
+        log = open(os.path.join(run_dir, f"{worker_id}.log"), 'a', encoding='utf-8')
+        return subprocess.Popen(command, cwd=run_dir, stdout=log, stderr=subprocess.STDOUT), log
+
+    workers = [start_worker(f"worker-{index}") for index in range(args.workers)]
+    if args.interrupt_after:
+        time.sleep(args.interrupt_after)
+        process, log = workers[0]
+        process.send_signal(signal.SIGINT)
+        process.wait()
+        log.close()
+        workers[0] = start_worker("worker-0")
+    for process, log in workers:
+        process.wait()
+        log.close()
+    run_seconds = time.perf_counter() - start
+
+    merged_path = sharding.merge_round(config, leases_path)
+    elapsed = time.perf_counter() - start
+    leases = sharding.ShardLeases(leases_path)
+    try:
+        shards = leases.status()['shards']
+    finally:
+        leases.close()
+
+    conversation_ids = set()
+    message_keys = set()
+    messages = 0
+    duplicate_messages = 0
+    for conversation_id, records in iter_conversations(merged_path) if merged_path else ():
+        conversation_ids.add(conversation_id)
+        for record in records:
+            message_key = (conversation_id, record.get("turn"), record.get("role"), record.get("name"))
+            duplicate_messages += message_key in message_keys
+            message_keys.add(message_key)
+            messages += 1
+    return {
+        "wall_seconds": elapsed,
+        "run_seconds": run_seconds,
+        "merge_seconds": elapsed - run_seconds,
+        "shards_done": shards["done"],
+        "shards_not_done": shards["leased"] + shards["waiting"],
+        "conversations": len(conversation_ids),
+        "conversations_per_minute": len(conversation_ids) / elapsed * 60,
+        "messages": messages,
+        "duplicate_messages": duplicate_messages,
+    }
+
+SCENARIOS = {
+    "end_to_end": scenario_end_to_end,
+    "distributed": scenario_distributed,
+    "append_output": scenario_append_output,
+    "vault_discovery": scenario_vault_discovery,
+    "prompt_construction": scenario_prompt_construction,
+}
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_mock_process(args):
+    """
+    Start the mock server in its own process, so its CPU time is not counted against SynthGen.
+
+    Returns:
+        tuple: The server process and its chat completions URL.
+    """
+    port = _free_port()
+    command = [
+        sys.executable, os.path.join(BENCHMARKS_DIR, "mock_openai_server.py"),
+        "--port", str(port),
+        "--latency", str(args.latency),
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--error-rate", str(args.error_rate),
+        "--response-words", str(args.response_words),
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}/v1"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"{base_url}/models", timeout=1).close()
+            return process, f"{base_url}/chat/completions"
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("The mock server did not start")
+
+def run_scenario_process(name, argv, work_dir):
+    """
+    Run one scenario in a child process and measure its CPU time and peak RSS.
+
+    Args:
+        name (str): The scenario name.
+        argv (list): Command-line arguments passed on to the child.
+        work_dir (str): The benchmark work directory.
+
+    Returns:
+        dict: The scenario results.
+    """
+    result_path = os.path.join(work_dir, f"{name}.result.json")
+    log_path = os.path.join(work_dir, f"{name}.log")
+    command = [sys.executable, os.path.abspath(__file__), *argv, "--run-scenario", name, "--result-file", result_path]
+    with open(log_path, 'w', encoding='utf-8') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+        else:
+            process.wait()
+            usage = None
+    if process.returncode != 0 or not os.path.exists(result_path):
+        return {"error": f"exited with status {process.returncode}, see {log_path}"}
+
+    with open(result_path, 'r', encoding='utf-8') as file:
+        result = json.load(file)
+    if usage is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        rss_bytes = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        result["process_cpu_seconds"] = usage.ru_utime + usage.ru_stime
+        result["peak_rss_mb"] = rss_bytes / (1024 * 1024)
+    if result.get("requests"):
+        result["cpu_ms_per_request"] = result["cpu_seconds"] / result["requests"] * 1000
+    return result
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(baseline, current):
+    """
+    Print the change of every numeric result between two benchmark runs.
+
+    Args:
+        baseline (dict): The earlier results.
+        current (dict): The new results.
+    """
+    print(f"\nComparison with {baseline.get('commit') or 'baseline'}:")
+    for name, results in current["scenarios"].items():
+        base_results = baseline.get("scenarios", {}).get(name)
+        if not base_results:
+            continue
+        print(f"  {name}")
+        for metric, value in results.items():
+            base_value = base_results.get(metric)
+            if isinstance(value, (int, float)) and isinstance(base_value, (int, float)) and base_value:
+                print(f"    {metric:28s} {base_value:14,.3f} -> {value:14,.3f}  {(value - base_value) / base_value:+8.1%}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the SynthGen benchmark scenarios.")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--notes", type=int, default=50, help="Notes in the synthetic vault")
+    parser.add_argument("--words", type=int, default=600, help="Approximate words per note")
+    parser.add_argument("--conversations", type=int, default=1, help="Conversations per note")
+    parser.add_argument("--stream", action="store_true", help="Stream responses")
+    parser.add_argument("--batching", action="store_true", help="Run end_to_end with turn-synchronous batching")
+    parser.add_argument("--sink", choices=["jsonl", "dataset"], default="jsonl", help="Output sink of end_to_end and append_output")
+    parser.add_argument("--fused", action="store_true", help="Run end_to_end generating each turn's CoR and Professor reply with one request")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mock server latency per request in seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Mock server generation speed (0 for instant)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock requests answered with a 429 or 503")
+    parser.add_argument("--mock-servers", type=int, default=1, help="Mock servers the local endpoint pool spreads requests over")
+    parser.add_argument("--response-words", type=int, default=150, help="Words per mock completion and per appended record")
+    parser.add_argument("--records", type=int, default=200000, help="Records written by append_output")
+    parser.add_argument("--prompt-notes", type=int, default=5, help="Notes used by prompt_construction")
+    parser.add_argument("--workers", type=int, default=2, help="Worker processes run by distributed")
+    parser.add_argument("--shards", type=int, default=8, help="Shards planned by distributed")
+    parser.add_argument("--interrupt-after", type=float, default=0.0, help="Seconds after which distributed interrupts and restarts its first worker (0 for never)")
+    parser.add_argument("--work-dir", help="Directory for the vault and run files (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare the results with an earlier results file")
+    parser.add_argument("--mock-url", help=argparse.SUPPRESS)
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        # Child process: run one scenario and write its results
+        # The local endpoint pool spreads requests over every mock server
+        os.environ['LOCAL_API_URLS'] = args.mock_url
+        os.environ['LOCAL_API_URL'] = args.mock_url.split(",")[0]
+        os.environ['LOCAL_API_MODEL'] = "mock-model"
+        # Import every module up front, so the scenario's CPU time leaves out interpreter startup
+        import main  # noqa: F401
+        cpu_start = time.process_time()
+        result = SCENARIOS[args.run_scenario](args)
+        result["cpu_seconds"] = time.process_time() - cpu_start
+        with open(args.result_file, 'w', encoding='utf-8') as file:
+            json.dump(result, file)
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="synthgen-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    vault_path = os.path.join(work_dir, "vault")
+    if not os.path.isdir(vault_path):
+        generate_vault(vault_path, args.notes, args.words)
+
+    mocks = [start_mock_process(args) for _ in range(max(1, args.mock_servers))]
+    child_argv = [arg for arg in sys.argv[1:] if arg not in ("--keep",)]
+    child_argv += ["--work-dir", work_dir, "--mock-url", ",".join(url for _, url in mocks)]
+    results = {
+        "commit": _git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("output", "compare", "work_dir", "keep", "mock_url", "run_scenario", "result_file")},
+        "scenarios": {},
+    }
+    try:
+        for name in args.scenarios:
+            print(f"Running {name}...")
+            results["scenarios"][name] = run_scenario_process(name, child_argv, work_dir)
+            print(f"  {json.dumps(results['scenarios'][name])}")
+    finally:
+        for mock_process, _ in mocks:
+            mock_process.terminate()
+            mock_process.wait()
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f"Wrote results to {args.output}")
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            compare_results(json.load(file), results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+# benchmarks/mock_openai_server.py
+
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Minimal OpenAI-compatible chat completions handler with keep-alive support.
+
+    Requests whose prompt asks for a fused turn (a <cor> block followed by a
+    <professor> block) are answered in that format, unless the server is told
+    not to, so both the fused and the fallback path can be exercised.
+
+    Chat completions take latency seconds plus the completion tokens at
+    tokens_per_second, are streamed as server-sent events when the request asks
+    for it, and fail with a 429 or 503 at the configured error rate.
+
+    Also stands in for the OpenAI Batch API (/files, /batches) and the
+    Anthropic Message Batches API (/messages/batches). Batches complete
+    batch_latency seconds after they are created.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately; avoid Nagle/delayed-ACK stalls on reused connections
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Runs once per TCP connection, standing in for TCP and TLS handshake cost
+        self.server.record_connection()
+        if self.server.connect_latency:
+            time.sleep(self.server.connect_latency)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, status, text):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/jsonl")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        parts = path.split('/')
+        if path.endswith('/models'):
+            self._send_json(200, {"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+        elif path.endswith('/stats'):
+            self._send_json(200, self.server.stats())
+        elif '/messages/batches/' in path and path.endswith('/results'):
+            self._send_text(200, self.server.batch_results(parts[-2]))
+        elif '/messages/batches/' in path:
+            self._send_json(200, self.server.anthropic_batch(parts[-1], self._base_url()))
+        elif '/batches/' in path:
+            self._send_json(200, self.server.openai_batch(parts[-1]))
+        elif '/files/' in path and path.endswith('/content'):
+            self._send_text(200, self.server.files.get(parts[-2], ""))
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw_body = self.rfile.read(length)
+        path = self.path.rstrip('/')
+        if path.endswith('/files'):
+            self._send_json(200, self.server.add_file(self._uploaded_file(raw_body)))
+            return
+        request = json.loads(raw_body or b"{}")
+        if path.endswith('/messages/batches'):
+            self._send_json(200, self.server.create_batch("anthropic", [(item["custom_id"], item["params"]) for item in request["requests"]]))
+            return
+        if path.endswith('/batches'):
+            lines = self.server.files[request["input_file_id"]].splitlines()
+            items = [json.loads(line) for line in lines if line.strip()]
+            self._send_json(200, self.server.create_batch("openai", [(item["custom_id"], item["body"]) for item in items]))
+            return
+
+        if self.server.should_fail():
+            self._send_error_response()
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        completion = self.server.completion(request)
+        if request.get("stream"):
+            self._stream_completion(request, completion)
+            return
+        time.sleep(self.server.generation_seconds(completion["usage"]["completion_tokens"]))
+        self._send_json(200, completion)
+
+    def _send_error_response(self):
+        # Alternate between a rate limit and a transient server error
+        if self.server.errors % 2:
+            body = json.dumps({"error": {"message": "Rate limit reached", "type": "rate_limit_error"}}).encode('utf-8')
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+        else:
+            body = json.dumps({"error": {"message": "Service unavailable", "type": "server_error"}}).encode('utf-8')
+            self.send_response(503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream_completion(self, request, completion):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = completion["choices"][0]["message"]["content"].split(" ")
+        delay = self.server.generation_seconds(completion["usage"]["completion_tokens"]) / len(words)
+        for index, word in enumerate(words):
+            if delay:
+                time.sleep(delay)
+            delta = word if index == len(words) - 1 else word + " "
+            self._write_event({"id": completion["id"], "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]})
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self._write_event({"id": completion["id"], "object": "chat.completion.chunk", "choices": [], "usage": completion["usage"]})
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_event(self, data):
+        self._write_chunk(b"data: " + json.dumps(data).encode('utf-8') + b"\n\n")
+
+    def _write_chunk(self, data):
+        # HTTP/1.1 chunked transfer encoding keeps the connection reusable
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _uploaded_file(self, raw_body):
+        # Parse the multipart/form-data upload of the Files API
+        header = f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode('utf-8')
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + raw_body)
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "file":
+                return part.get_payload(decode=True).decode('utf-8')
+        return ""
+
+    def _base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """
+    Threaded mock server that counts the TCP connections it accepts.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, connect_latency=0.0, response_text="This is a mock response.", batch_latency=0.0, tokens_per_second=0.0, error_rate=0.0, seed=0, fused_format=True):
+        super().__init__(address, MockOpenAIHandler)
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.response_text = response_text
+        self.batch_latency = batch_latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.fused_format = fused_format
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self.files = {}
+        self.batches = {}
+        self._ids = itertools.count(1)
+        self._connections_lock = threading.Lock()
+
+    def record_connection(self):
+        with self._connections_lock:
+            self.connections += 1
+
+    def should_fail(self):
+        """
+        Count a chat completions request and decide whether it fails.
+
+        Returns:
+            bool: True if the request should get an error response.
+        """
+        with self._connections_lock:
+            self.requests += 1
+            if self.error_rate and self._rng.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+    def generation_seconds(self, completion_tokens):
+        return completion_tokens / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def stats(self):
+        with self._connections_lock:
+            return {"requests": self.requests, "errors": self.errors, "connections": self.connections}
+
+    def completion(self, request):
+        """
+        Build the chat completion returned for a request.
+
+        Args:
+            request (dict): The chat completions request body.
+
+        Returns:
+            dict: The chat completion.
+        """
+        content = self.response_text
+        prompt = "".join(str(message.get("content", "")) for message in request.get("messages", []))
+        if self.fused_format and "<professor>" in prompt:
+            cor = json.dumps({"🎯": content})
+            content = f"<cor>\n{cor}\n</cor>\n<professor>\n🧙🏿‍♂️: {content}\n</professor>"
+        prompt_chars = len(prompt)
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "model": request.get("model", "mock-model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_chars // 4,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": (prompt_chars + len(content)) // 4,
+            },
+        }
+
+    def add_file(self, content):
+        with self._connections_lock:
+            file_id = f"file-{next(self._ids)}"
+            self.files[file_id] = content
+        return {"id": file_id, "object": "file", "purpose": "batch", "bytes": len(content)}
+
+    def create_batch(self, api, items):
+        with self._connections_lock:
+            batch_id = f"batch-{next(self._ids)}"
+            self.batches[batch_id] = {"api": api, "items": items, "created": time.monotonic()}
+        if api == "anthropic":
+            return {"id": batch_id, "type": "message_batch", "processing_status": "in_progress", "results_url": None}
+        return {"id": batch_id, "object": "batch", "status": "in_progress", "output_file_id": None}
+
+    def _batch_done(self, batch):
+        return time.monotonic() - batch["created"] >= self.batch_latency
+
+    def batch_results(self, batch_id):
+        batch = self.batches[batch_id]
+        lines = []
+        for custom_id, body in batch["items"]:
+            completion = self.completion(body)
+            if batch["api"] == "anthropic":
+                message = {"type": "message", "role": "assistant", "content": [{"type": "text", "text": completion["choices"][0]["message"]["content"]}]}
+                lines.append({"custom_id": custom_id, "result": {"type": "succeeded", "message": message}})
+            else:
+                lines.append({"id": f"response-{custom_id}", "custom_id": custom_id, "response": {"status_code": 200, "body": completion}, "error": None})
+        return "\n".join(json.dumps(line) for line in lines) + "\n"
+
+    def openai_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        if not self._batch_done(batch):
+            return {"id": batch_id, "object": "batch", "status": "in_progress", "output_file_id": None}
+        with self._connections_lock:
+            if "output_file_id" not in batch:
+                batch["output_file_id"] = f"file-{next(self._ids)}"
+                self.files[batch["output_file_id"]] = self.batch_results(batch_id)
+        return {"id": batch_id, "object": "batch", "status": "completed", "output_file_id": batch["output_file_id"]}
+
+    def anthropic_batch(self, batch_id, base_url):
+        if not self._batch_done(self.batches[batch_id]):
+            return {"id": batch_id, "type": "message_batch", "processing_status": "in_progress", "results_url": None}
+        return {"id": batch_id, "type": "message_batch", "processing_status": "ended", "results_url": f"{base_url}/messages/batches/{batch_id}/results"}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+def make_response_text(words):
+    """
+    Build a completion of a given length out of a fixed vocabulary.
+
+    Args:
+        words (int): The number of words.
+
+    Returns:
+        str: The text.
+    """
+    vocabulary = ["the", "reasoning", "step", "suggests", "we", "consider", "another", "angle", "on", "this", "problem", "before", "moving", "forward."]
+    return " ".join(vocabulary[index % len(vocabulary)] for index in range(words))
+
+def start_mock_server(port=0, **kwargs):
+    """
+    Start a mock server in a background thread.
+
+    Args:
+        port (int): Port to listen on. 0 picks a free port.
+        **kwargs: Options passed to MockOpenAIServer.
+
+    Returns:
+        MockOpenAIServer: The running server. Call shutdown() to stop it.
+    """
+    server = MockOpenAIServer(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=server.serve_forever, name="mock-openai-server", daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a mock OpenAI-compatible chat completions server.")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each request")
+    parser.add_argument("--connect-latency", type=float, default=0.0, help="Seconds to wait on every new connection")
+    parser.add_argument("--batch-latency", type=float, default=0.0, help="Seconds before a submitted batch completes")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Generation speed of completions (0 for instant)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of chat completions answered with a 429 or 503")
+    parser.add_argument("--response-words", type=int, default=0, help="Words per completion (0 for a short fixed response)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the error sequence")
+    parser.add_argument("--no-fused-format", action="store_true", help="Answer fused turn requests with the plain response, forcing the two-request fallback")
+    args = parser.parse_args()
+
+    options = {"response_text": make_response_text(args.response_words)} if args.response_words else {}
+    server = MockOpenAIServer(
+        ("127.0.0.1", args.port),
+        latency=args.latency,
+        connect_latency=args.connect_latency,
+        batch_latency=args.batch_latency,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        fused_format=not args.no_fused_format,
+        **options
+    )
+    print(f"Mock server listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,104 @@
+# benchmarks/synthetic_vault.py
+#
+# Generate a synthetic Obsidian vault for benchmarks: nested folders of
+# Markdown notes with frontmatter, headings, lists and wiki links.
+#
+#   python benchmarks/synthetic_vault.py /tmp/vault --notes 1000 --words 800
+
+import argparse
+import os
+import random
+
+_WORDS = (
+    "memory palace insight reasoning chain goal context problem solution question answer "
+    "hypothesis evidence pattern structure habit reflection journal project plan idea "
+    "learning practice feedback focus energy decision priority system process review"
+).split()
+
+def _sentence(rng):
+    words = [rng.choice(_WORDS) for _ in range(rng.randint(6, 18))]
+    return " ".join(words).capitalize() + rng.choice([".", ".", ".", "?", "!"])
+
+def make_note(rng, words, note_names):
+    """
+    Build the Markdown text of one note.
+
+    Args:
+        rng (random.Random): Random generator.
+        words (int): Approximate number of words in the body.
+        note_names (list): Names of other notes, used for wiki links.
+
+    Returns:
+        str: The note text.
+    """
+    lines = [
+        "---",
+        f"tags: [{rng.choice(_WORDS)}, {rng.choice(_WORDS)}]",
+        f"created: 2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "---",
+        "",
+        f"# {rng.choice(_WORDS).capitalize()} {rng.choice(_WORDS)}",
+        "",
+    ]
+    written = 0
+    while written < words:
+        kind = rng.random()
+        if kind < 0.15:
+            lines += [f"## {rng.choice(_WORDS).capitalize()} {rng.choice(_WORDS)}", ""]
+        elif kind < 0.35:
+            items = [f"- {_sentence(rng)}" for _ in range(rng.randint(2, 5))]
+            lines += items + [""]
+            written += sum(len(item.split()) for item in items)
+        else:
+            sentences = [_sentence(rng) for _ in range(rng.randint(2, 6))]
+            if note_names and rng.random() < 0.5:
+                sentences.append(f"See [[{rng.choice(note_names)}]].")
+            paragraph = " ".join(sentences)
+            lines += [paragraph, ""]
+            written += len(paragraph.split())
+    return "\n".join(lines)
+
+def generate_vault(path, notes=100, words=500, folders=10, depth=2, seed=0):
+    """
+    Write a synthetic vault.
+
+    Args:
+        path (str): Directory to create the vault in.
+        notes (int): Number of notes.
+        words (int): Approximate number of words per note.
+        folders (int): Number of folders the notes are spread over.
+        depth (int): Maximum folder nesting depth.
+        seed (int): Seed of the generated content.
+
+    Returns:
+        list: Paths of the written notes.
+    """
+    rng = random.Random(seed)
+    folder_paths = [path]
+    for index in range(folders):
+        parent = rng.choice([folder for folder in folder_paths if folder.count(os.sep) - path.count(os.sep) < depth])
+        folder_paths.append(os.path.join(parent, f"Folder {index}"))
+    note_names = [f"Note {index} {rng.choice(_WORDS)}" for index in range(notes)]
+
+    note_paths = []
+    for name in note_names:
+        folder = rng.choice(folder_paths)
+        os.makedirs(folder, exist_ok=True)
+        note_path = os.path.join(folder, f"{name}.md")
+        with open(note_path, 'w', encoding='utf-8') as file:
+            file.write(make_note(rng, words, note_names))
+        note_paths.append(note_path)
+    return note_paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Obsidian vault.")
+    parser.add_argument("path")
+    parser.add_argument("--notes", type=int, default=100)
+    parser.add_argument("--words", type=int, default=500, help="Approximate words per note")
+    parser.add_argument("--folders", type=int, default=10)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    note_paths = generate_vault(args.path, args.notes, args.words, args.folders, args.depth, args.seed)
+    print(f"Wrote {len(note_paths)} notes to {args.path}")
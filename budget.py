@@ -0,0 +1,321 @@
+# budget.py
+
+import argparse
+import threading
+from credentials import CredentialsExhausted
+from router import Backend, default_model_id
+from state_store import StateStore
+
+# What the governor can do once the soft limit is reached
+SOFT_LIMIT_ACTIONS = ("reduce", "downgrade", "stop")
+
+class BudgetExceeded(CredentialsExhausted):
+    """
+    Raised instead of sending a request once the hard limit of the budget is reached.
+
+    Handled like exhausted API keys: checkpoints are kept and the note is not
+    marked as processed, so a run with a larger budget resumes it.
+    """
+
+class BudgetGovernor:
+    """
+    Keep a ledger of the tokens and cost of every request and hold the run to its budget.
+
+    The ledger is kept in the state store by name, so a resumed run picks up
+    where the spend of the earlier runs left off. The workers of a distributed
+    run keep it in the round's leases instead, and every request brings in the
+    spend of the other workers, so they hold to one budget. Once enough notes have
+    finished, the cost of the rest of the run is forecast from the average cost
+    per note. Reaching the soft limit, or a forecast over the hard limit, applies
+    the configured soft limit actions; reaching the hard limit stops every request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.enabled = False
+        self.state_store = None
+        self.ledger = None
+        self.prices = {}
+        self.default_price = None
+        self.batch_discount = 1.0
+        self.soft_limit = None
+        self.hard_limit = None
+        self.soft_limit_tokens = None
+        self.hard_limit_tokens = None
+        self.forecast_after = 5
+        self.actions = ()
+        self.reduce_factor = 0.5
+        self.downgrade_backend = None
+        self.soft_reached = False
+        self.hard_reached = False
+        self._usage = {}
+        self._unpriced = set()
+        self.total_cost = 0.0
+        self.total_tokens = 0
+        self.run_cost = 0.0
+        self.run_tokens = 0
+        self.planned_notes = 0
+        self.finished_notes = 0
+        self.forecast = None
+
+    def configure(self, config, state_store):
+        """
+        Apply the 'budget' section of the config and load the ledger from the state store.
+
+        Args:
+            config (dict): Configuration settings.
+            state_store (StateStore or ShardLeases or CoordinatorClient): Store persisting the ledger across runs and workers.
+        """
+        budget = config.get('budget') or {}
+        with self._lock:
+            self._reset()
+            self.enabled = budget.get('enabled', False)
+            if not self.enabled:
+                return
+            unknown = [action for action in budget.get('soft_limit_actions') or [] if action not in SOFT_LIMIT_ACTIONS]
+            if unknown:
+                raise ValueError(f"Unknown budget soft limit actions: {', '.join(unknown)}")
+            self.state_store = state_store
+            self.ledger = budget.get('ledger', "default")
+            self.prices = {model_id: tuple(price) for model_id, price in (budget.get('prices') or {}).items()}
+            self.default_price = tuple(budget['default_price']) if budget.get('default_price') else None
+            self.batch_discount = budget.get('batch_api_discount', 0.5)
+            self.soft_limit = budget.get('soft_limit')
+            self.hard_limit = budget.get('hard_limit')
+            self.soft_limit_tokens = budget.get('soft_limit_tokens')
+            self.hard_limit_tokens = budget.get('hard_limit_tokens')
+            self.forecast_after = max(1, budget.get('forecast_after_notes', 5))
+            self.actions = tuple(budget.get('soft_limit_actions') or ("reduce",))
+            self.reduce_factor = budget.get('reduce_factor', 0.5)
+            downgrade = budget.get('downgrade_to')
+            if downgrade:
+                self.downgrade_backend = Backend(downgrade['provider'], downgrade.get('model_id') or default_model_id(config, downgrade['provider']))
+            elif "downgrade" in self.actions:
+                raise ValueError("The 'downgrade' soft limit action needs a 'downgrade_to' backend in the 'budget' section.")
+            for provider, model_id, requests, prompt_tokens, completion_tokens, cost in state_store.load_budget_ledger(self.ledger):
+                self._usage[(provider, model_id)] = [requests, prompt_tokens, completion_tokens, cost]
+                self.total_cost += cost
+                self.total_tokens += prompt_tokens + completion_tokens
+            if self.total_tokens:
+                print(f"Budget ledger '{self.ledger}': ${self.total_cost:,.2f} and {self.total_tokens:,} tokens spent by earlier runs")
+            self._check_limits()
+
+    def price(self, model_id):
+        """
+        Return the price of a model.
+
+        Args:
+            model_id (str): The model ID.
+
+        Returns:
+            tuple: USD per million prompt tokens and per million completion tokens.
+        """
+        price = self.prices.get(model_id) or self.default_price
+        if price is None:
+            if model_id not in self._unpriced:
+                self._unpriced.add(model_id)
+                print(f"No price configured for {model_id} in the 'budget' section; counting its tokens at no cost.")
+            return 0.0, 0.0
+        return price
+
+    def record(self, provider, model_id, prompt_tokens, completion_tokens, batch_api=False):
+        """
+        Add the usage of a finished request to the ledger.
+
+        Args:
+            provider (str): The provider name.
+            model_id (str): The model ID.
+            prompt_tokens (int): Prompt tokens, as reported by the provider or estimated.
+            completion_tokens (int): Generated tokens.
+            batch_api (bool): Whether the request went through a provider batch API, billed at a discount.
+        """
+        if not self.enabled:
+            return
+        prompt_tokens = prompt_tokens or 0
+        completion_tokens = completion_tokens or 0
+        with self._lock:
+            prompt_price, completion_price = self.price(model_id)
+            cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+            if batch_api:
+                cost *= self.batch_discount
+            usage = self._usage.setdefault((provider, model_id or ""), [0, 0, 0, 0.0])
+            usage[0] += 1
+            usage[1] += prompt_tokens
+            usage[2] += completion_tokens
+            usage[3] += cost
+            self.total_cost += cost
+            self.total_tokens += prompt_tokens + completion_tokens
+            self.run_cost += cost
+            self.run_tokens += prompt_tokens + completion_tokens
+            self._check_limits()
+        total_cost, total_tokens = self.state_store.add_budget_usage(self.ledger, provider, model_id or "", prompt_tokens, completion_tokens, cost)
+        with self._lock:
+            # The ledger's totals include what other workers sharing it spent
+            self.total_cost = max(self.total_cost, total_cost)
+            self.total_tokens = max(self.total_tokens, total_tokens)
+            self._check_limits()
+
+    def plan(self, notes):
+        """
+        Add to the number of notes the run will generate from, for the forecast.
+
+        A worker of a distributed run adds the notes of each shard it claims.
+
+        Args:
+            notes (int): The number of notes queued.
+        """
+        with self._lock:
+            self.planned_notes += notes
+
+    def note_finished(self):
+        """
+        Record that a note of the run ended, and update the forecast every 'forecast_after_notes' notes.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.finished_notes += 1
+            # No forecast once no new notes are started
+            if not self.accepts_notes() or self.finished_notes % self.forecast_after or self.finished_notes >= self.planned_notes:
+                return
+            remaining = self.planned_notes - self.finished_notes
+            self.forecast = (
+                self.total_cost + self.run_cost / self.finished_notes * remaining,
+                self.total_tokens + self.run_tokens // self.finished_notes * remaining,
+            )
+            cost, tokens = self.forecast
+            print(f"Budget forecast after {self.finished_notes} of {self.planned_notes} notes: ${cost:,.2f} and {tokens:,} tokens for the run "
+                  f"(${self.run_cost / self.finished_notes:,.4f} per note)")
+            self._check_limits()
+
+    def _check_limits(self):
+        # Called with the lock held
+        if not self.hard_reached and (_over(self.total_cost, self.hard_limit) or _over(self.total_tokens, self.hard_limit_tokens)):
+            self.hard_reached = True
+            print(f"Budget hard limit reached: ${self.total_cost:,.2f} and {self.total_tokens:,} tokens spent. No more requests will be sent.")
+        if self.soft_reached or self.hard_reached:
+            return
+        if _over(self.total_cost, self.soft_limit) or _over(self.total_tokens, self.soft_limit_tokens):
+            reason = f"soft limit reached (${self.total_cost:,.2f} and {self.total_tokens:,} tokens spent)"
+        elif self.forecast is not None and (_over(self.forecast[0], self.hard_limit) or _over(self.forecast[1], self.hard_limit_tokens)):
+            reason = "forecast over the hard limit"
+        else:
+            return
+        self.soft_reached = True
+        applied = {
+            "reduce": f"max_tokens and turns cut to {self.reduce_factor:.0%}",
+            "downgrade": f"switching to {self.downgrade_backend}",
+            "stop": "no new notes will be started",
+        }
+        print(f"Budget {reason}: {', '.join(applied[action] for action in self.actions)}.")
+
+    def check(self):
+        """
+        Raise if the hard limit is reached; called before each request is sent.
+
+        Raises:
+            BudgetExceeded: If the hard limit is reached.
+        """
+        if self.hard_reached:
+            raise BudgetExceeded(f"The budget of ledger '{self.ledger}' is spent: ${self.total_cost:,.2f} and {self.total_tokens:,} tokens.")
+
+    def _acting(self, action):
+        return self.soft_reached and action in self.actions
+
+    def accepts_notes(self):
+        """
+        Return whether new notes may be started.
+
+        Returns:
+            bool: False once the hard limit is reached, or the soft limit with the 'stop' action.
+        """
+        return not (self.hard_reached or self._acting("stop"))
+
+    def max_tokens(self, max_tokens):
+        """
+        Return the max_tokens of a request, cut down past the soft limit with the 'reduce' action.
+        """
+        if self._acting("reduce"):
+            return max(1, int(max_tokens * self.reduce_factor))
+        return max_tokens
+
+    def turns(self, num_turns):
+        """
+        Return the number of turns of a new conversation, cut down past the soft limit with the 'reduce' action.
+        """
+        if self._acting("reduce"):
+            return max(2, int(num_turns * self.reduce_factor))
+        return num_turns
+
+    def backends(self, backends):
+        """
+        Return the backends to try for a request: the cheaper model past the soft limit with the 'downgrade' action.
+
+        Args:
+            backends (list): The backends ordered by the router.
+
+        Returns:
+            list: Backend objects.
+        """
+        if self._acting("downgrade"):
+            return [self.downgrade_backend]
+        return backends
+
+    def report(self):
+        """
+        Print the spend of the run and the ledger.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            print(f"\nBudget ledger '{self.ledger}': ${self.total_cost:,.2f} and {self.total_tokens:,} tokens in total, ${self.run_cost:,.2f} and {self.run_tokens:,} tokens this run")
+            limits = [f"{name} ${limit:,.2f}" for name, limit in (("soft", self.soft_limit), ("hard", self.hard_limit)) if limit is not None]
+            limits += [f"{name} {limit:,} tokens" for name, limit in (("soft", self.soft_limit_tokens), ("hard", self.hard_limit_tokens)) if limit is not None]
+            if limits:
+                print(f"  Limits: {', '.join(limits)}")
+            for (provider, model_id), (requests, prompt_tokens, completion_tokens, cost) in sorted(self._usage.items()):
+                print(f"  {provider}/{model_id}: {requests:,} requests, {prompt_tokens:,} prompt and {completion_tokens:,} completion tokens, ${cost:,.2f}")
+
+def _over(value, limit):
+    return limit is not None and value >= limit
+
+# Shared by every worker thread of the process
+budget_governor = BudgetGovernor()
+
+def configure_budget(config, state_store):
+    """
+    Apply the budget settings of the config to the shared governor.
+
+    Args:
+        config (dict): Configuration settings.
+        state_store (StateStore or ShardLeases or CoordinatorClient): Store persisting the ledger across runs and workers.
+    """
+    budget_governor.configure(config, state_store)
+
+if __name__ == "__main__":
+    from config import load_config
+
+    parser = argparse.ArgumentParser(description="Show or reset a budget ledger.")
+    parser.add_argument("--config", default="config.yaml", help="Path of the config file")
+    parser.add_argument("--ledger", help="Name of the ledger. Defaults to 'ledger' in the 'budget' section of the config")
+    parser.add_argument("--reset", action="store_true", help="Delete the ledger, so the next run starts with the whole budget")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    ledger = args.ledger or (config.get('budget') or {}).get('ledger', "default")
+    store = StateStore(config['file_paths'].get('state_store', 'synthgen_state.db'))
+    try:
+        if args.reset:
+            store.reset_budget_ledger(ledger)
+            print(f"Reset budget ledger '{ledger}'")
+        else:
+            total = 0.0
+            for provider, model_id, requests, prompt_tokens, completion_tokens, cost in store.load_budget_ledger(ledger):
+                print(f"{provider}/{model_id}: {requests:,} requests, {prompt_tokens:,} prompt and {completion_tokens:,} completion tokens, ${cost:,.4f}")
+                total += cost
+            print(f"Ledger '{ledger}': ${total:,.4f}")
+    finally:
+        store.close()
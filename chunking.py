@@ -0,0 +1,339 @@
+# chunking.py
+
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+import yaml
+from history import count_tokens
+
+_FRONTMATTER = re.compile(r"\A---[ \t]*\r?\n(.*?)\r?\n---[ \t]*(?:\r?\n|\Z)", re.DOTALL)
+_HEADING = re.compile(r"^(#{1,6})[ \t]+(.+?)(?:[ \t]+#+)?[ \t]*$")
+_FENCE = re.compile(r"^[ \t]*(```|~~~)")
+_COMMENT = re.compile(r"%%.*?%%", re.DOTALL)
+_EMBED = re.compile(r"!\[\[[^\]]*\]\]")
+_WIKILINK = re.compile(r"\[\[([^\]|#]*)(?:#([^\]|]*))?(?:\|([^\]]*))?\]\]")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+class Section:
+    """
+    A heading of a note and the text under it, up to the next heading.
+    """
+
+    def __init__(self, headings, text, links, continued=False):
+        """
+        Initialize the section.
+
+        Args:
+            headings (list): Titles of the enclosing headings, outermost first, ending with the section's own.
+            text (str): The section text, heading line included unless the section continues a split one.
+            links (list): Targets of the wikilinks in the section.
+            continued (bool): Whether the section is a later part of a section split to fit the budget.
+        """
+        self.headings = headings
+        self.text = text
+        self.links = links
+        self.continued = continued
+        self.tokens = count_tokens(text)
+
+class NoteChunk:
+    """
+    Part of a note that fits the prompt budget, generated from as its own unit.
+    """
+
+    def __init__(self, note_path, index, count, text, tokens, headings, max_turns=None):
+        """
+        Initialize the chunk.
+
+        Args:
+            note_path (str): Path of the note.
+            index (int): Index of the chunk among the chunks of the note.
+            count (int): Number of chunks of the note.
+            text (str): The chunk text sent as the document.
+            tokens (int): Token count of the text.
+            headings (list): Heading titles leading to the start of the chunk.
+            max_turns (int, optional): Cap on the number of turns of conversations about the chunk.
+        """
+        self.note_path = note_path
+        self.index = index
+        self.count = count
+        self.text = text
+        self.tokens = tokens
+        self.headings = headings
+        self.max_turns = max_turns
+
+    def as_note(self):
+        """
+        Return the chunk in the note format used by generate_conversation().
+
+        Returns:
+            dict: The filename, the chunk text as content, and the turn cap.
+        """
+        return {"filename": os.path.basename(self.note_path), "content": self.text, "max_turns": self.max_turns}
+
+    def checkpoint_index(self, conversation_index):
+        """
+        Return the checkpoint index of one conversation about the chunk.
+
+        Args:
+            conversation_index (int): Index of the conversation among the chunk's conversations.
+
+        Returns:
+            str: The index, unique among the conversations of the note.
+        """
+        # Notes that fit in one chunk keep the checkpoint keys used before chunking
+        if self.count == 1:
+            return conversation_index
+        return f"{self.index}.{conversation_index}"
+
+    def __str__(self):
+        if self.count == 1:
+            return self.note_path
+        return f"{self.note_path} (chunk {self.index + 1}/{self.count})"
+
+def _clean_text(text):
+    # Obsidian comments and embeds are not part of the note's prose; links keep their displayed text
+    text = _COMMENT.sub("", text)
+    text = _EMBED.sub("", text)
+    text = _WIKILINK.sub(lambda match: match.group(3) or " > ".join(part for part in (match.group(1), match.group(2)) if part), text)
+    return _BLANK_LINES.sub("\n\n", text).strip()
+
+def parse_note(content):
+    """
+    Parse an Obsidian note into its frontmatter and sections.
+
+    Headings inside code blocks do not start a section. Comments (%%...%%) and
+    embeds (![[...]]) are dropped, and wikilinks are replaced by their alias, or
+    by their target when they have none.
+
+    Args:
+        content (str): The note text.
+
+    Returns:
+        tuple: The frontmatter (dict, empty if there is none) and the list of Section objects.
+    """
+    frontmatter = {}
+    match = _FRONTMATTER.match(content)
+    if match:
+        try:
+            frontmatter = yaml.safe_load(match.group(1)) or {}
+        except yaml.YAMLError:
+            frontmatter = {}
+        if not isinstance(frontmatter, dict):
+            frontmatter = {}
+        content = content[match.end():]
+
+    sections = []
+    trail = []
+    lines = []
+    in_fence = False
+
+    def flush():
+        raw = "\n".join(lines)
+        text = _clean_text(raw)
+        if text:
+            links = [link.group(1).strip() for link in _WIKILINK.finditer(_EMBED.sub("", raw)) if link.group(1).strip()]
+            sections.append(Section([title for _, title in trail], text, links))
+
+    for line in content.splitlines():
+        if _FENCE.match(line):
+            in_fence = not in_fence
+        heading = None if in_fence else _HEADING.match(line)
+        if heading:
+            flush()
+            lines = []
+            level = len(heading.group(1))
+            while trail and trail[-1][0] >= level:
+                trail.pop()
+            trail.append((level, _clean_text(heading.group(2))))
+        lines.append(line)
+    flush()
+    return frontmatter, sections
+
+def _split_text(text, budget):
+    # Split at paragraphs, then cut paragraphs that are still too long at about 'budget' tokens
+    parts = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        while count_tokens(paragraph) > budget:
+            cut = max(1, len(paragraph) * budget // count_tokens(paragraph))
+            space = paragraph.rfind(" ", 0, cut)
+            cut = space if space > 0 else cut
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        candidate = f"{current}\n\n{paragraph}" if current else paragraph
+        if current and count_tokens(candidate) > budget:
+            parts.append(current)
+            candidate = paragraph
+        current = candidate
+    if current:
+        parts.append(current)
+    return parts
+
+def split_sections(sections, budget):
+    """
+    Split sections longer than the budget into parts that fit it.
+
+    Args:
+        sections (list): Section objects.
+        budget (int): Maximum tokens per section.
+
+    Returns:
+        list: Section objects, each within the budget.
+    """
+    result = []
+    for section in sections:
+        if section.tokens <= budget:
+            result.append(section)
+            continue
+        for index, part in enumerate(_split_text(section.text, budget)):
+            result.append(Section(section.headings, part, section.links, continued=section.continued or index > 0))
+    return result
+
+def _chunk_text(sections, header):
+    first = sections[0]
+    # Show where the chunk starts in the note when it starts below the top level
+    context = first.headings if first.continued else first.headings[:-1]
+    parts = [header] if header else []
+    if context:
+        parts.append(f"Section: {' > '.join(context)}" + (" (continued)" if first.continued else ""))
+    parts.extend(section.text for section in sections)
+    return "\n\n".join(parts)
+
+def pack_sections(sections, budget, header=""):
+    """
+    Pack consecutive sections into chunk texts of at most 'budget' tokens.
+
+    Args:
+        sections (list): Section objects, each within the budget.
+        budget (int): Maximum tokens per chunk.
+        header (str): Line put at the top of every chunk, such as the note's tags.
+
+    Returns:
+        list: (text, tokens, headings) tuples, in note order.
+    """
+    chunks = []
+    current = []
+    current_tokens = count_tokens(header)
+    for section in sections:
+        if current and current_tokens + section.tokens > budget:
+            text = _chunk_text(current, header)
+            chunks.append((text, count_tokens(text), current[0].headings))
+            current = []
+            current_tokens = count_tokens(header)
+        current.append(section)
+        current_tokens += section.tokens
+    if current:
+        text = _chunk_text(current, header)
+        chunks.append((text, count_tokens(text), current[0].headings))
+    return chunks
+
+def _frontmatter_header(frontmatter):
+    values = []
+    for key in ('aliases', 'tags'):
+        value = frontmatter.get(key)
+        if isinstance(value, str):
+            value = [value]
+        if isinstance(value, list):
+            values += [str(item) for item in value if item]
+    return f"Tags: {', '.join(values)}" if values else ""
+
+def build_chunks(content, budget, max_chunks=None, min_tokens=0):
+    """
+    Parse a note and pack its sections into chunks within the prompt budget.
+
+    Args:
+        content (str): The note text.
+        budget (int): Maximum tokens per chunk.
+        max_chunks (int, optional): Keep at most this many chunks, the longest ones, in note order.
+        min_tokens (int): Notes with fewer tokens of text have no chunks.
+
+    Returns:
+        list: (text, tokens, headings) tuples.
+    """
+    frontmatter, sections = parse_note(content)
+    if sum(section.tokens for section in sections) < max(min_tokens, 1):
+        return []
+    header = _frontmatter_header(frontmatter)
+    # Leave room for the header and the section context line of each chunk
+    section_budget = max(budget - count_tokens(header) - 32, 32)
+    chunks = pack_sections(split_sections(sections, section_budget), budget, header)
+    if max_chunks and len(chunks) > max_chunks:
+        longest = sorted(range(len(chunks)), key=lambda index: chunks[index][1], reverse=True)[:max_chunks]
+        chunks = [chunks[index] for index in sorted(longest)]
+    return chunks
+
+class ChunkCache:
+    """
+    Parsed chunks of notes keyed by a hash of their content, least recently used evicted first.
+
+    Unchanged notes are parsed once per run however many times they are read,
+    and a note moved or copied within the vault reuses the chunks of its content.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, content, budget, max_chunks=None, min_tokens=0):
+        """
+        Return the chunks of a note, building them on a miss.
+
+        Args:
+            content (str): The note text.
+            budget (int): Maximum tokens per chunk.
+            max_chunks (int, optional): Keep at most this many chunks.
+            min_tokens (int): Notes with fewer tokens of text have no chunks.
+
+        Returns:
+            list: (text, tokens, headings) tuples.
+        """
+        key = (hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest(), budget, max_chunks, min_tokens)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        chunks = build_chunks(content, budget, max_chunks, min_tokens)
+        with self._lock:
+            self._entries[key] = chunks
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return chunks
+
+# Shared by every worker thread of the process
+chunk_cache = ChunkCache()
+
+def chunk_note(note_path, content, config):
+    """
+    Split a note into the chunks generated from, as configured in the 'chunking' section of the config.
+
+    With chunking disabled, the whole note is one chunk.
+
+    Args:
+        note_path (str): Path of the note.
+        content (str): The note text.
+        config (dict): Configuration settings.
+
+    Returns:
+        list: NoteChunk objects, empty for a note with too little text to generate from.
+    """
+    chunking = config.get('chunking') or {}
+    if not chunking.get('enabled', False):
+        return [NoteChunk(note_path, 0, 1, content, count_tokens(content), [])]
+
+    chunks = chunk_cache.get_or_build(
+        content,
+        chunking.get('max_prompt_tokens', 3000),
+        chunking.get('max_chunks_per_note'),
+        chunking.get('min_note_tokens', 0),
+    )
+    tokens_per_turn = chunking.get('tokens_per_turn')
+    return [
+        NoteChunk(note_path, index, len(chunks), text, tokens, headings, max(2, tokens // tokens_per_turn) if tokens_per_turn else None)
+        for index, (text, tokens, headings) in enumerate(chunks)
+    ]
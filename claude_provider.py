@@ -0,0 +1,78 @@
+# claude_provider.py
+
+import os
+import anthropic
+from providers import AsyncProvider, StreamOptions, consume_stream, pool_settings, prompt_cache_settings, record_prompt_cache
+from metrics import record_usage
+
+class ClaudeProvider(AsyncProvider):
+    """
+    Provider for Anthropic's Messages API using one long-lived AsyncAnthropic client.
+    """
+
+    name = "claude"
+
+    def __init__(self, api_key=None):
+        """
+        Initialize the provider.
+
+        Args:
+            api_key (str, optional): The Anthropic API key. Defaults to CLAUDE_API_KEY from the environment.
+        """
+        self.api_key = api_key or os.getenv('CLAUDE_API_KEY')
+        self._client = None
+
+    async def generate(self, messages, model_id, temperature, max_tokens, system_prompt=None):
+        if self._client is None:
+            self._client = anthropic.AsyncAnthropic(api_key=self.api_key, timeout=pool_settings["timeout"])
+        kwargs = self._system_kwargs(system_prompt)
+        response = await self._client.messages.create(
+            model=model_id,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **kwargs
+        )
+        self._record_usage(response)
+        return response.content[0].text
+
+    async def generate_stream(self, messages, model_id, temperature, max_tokens, system_prompt=None, stream_options=None):
+        if self._client is None:
+            self._client = anthropic.AsyncAnthropic(api_key=self.api_key, timeout=pool_settings["timeout"])
+        kwargs = self._system_kwargs(system_prompt)
+
+        async def deltas():
+            async with self._client.messages.stream(
+                model=model_id,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **kwargs
+            ) as stream:
+                async for text in stream.text_stream:
+                    yield text
+                self._record_usage(await stream.get_final_message())
+
+        return await consume_stream(deltas(), stream_options or StreamOptions())
+
+    def _system_kwargs(self, system_prompt):
+        if not system_prompt:
+            return {}
+        system_block = {"type": "text", "text": system_prompt}
+        if prompt_cache_settings["enabled"]:
+            # Mark the static system prompt as a cacheable prefix
+            system_block["cache_control"] = {"type": "ephemeral"}
+        return {"system": [system_block]}
+
+    def _record_usage(self, response):
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            cache_read_tokens = getattr(usage, 'cache_read_input_tokens', 0) or 0
+            cache_write_tokens = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+            record_prompt_cache(cache_read_tokens, cache_write_tokens)
+            record_usage(usage.input_tokens + cache_read_tokens + cache_write_tokens, usage.output_tokens)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
@@ -1,18 +1,23 @@
 # conversation.py
 
 import os
-import json
 import random
+import re
+import threading
+import time
 import uuid
-from api_clients import (
-    generate_response_openai,
-    generate_response_claude,
-    generate_response_groq,
-    generate_response_gemini,
-    generate_response_local
-)
-from google.api_core import exceptions
-import google.generativeai as genai
+from api_clients import generate_provider_response
+from budget import budget_governor
+from credentials import CredentialsExhausted
+from output_sinks import TurnBuffer, export_jsonl_to_json
+from scheduler import provider_limiter
+from history import ConversationHistory, count_tokens, count_static_tokens
+from metrics import track_request
+from stats import run_stats
+from response_cache import get_response_cache
+from router import active_router
+from providers import StreamOptions
+from quality import create_quality_monitor
 from dotenv import load_dotenv
 
 # Load environment variables from a .env file
@@ -26,10 +31,109 @@ gemini_api_key = os.getenv('GEMINI_API_KEY')
 local_api_url = os.getenv('LOCAL_API_URL')
 local_api_model = os.getenv('LOCAL_API_MODEL')
 
-def generate_response(role, message, response_type=None, model_conversation_history=None, config=None, use_openai=False, use_claude=False, use_groq=False, use_gemini=False, use_local=False, gemini_model=None):
+# Reply format of a fused turn, used when the config's system prompts have no 'fused_turn_instructions'
+DEFAULT_FUSED_TURN_INSTRUCTIONS = """# FUSED TURN
+Play both parts of the turn in one reply. First fill in the CoR template for the latest message of the Conversation History, then reply to Joseph as Professor Synapse, following that CoR.
+Reply in exactly this format and nothing else:
+<cor>
+{the filled-in CoR template}
+</cor>
+<professor>
+🧙🏿‍♂️: {your reply to Joseph}
+</professor>"""
+
+_FUSED_COR = re.compile(r"<cor>(.*?)</cor>", re.DOTALL | re.IGNORECASE)
+_FUSED_PROFESSOR = re.compile(r"<professor>(.*?)(?:</professor>|\Z)", re.DOTALL | re.IGNORECASE)
+
+class CoRTemplateCompletion:
+    """
+    Stop condition that detects the end of a filled-in Chain of Reasoning template.
+
+    The CoR template is a single JSON object. Braces are counted as text arrives,
+    skipping those inside JSON strings, and the response is complete as soon as
+    the outermost object closes, so whatever the model would add after it is
+    never generated.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, delta):
+        """
+        Consume the next piece of the response.
+
+        Args:
+            delta (str): The text received since the last call.
+
+        Returns:
+            bool: True once the template's JSON object is closed.
+        """
+        for char in delta:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == "{":
+                self.depth += 1
+                self.started = True
+            elif not self.started:
+                continue
+            elif char == '"':
+                self.in_string = True
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
+
+    def finish(self, response):
+        """
+        Close a code fence left open when the response was cut off after the template.
+
+        Args:
+            response (str): The streamed response.
+
+        Returns:
+            str: The response with balanced code fences.
+        """
+        if response.count("```") % 2:
+            return response + "\n```"
+        return response
+
+def build_stream_options(config, response_type, on_delta=None):
+    """
+    Build the streaming options for a response from the 'streaming' section of the config.
+
+    Args:
+        config (dict): Configuration settings.
+        response_type (str): The type of response to generate.
+        on_delta (callable, optional): Called with each piece of text as it arrives.
+
+    Returns:
+        StreamOptions: The options, or None when streaming is disabled.
+    """
+    streaming_config = config.get('streaming') or {}
+    if not streaming_config.get('enabled'):
+        return None
+    stop_condition = None
+    if response_type == "cor" and streaming_config.get('stop_on_complete_cor', True):
+        stop_condition = CoRTemplateCompletion()
+    max_chars = streaming_config.get('max_chars') or {}
+    return StreamOptions(response_type, on_delta, stop_condition, max_chars.get(response_type, max_chars.get('default')))
+
+def generate_response(role, message, response_type=None, model_conversation_history=None, config=None, use_openai=False, use_claude=False, use_groq=False, use_gemini=False, use_local=False, gemini_model=None, system_prompt=None, on_delta=None, cache_scope=None):
     """
     Generate a response using the selected AI model.
 
+    Without a provider flag, the request is routed through the router set up
+    with configure_router(), failing over to the next backend when one fails.
+
     Args:
         role (str): The role of the responder (e.g., user, assistant).
         message (str): The message to generate a response for.
@@ -41,259 +145,842 @@ def generate_response(role, message, response_type=None, model_conversation_hist
         use_groq (bool): Flag to use Groq.
         use_gemini (bool): Flag to use Gemini.
         use_local (bool): Flag to use local model.
-        gemini_model (GenerativeModel, optional): The Gemini model object.
+        gemini_model (GenerativeModel, optional): The Gemini model object. Defaults to the model ID in the config.
+        system_prompt (str, optional): Static system prompt sent ahead of the conversation.
+        on_delta (callable, optional): Called with each piece of a streamed response as it arrives.
+        cache_scope (str, optional): Scope of the request in the response cache, see ResponseCache.make_key().
 
     Returns:
         str: The generated response.
+
+    Raises:
+        CredentialsExhausted: If the API keys of every backend ran out, or the budget is spent.
+    """
+    max_tokens, temperature = generation_settings(config, role, response_type)
+    router = active_router(config, use_openai, use_claude, use_groq, use_gemini, use_local)
+    # Past the soft limit of the budget, requests may go to a cheaper model instead
+    backends = budget_governor.backends(router.order(response_type or role))
+
+    response_cache = get_response_cache(config)
+    cache_keys, cached_response = lookup_response_cache(config, backends, role, message, model_conversation_history, system_prompt, max_tokens, temperature, cache_scope)
+    if cached_response is not None:
+        return cached_response
+    if cache_keys is not None and response_cache.mode == "replay":
+        print(f"No cached response for {role} ({response_type}) in replay mode.")
+        return None
+
+    budget_governor.check()
+    response = None
+    exhausted = []
+    for index, backend in enumerate(backends):
+        if index:
+            run_stats.add('failovers')
+            print(f"Failing over to {backend} for {role} ({response_type}).")
+        start = time.perf_counter()
+        try:
+            response = generate_backend_response(backend, role, message, response_type, model_conversation_history, config, max_tokens, temperature, gemini_model, system_prompt, on_delta)
+        except CredentialsExhausted as e:
+            # The next backend may still have keys left
+            print(str(e))
+            exhausted.append(e)
+            response = None
+        router.record(backend, response_type or role, time.perf_counter() - start, response is not None)
+        if response is not None:
+            if cache_keys is not None:
+                response_cache.put(cache_keys[index], response)
+            return response
+    if len(exhausted) == len(backends):
+        raise exhausted[-1]
+    if all(backend.provider == "gemini" for backend in backends):
+        raise CredentialsExhausted("All Gemini API keys have been exhausted. Please try again later.")
+    return None
+
+def generate_backend_response(backend, role, message, response_type, model_conversation_history, config, max_tokens, temperature, gemini_model=None, system_prompt=None, on_delta=None):
+    """
+    Generate a response with one backend.
+
+    Args:
+        backend (Backend): The provider and model to generate with.
+        role (str): The role of the responder (e.g., user, assistant).
+        message (str): The message to generate a response for.
+        response_type (str): The type of response to generate.
+        model_conversation_history (list): The history of the conversation for the model.
+        config (dict): Configuration settings.
+        max_tokens (int): Maximum number of tokens to generate.
+        temperature (float): Sampling temperature.
+        gemini_model (GenerativeModel, optional): The Gemini model object. Defaults to the backend's model ID.
+        system_prompt (str, optional): Static system prompt sent ahead of the conversation.
+        on_delta (callable, optional): Called with each piece of a streamed response as it arrives.
+
+    Returns:
+        str: The generated response, or None if generation failed.
+    """
+    provider = backend.provider
+    # Gemini responses are not streamed
+    stream_options = None if provider == "gemini" else build_stream_options(config, response_type or role, on_delta)
+    if provider == "gemini":
+        print(f"Attempting to generate response with Gemini API.")
+
+    with track_request(provider, backend.model_id, response_type or role) as request_metrics:
+        with provider_limiter.slot(provider):
+            response = generate_provider_response(
+                provider,
+                gemini_model if provider == "gemini" and gemini_model is not None else backend.model_id,
+                model_conversation_history,
+                role,
+                message,
+                config,
+                temperature,
+                max_tokens,
+                response_type,
+                system_prompt,
+                stream_options,
+            )
+        request_metrics.response = response
+    budget_governor.record(provider, backend.model_id, request_metrics.prompt_tokens, request_metrics.completion_tokens)
+
+    if response is not None and stream_options is not None and stream_options.stop_condition is not None:
+        response = stream_options.stop_condition.finish(response)
+    return response
+
+def generation_settings(config, role, response_type=None):
+    """
+    Return the generation parameters of a response.
+
+    Args:
+        config (dict): Configuration settings.
+        role (str): The role of the responder (e.g., user, assistant).
+        response_type (str, optional): The type of response to generate.
+
+    Returns:
+        tuple: The maximum number of tokens and the sampling temperature.
     """
     if not isinstance(config['generation_parameters']['max_tokens'], dict):
         raise ValueError("config['generation_parameters']['max_tokens'] should be a dictionary")
 
     max_tokens = config['generation_parameters']['max_tokens'].get(response_type or role, config['generation_parameters']['max_tokens']['default'])
+    return budget_governor.max_tokens(max_tokens), config['generation_parameters']['temperature']
 
-    if use_openai:
-        return generate_response_openai(model_conversation_history, role, message, config['openai_details']['model_id'], config['generation_parameters']['temperature'], max_tokens)
-    elif use_claude:
-        return generate_response_claude(model_conversation_history, role, message, config['claude_details']['model_id'], config['generation_parameters']['temperature'], max_tokens)
-    elif use_groq:
-        return generate_response_groq(model_conversation_history, role, message, config['groq_details']['model_id'], config['generation_parameters']['temperature'], max_tokens)
-    elif use_gemini:
-        print(f"Attempting to generate response with Gemini API.")
-        response = generate_response_gemini(message, gemini_model)
-        if response is None:
-            raise exceptions.ResourceExhausted("All Gemini API keys have been exhausted. Please try again later.")
-        return response
-    elif use_local:
-        return generate_response_local(model_conversation_history, role, message, config, max_tokens, response_type)
-    else:
-        raise ValueError("No valid AI model selected for response generation.")
+def lookup_response_cache(config, backends, role, message, model_conversation_history, system_prompt, max_tokens, temperature, cache_scope=None):
+    """
+    Look up a request in the response cache.
 
-def append_conversation_to_json(conversation, output_file, conversation_id):
+    A response generated by any of the backends the request may be routed to is reused.
+
+    Args:
+        config (dict): Configuration settings.
+        backends (list): Backend objects the request may be sent to.
+        role (str): The role of the responder (e.g., user, assistant).
+        message (str): The message to generate a response for.
+        model_conversation_history (list): Chat messages sent ahead of the message.
+        system_prompt (str): Static system prompt sent ahead of the conversation.
+        max_tokens (int): Maximum number of tokens to generate.
+        temperature (float): Sampling temperature.
+        cache_scope (str, optional): Scope of the request, see ResponseCache.make_key().
+
+    Returns:
+        tuple: The cache key of each backend (None when caching is off) and the cached response (None on a miss or in record mode).
     """
-    Append a conversation entry to a JSON file.
+    response_cache = get_response_cache(config)
+    if response_cache is None:
+        return None, None
+    messages = ([{"role": "system", "content": system_prompt}] if system_prompt else []) + list(model_conversation_history or []) + [{"role": role, "content": message}]
+    seed = config['generation_parameters'].get('seed')
+    cache_keys = [response_cache.make_key(backend.provider, backend.model_id, temperature, max_tokens, messages, seed, cache_scope) for backend in backends]
+    if response_cache.mode == "record":
+        return cache_keys, None
+    for cache_key in cache_keys:
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            run_stats.add('response_cache_hits')
+            return cache_keys, cached_response
+    run_stats.add('response_cache_misses')
+    return cache_keys, None
+
+def append_conversation_to_json(conversation, output_sink, conversation_id):
+    """
+    Append a conversation entry to the output sink.
 
     Args:
         conversation (dict): The conversation entry to append.
-        output_file (str): Path to the output JSON file.
+        output_sink (OutputSink): The sink receiving message records.
         conversation_id (str): The ID of the conversation.
     """
-    if not os.path.exists(output_file):
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump([], f)
+    output_sink.write(conversation)
 
-    with open(output_file, 'r', encoding='utf-8') as f:
-        try:
-            conversations = json.load(f)
-        except json.JSONDecodeError:
-            conversations = []
+class GenerationRequest:
+    """
+    A model request made by a conversation step.
 
-    conversations.append(conversation)
+    Step generators yield requests and receive the generated responses, so the
+    same conversation logic can be driven one request at a time or batched
+    with the requests of other conversations.
+    """
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(conversations, f, indent=4)
+    def __init__(self, role, prompt, response_type=None, system_prompt=None, history=None, on_delta=None, share_key=None, cache_scope=None):
+        """
+        Initialize the request.
+
+        Args:
+            role (str): The role of the responder (e.g., user, assistant).
+            prompt (str): The prompt for generating the response.
+            response_type (str, optional): The type of response to generate.
+            system_prompt (str, optional): Static system prompt sent ahead of the prompt.
+            history (list, optional): Chat messages sent ahead of the prompt.
+            on_delta (callable, optional): Called with each piece of a streamed response as it arrives.
+            share_key (object, optional): Requests of one batch with the same share key are generated once, and each gets the response.
+            cache_scope (str, optional): Scope of the request in the response cache, usually its conversation's checkpoint key,
+                so the conversations of a note do not turn into copies of each other by sharing cached responses.
+        """
+        self.role = role
+        self.prompt = prompt
+        self.response_type = response_type
+        self.system_prompt = system_prompt
+        self.history = history if history is not None else []
+        self.on_delta = on_delta
+        self.share_key = share_key
+        self.cache_scope = cache_scope
+
+class SharedOpening:
+    """
+    The opening user problem shared by the variants of a conversation.
 
-def generate_and_append_response(role, prompt, model_conversation_history, user_conversation_history, output_file, conversation_id, turn, response_type, name, last_role, config, use_openai, use_claude, use_groq, use_gemini, use_local, gemini_model):
+    The first variant to generate it publishes it here, and the others fork
+    from it instead of sending the document prompt again, so all of them
+    continue from the same prefix. In a batch, variants requesting the opening
+    together share a single request through the share key.
     """
-    Generate a response and append it to the conversation history.
+
+    def __init__(self):
+        self.response = None
+        self._ready = threading.Event()
+
+    def set(self, response):
+        """
+        Publish the opening, unless one was already published.
+
+        Args:
+            response (str): The generated user problem.
+        """
+        if self.response is None and response:
+            self.response = response
+        self._ready.set()
+
+    def release(self):
+        """
+        Wake the variants waiting for the opening, even if none was generated.
+        """
+        self._ready.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the opening is published or the variant generating it has ended.
+
+        Args:
+            timeout (float, optional): Seconds to wait at most.
+
+        Returns:
+            bool: True unless the wait timed out.
+        """
+        return self._ready.wait(timeout)
+
+def run_steps(steps, config, use_openai, use_claude, use_groq, use_gemini, use_local, gemini_model=None):
+    """
+    Drive a step generator, generating each of its requests in turn.
+
+    Args:
+        steps (generator): Generator yielding GenerationRequest objects and receiving their responses.
+        config (dict): Configuration settings.
+        use_openai (bool): Flag to use OpenAI.
+        use_claude (bool): Flag to use Claude.
+        use_groq (bool): Flag to use Groq.
+        use_gemini (bool): Flag to use Gemini.
+        use_local (bool): Flag to use local model.
+        gemini_model (GenerativeModel, optional): The Gemini model object.
+
+    Returns:
+        The value returned by the generator.
+    """
+    response = None
+    try:
+        while True:
+            request = steps.send(response)
+            response = generate_response(request.role, request.prompt, request.response_type, request.history, config, use_openai, use_claude, use_groq, use_gemini, use_local, gemini_model, request.system_prompt, request.on_delta, request.cache_scope)
+    except StopIteration as stop:
+        return stop.value
+    finally:
+        # Runs the generator's cleanup right away if generation raised
+        steps.close()
+
+def append_message(role, name, content, model_conversation_history, user_conversation_history, output_sink, conversation_id, turn):
+    """
+    Append a message to the conversation histories and write its record to the sink.
+
+    The user's history only holds the user's messages and the Professor's
+    replies, and shares the message objects of the model's history.
+
+    Args:
+        role (str): The role of the message (e.g., user, assistant).
+        name (str): The name of the speaker.
+        content (str): The message text.
+        model_conversation_history (ConversationHistory): The history of the conversation for the model.
+        user_conversation_history (ConversationHistory): The history of the user's conversation.
+        output_sink (OutputSink): The sink receiving message records.
+        conversation_id (str): The conversation ID.
+        turn (int): The turn number in the conversation.
+    """
+    message = {"role": role, "content": content, "name": name}
+    model_conversation_history.append(message)
+
+    if role == "user" or name == "Professor":
+        user_conversation_history.append(message)
+
+    append_conversation_to_json({"role": role, "name": name, "content": content, "conversation_id": conversation_id, "turn": turn, "token_count": count_tokens(content)}, output_sink, conversation_id)
+
+def generate_and_append_step(role, prompt, model_conversation_history, user_conversation_history, output_sink, conversation_id, turn, response_type, name, last_role, config, use_claude, rng=random, system_prompt=None, share_key=None, quality=None, cache_scope=None):
+    """
+    Generate a response and append it to the conversation history, as a step generator.
+
+    With a quality monitor, a rejected response is not appended. Depending on
+    the quality gate's action, the response is generated again with the reason
+    it was rejected added to the prompt, or the conversation is cut short.
 
     Args:
         role (str): The role of the responder (e.g., user, assistant).
         prompt (str): The prompt for generating the response.
-        model_conversation_history (list): The history of the conversation for the model.
-        user_conversation_history (list): The history of the user's conversation.
-        output_file (str): The output file path.
+        model_conversation_history (ConversationHistory): The history of the conversation for the model.
+        user_conversation_history (ConversationHistory): The history of the user's conversation.
+        output_sink (OutputSink): The sink receiving message records.
         conversation_id (str): The conversation ID.
         turn (int): The turn number in the conversation.
         response_type (str): The type of response to generate.
         name (str): The name of the responder.
         last_role (str): The role of the last message in the conversation.
         config (dict): Configuration settings.
-        use_openai (bool): Flag to use OpenAI.
         use_claude (bool): Flag to use Claude.
-        use_groq (bool): Flag to use Groq.
-        use_gemini (bool): Flag to use Gemini.
-        use_local (bool): Flag to use local model.
-        gemini_model (GenerativeModel, optional): The Gemini model object.
+        rng (random.Random, optional): Random generator for the conversation.
+        system_prompt (str, optional): Static system prompt sent ahead of the prompt.
+        share_key (object, optional): Share key of the request, see GenerationRequest.
+        quality (QualityMonitor, optional): Monitor validating the response before it is appended.
+        cache_scope (str, optional): Scope of the conversation's requests in the response cache, see GenerationRequest.
+
+    Yields:
+        GenerationRequest: Each request to generate; the response is sent back in.
 
     Returns:
-        tuple: The generated response and the new last_role.
+        tuple: The generated response and the new last_role. The response is None if generation
+            failed or the quality gate cut the conversation.
     """
     print(f"Conversation ID: {conversation_id}, Turn: {turn}, Role: {role}")
-    print(random.choice(config['synapse_thoughts']))
+    print(rng.choice(config['synapse_thoughts']))
 
     # Ensure alternating roles for Claude API
     if use_claude and role == last_role:
         # If the roles would be the same, insert a user message
         interim_prompt = f"Based on the last response, what would be a good follow-up question or comment?"
-        interim_response = generate_response("user", interim_prompt, model_conversation_history=model_conversation_history, config=config, use_claude=use_claude)
-        model_conversation_history.append({"role": "user", "content": interim_response, "name": "System"})
-        user_conversation_history.append({"role": "user", "content": interim_response, "name": "System"})
-        append_conversation_to_json({"role": "user", "name": "System", "content": interim_response, "conversation_id": conversation_id, "turn": turn, "token_count": len(interim_response)}, output_file, conversation_id)
+        interim_response = yield GenerationRequest("user", interim_prompt, history=model_conversation_history.messages, cache_scope=cache_scope)
+        if interim_response is None:
+            print("Failed to generate interim user message.")
+            return None, last_role
+        append_message("user", "System", interim_response, model_conversation_history, user_conversation_history, output_sink, conversation_id, turn)
         last_role = "user"
 
-    response = generate_response(role, prompt, response_type, model_conversation_history, config, use_openai, use_claude, use_groq, use_gemini, use_local, gemini_model)
-    if response is None:
-        print(f"Failed to generate {role} response.")
-        return None, last_role
+    def write_partial(delta):
+        output_sink.write_partial({"conversation_id": conversation_id, "turn": turn, "name": name, "delta": delta})
 
+    # The prompt already carries the rendered history, so it is not sent again as chat messages
+    request_prompt = prompt
+    # A shared opening is meant to be the same for every variant, so it is cached for the note rather than the conversation
+    request_scope = cache_scope if share_key is None else None
+    retries = 0
+    while True:
+        response = yield GenerationRequest(role, request_prompt, response_type, system_prompt, on_delta=write_partial, share_key=share_key, cache_scope=request_scope)
+        if response is None:
+            print(f"Failed to generate {role} response.")
+            return None, last_role
+        rejection = quality.check(response, response_type, name) if quality is not None else None
+        if rejection is None or quality.action == "log":
+            break
+        if quality.action == "cut" or retries >= quality.max_retries:
+            print(f"Cutting conversation {conversation_id} short at turn {turn}.")
+            run_stats.add('quality_cut_conversations')
+            return None, last_role
+        retries += 1
+        run_stats.add('quality_retries')
+        # A retry is a request of its own, with a prompt that is not served from the response cache
+        share_key = None
+        request_prompt = f"{prompt}\n\n(Your previous reply was rejected: {rejection}. Write a different reply.)"
+
+    if quality is not None:
+        quality.accept(response, name)
     if name == "Professor":
         response = f"🧙🏿‍♂️: {response}"
 
-    model_conversation_history.append({"role": role, "content": response, "name": name})
-    
-    if role == "user" or name == "Professor":
-        user_conversation_history.append({"role": role, "content": response, "name": name})
-    
-    append_conversation_to_json({"role": role, "name": name, "content": response, "conversation_id": conversation_id, "turn": turn, "token_count": len(response)}, output_file, conversation_id)
-    
+    append_message(role, name, response, model_conversation_history, user_conversation_history, output_sink, conversation_id, turn)
     return response, role
 
-def generate_conversation(note, output_file, config, use_openai, use_claude, use_groq, use_gemini, use_local):
+def generate_and_append_response(role, prompt, model_conversation_history, user_conversation_history, output_sink, conversation_id, turn, response_type, name, last_role, config, use_openai, use_claude, use_groq, use_gemini, use_local, gemini_model, rng=random, system_prompt=None):
+    """
+    Generate a response and append it to the conversation history.
+
+    Args:
+        role (str): The role of the responder (e.g., user, assistant).
+        prompt (str): The prompt for generating the response.
+        model_conversation_history (ConversationHistory): The history of the conversation for the model.
+        user_conversation_history (ConversationHistory): The history of the user's conversation.
+        output_sink (OutputSink): The sink receiving message records.
+        conversation_id (str): The conversation ID.
+        turn (int): The turn number in the conversation.
+        response_type (str): The type of response to generate.
+        name (str): The name of the responder.
+        last_role (str): The role of the last message in the conversation.
+        config (dict): Configuration settings.
+        use_openai (bool): Flag to use OpenAI.
+        use_claude (bool): Flag to use Claude.
+        use_groq (bool): Flag to use Groq.
+        use_gemini (bool): Flag to use Gemini.
+        use_local (bool): Flag to use local model.
+        gemini_model (GenerativeModel, optional): The Gemini model object.
+        rng (random.Random, optional): Random generator for the conversation.
+        system_prompt (str, optional): Static system prompt sent ahead of the prompt.
+
+    Returns:
+        tuple: The generated response and the new last_role.
+    """
+    steps = generate_and_append_step(role, prompt, model_conversation_history, user_conversation_history, output_sink, conversation_id, turn, response_type, name, last_role, config, use_claude, rng, system_prompt, cache_scope=conversation_id)
+    return run_steps(steps, config, use_openai, use_claude, use_groq, use_gemini, use_local, gemini_model)
+
+def generate_conversation(note, output_sink, config, use_openai=False, use_claude=False, use_groq=False, use_gemini=False, use_local=False, rng=None, checkpoint=None, shared_opening=None):
     """
     Generate a synthetic conversation based on a user's note.
 
+    Without a provider flag, requests are routed through the router set up with configure_router().
+
     Args:
-        note (dict): Note content to base the conversation on.
-        output_file (str): Path to the output file for saving the conversation.
+        note (dict): Note content to base the conversation on: its filename, content and optional max_turns cap.
+        output_sink (OutputSink): The sink receiving message records.
         config (dict): Configuration settings.
         use_openai (bool): Flag to use OpenAI.
         use_claude (bool): Flag to use Claude.
         use_groq (bool): Flag to use Groq.
         use_gemini (bool): Flag to use Gemini.
         use_local (bool): Flag to use local model.
+        rng (random.Random, optional): Random generator for the conversation. A seeded generator makes the conversation ID, turn count and thoughts reproducible.
+        checkpoint (ConversationCheckpoint, optional): Checkpoint saved after every turn. If it holds a saved state, the conversation resumes after the last completed turn.
+        shared_opening (SharedOpening, optional): Opening shared with the other variants of the conversation.
 
     Returns:
         list: The generated conversation history.
     """
-    model_conversation_history = []
-    user_conversation_history = []
-    conversation_id = str(uuid.uuid4())
-    last_role = "system"  # Initialize with system to ensure the first message is from the user
+    # Claude needs alternating roles whenever it may receive the request
+    alternate_roles = active_router(config, use_openai, use_claude, use_groq, use_gemini, use_local).uses("claude")
+    steps = generate_conversation_steps(note, output_sink, config, alternate_roles, rng, checkpoint, shared_opening)
+    return run_steps(steps, config, use_openai, use_claude, use_groq, use_gemini, use_local)
 
-    gemini_model = None
-    if use_gemini:
-        gemini_model = genai.GenerativeModel(config['gemini_details']['model_id'])
-
-    # Initial user problem generation with document access
-    print(f"Generating user problem for note: {note['filename']}")
-    user_problem, last_role = generate_and_append_response(
-        "user",
-        f"{config['system_prompts']['user_system_prompt']}\n\nDocument:\n{note['content']}\n\n**You are now Joseph!**, and are about to begin your conversation with Prof. Come up with the problem you face based on the provided text, and respond in the first person as Joseph:**",
-        model_conversation_history,
-        user_conversation_history,
-        output_file,
-        conversation_id,
-        0,
-        response_type="user",
-        name="Joseph",
-        last_role=last_role,
-        config=config,
-        use_openai=use_openai,
-        use_claude=use_claude,
-        use_groq=use_groq,
-        use_gemini=use_gemini,
-        use_local=use_local,
-        gemini_model=gemini_model
-    )
-    
-    if user_problem is None or not user_problem.strip():
-        print("Failed to generate user problem or user problem is empty.")
+def generate_conversation_steps(note, output_sink, config, use_claude=False, rng=None, checkpoint=None, shared_opening=None):
+    """
+    Generate a synthetic conversation based on a user's note, as a step generator.
+
+    Args:
+        note (dict): Note content to base the conversation on: its filename, content and optional max_turns cap.
+        output_sink (OutputSink): The sink receiving message records.
+        config (dict): Configuration settings.
+        use_claude (bool): Flag to use Claude.
+        rng (random.Random, optional): Random generator for the conversation. A seeded generator makes the conversation ID, turn count and thoughts reproducible.
+        checkpoint (ConversationCheckpoint, optional): Checkpoint saved after every turn. If it holds a saved state, the conversation resumes after the last completed turn.
+        shared_opening (SharedOpening, optional): Opening shared with the other variants of the conversation. A published
+            opening is used instead of generating one; otherwise the opening generated here is published.
+
+    Yields:
+        GenerationRequest: Each request to generate; the response is sent back in.
+
+    Returns:
+        list: The generated conversation history.
+    """
+    if rng is None:
+        rng = random.Random()
+
+    checkpoint_state = checkpoint.load() if checkpoint is not None else None
+    if checkpoint_state is not None and checkpoint_state.get('completed'):
+        print(f"Conversation already completed for note: {note['filename']}")
+        if shared_opening is not None:
+            shared_opening.release()
+        return checkpoint_state['model_conversation_history']
+
+    if checkpoint_state is not None:
+        conversation_id = checkpoint_state['conversation_id']
+    else:
+        conversation_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    if checkpoint is not None:
+        # The checkpoint key names the note, chunk and conversation, so it is the same in every run
+        cache_scope = checkpoint.key
+    else:
+        # The conversation ID only repeats across runs with a seeded generator
+        get_response_cache(config, stable_scope=config.get('concurrency', {}).get('deterministic', False))
+        cache_scope = conversation_id
+    if checkpoint is not None:
+        # A resumed conversation repeats the turn it stopped in, so only saved turns reach the output
+        output_sink = TurnBuffer(output_sink)
+    try:
+        conversation = yield from run_conversation_steps(note, output_sink, conversation_id, config, use_claude, rng, checkpoint, checkpoint_state, shared_opening, cache_scope)
+        if checkpoint is not None:
+            # The turn a conversation was cut short in is not generated again
+            output_sink.commit()
+            if conversation:
+                checkpoint.complete(conversation)
+            else:
+                checkpoint.clear()
+        return conversation
+    finally:
+        if shared_opening is not None:
+            # Variants waiting for an opening that was never generated start their own
+            shared_opening.release()
+        # Flush the finished (or aborted) conversation to disk before moving on
+        output_sink.end_conversation(conversation_id)
+        run_stats.add('conversations')
+
+def record_prompt_tokens(system_prompt, prompt, history_text, embedded_history, model_conversation_history):
+    """
+    Record the prompt tokens of a request, and what the request would have cost
+    with the full history embedded as a repr() and re-sent as chat messages.
+
+    Args:
+        system_prompt (str): The static system prompt sent with the request.
+        prompt (str): The prompt sent to the model.
+        history_text (str): The rendered history embedded in the prompt.
+        embedded_history (ConversationHistory): The history rendered into the prompt.
+        model_conversation_history (ConversationHistory): The history previously re-sent as chat messages.
+    """
+    prompt_tokens = count_static_tokens(system_prompt) + count_tokens(prompt)
+    run_stats.add('prompt_tokens', prompt_tokens)
+    run_stats.add('prompt_tokens_baseline', prompt_tokens - count_tokens(history_text) + embedded_history.repr_tokens + model_conversation_history.full_tokens)
+
+def fused_system_prompt(config):
+    """
+    Build the system prompt of a fused turn: the CoR and Professor Synapse prompts followed by the reply format.
+
+    Args:
+        config (dict): Configuration settings.
+
+    Returns:
+        str: The system prompt, the same for every request of a run so it stays cacheable.
+    """
+    system_prompts = config['system_prompts']
+    return "\n\n".join([
+        system_prompts['cor_system_prompt'].strip(),
+        system_prompts['synapse_system_prompt'].strip(),
+        system_prompts.get('fused_turn_instructions', DEFAULT_FUSED_TURN_INSTRUCTIONS).strip(),
+    ])
+
+def parse_fused_response(response):
+    """
+    Split a fused turn response into the CoR and the Professor's reply.
+
+    Args:
+        response (str): The generated response.
+
+    Returns:
+        tuple: The CoR and the reply (without its 🧙🏿‍♂️ prefix), or None if the response does not follow the format.
+    """
+    cor_match = _FUSED_COR.search(response)
+    if cor_match is None:
+        return None
+    professor_match = _FUSED_PROFESSOR.search(response, cor_match.end())
+    if professor_match is None:
+        return None
+    cor = cor_match.group(1).strip()
+    professor = professor_match.group(1).strip()
+    if professor.startswith("🧙🏿‍♂️:"):
+        professor = professor[len("🧙🏿‍♂️:"):].strip()
+    # The CoR must hold the whole template, and the reply must not be cut off before it starts
+    if not CoRTemplateCompletion().feed(cor) or not professor:
         return None
+    return cor, professor
 
-    num_turns = random.randint(6, 10)  # Randomly choose the number of turns between 6 and 10
+def generate_fused_turn_step(model_conversation_history, user_conversation_history, output_sink, conversation_id, turn, config, rng, quality=None, cache_scope=None):
+    """
+    Generate the CoR and the Professor's reply of a turn with a single request, as a step generator.
 
-    for turn in range(1, num_turns + 1):
-        print(f"Generating CoR response for turn {turn}")
-        cor_prompt = f"{config['system_prompts']['cor_system_prompt']}\n\nConversation History:\n{model_conversation_history}\n\nFilled-in CoR:"
-        cor_response, last_role = generate_and_append_response(
-            "assistant",
-            cor_prompt,
-            model_conversation_history,
-            user_conversation_history,
-            output_file,
-            conversation_id,
-            turn,
-            response_type="cor",
-            name="CoR",
-            last_role=last_role,
-            config=config,
-            use_openai=use_openai,
-            use_claude=use_claude,
-            use_groq=use_groq,
-            use_gemini=use_gemini,
-            use_local=use_local,
-            gemini_model=gemini_model
-        )
-        if cor_response is None or not cor_response.strip():
-            return model_conversation_history
-
-        print(f"Generating Professor Synapse response for turn {turn}")
-        synapse_prompt = f"{config['system_prompts']['synapse_system_prompt']}\n\nConversation History:\n{model_conversation_history}\n\n🧙🏿‍♂️:"
-        synapse_response, last_role = generate_and_append_response(
-            "assistant",
-            synapse_prompt,
+    Both parts are appended as their usual CoR and Professor messages. No
+    interim message is inserted between them for Claude, as the request is a
+    single user prompt.
+
+    Args:
+        model_conversation_history (ConversationHistory): The history of the conversation for the model.
+        user_conversation_history (ConversationHistory): The history of the user's conversation.
+        output_sink (OutputSink): The sink receiving message records.
+        conversation_id (str): The conversation ID.
+        turn (int): The turn number in the conversation.
+        config (dict): Configuration settings.
+        rng (random.Random): Random generator for the conversation.
+        quality (QualityMonitor, optional): Monitor validating both parts; a rejected part makes the turn fall back to two requests.
+        cache_scope (str, optional): Scope of the conversation's requests in the response cache, see GenerationRequest.
+
+    Yields:
+        GenerationRequest: The fused request; the response is sent back in.
+
+    Returns:
+        tuple: The CoR and the Professor's reply, or None if generation failed or the response could not be split,
+            in which case nothing is appended and the turn should be generated with two requests.
+    """
+    print(f"Generating fused CoR and Professor Synapse response for turn {turn}")
+    print(f"Conversation ID: {conversation_id}, Turn: {turn}, Role: assistant")
+    print(rng.choice(config['synapse_thoughts']))
+
+    system_prompt = fused_system_prompt(config)
+    history_text = model_conversation_history.render("cor")
+    prompt = f"Conversation History:\n{history_text}\n\nFilled-in CoR and 🧙🏿‍♂️ reply:"
+    record_prompt_tokens(system_prompt, prompt, history_text, model_conversation_history, model_conversation_history)
+
+    def write_partial(delta):
+        output_sink.write_partial({"conversation_id": conversation_id, "turn": turn, "name": "CoR+Professor", "delta": delta})
+
+    response = yield GenerationRequest("assistant", prompt, "fused", system_prompt, on_delta=write_partial, cache_scope=cache_scope)
+    parts = parse_fused_response(response) if response else None
+    if parts is None:
+        print("Could not split the fused response; generating the CoR and the Professor's reply separately.")
+        run_stats.add('fused_turn_fallbacks')
+        return None
+
+    cor, professor = parts
+    if quality is not None and quality.action != "log":
+        if quality.check(cor, "cor", "CoR") is not None or quality.check(professor, "professor_synapse", "Professor") is not None:
+            print("The fused response failed the quality gate; generating the CoR and the Professor's reply separately.")
+            run_stats.add('fused_turn_fallbacks')
+            return None
+    if quality is not None:
+        quality.accept(cor, "CoR")
+        quality.accept(professor, "Professor")
+    append_message("assistant", "CoR", cor, model_conversation_history, user_conversation_history, output_sink, conversation_id, turn)
+    append_message("assistant", "Professor", f"🧙🏿‍♂️: {professor}", model_conversation_history, user_conversation_history, output_sink, conversation_id, turn)
+    run_stats.add('fused_turns')
+    return parts
+
+def save_checkpoint(checkpoint, output_sink, conversation_id, model_conversation_history, last_role, num_turns, turn, rng):
+    """
+    Save the state of a conversation after a completed turn.
+
+    The output sink is synced first, so a checkpoint never covers messages that
+    are not yet on disk. The user's history is rebuilt from the model's on resume.
+
+    Args:
+        checkpoint (ConversationCheckpoint): The checkpoint to save, or None to skip.
+        output_sink (OutputSink): The sink receiving message records.
+        conversation_id (str): The conversation ID.
+        model_conversation_history (ConversationHistory): The history of the conversation for the model.
+        last_role (str): The role of the last message in the conversation.
+        num_turns (int): The number of turns chosen for the conversation.
+        turn (int): The last completed turn (0 for the user problem).
+        rng (random.Random): Random generator for the conversation.
+    """
+    if checkpoint is None:
+        return
+    output_sink.sync()
+    checkpoint.save({
+        "conversation_id": conversation_id,
+        "model_conversation_history": model_conversation_history.messages,
+        "last_role": last_role,
+        "num_turns": num_turns,
+        "turn": turn,
+        "rng_state": rng.getstate(),
+    })
+
+def run_conversation_steps(note, output_sink, conversation_id, config, use_claude, rng, checkpoint=None, checkpoint_state=None, shared_opening=None, cache_scope=None):
+    """
+    Run the turns of a synthetic conversation and write each message to the sink, as a step generator.
+
+    Args:
+        note (dict): Note content to base the conversation on: its filename, content and optional max_turns cap.
+        output_sink (OutputSink): The sink receiving message records.
+        conversation_id (str): The conversation ID.
+        config (dict): Configuration settings.
+        use_claude (bool): Flag to use Claude.
+        rng (random.Random): Random generator for the conversation.
+        checkpoint (ConversationCheckpoint, optional): Checkpoint saved after every turn.
+        checkpoint_state (dict, optional): Saved state to resume from.
+        shared_opening (SharedOpening, optional): Opening shared with the other variants of the conversation.
+        cache_scope (str, optional): Scope of the conversation's requests in the response cache, see GenerationRequest.
+
+    Yields:
+        GenerationRequest: Each request to generate; the response is sent back in.
+
+    Returns:
+        list: The generated conversation history.
+    """
+    model_conversation_history = ConversationHistory(config)
+    user_conversation_history = ConversationHistory(config)
+    fused_turns = config['conversation_generation'].get('fused_turns', False)
+    fused_fallbacks = 0
+    quality = create_quality_monitor(config)
+    last_role = "system"  # Initialize with system to ensure the first message is from the user
+
+    if checkpoint_state is not None:
+        for message in checkpoint_state['model_conversation_history']:
+            model_conversation_history.append(message)
+            if message['role'] == "user" or message.get('name') == "Professor":
+                user_conversation_history.append(message)
+            if quality is not None:
+                quality.accept(message['content'], message.get('name'))
+        last_role = checkpoint_state['last_role']
+        num_turns = checkpoint_state['num_turns']
+        start_turn = checkpoint_state['turn'] + 1
+        version, internal_state, gauss_next = checkpoint_state['rng_state']
+        rng.setstate((version, tuple(internal_state), gauss_next))
+        print(f"Resuming conversation {conversation_id} for note {note['filename']} at turn {start_turn}")
+        messages = model_conversation_history.messages
+        if shared_opening is not None and messages and messages[0]['role'] == "user":
+            # Variants that have not started yet fork from the opening saved with this one
+            shared_opening.set(messages[0]['content'])
+    elif shared_opening is not None and shared_opening.response is not None:
+        # Fork from the opening of another variant, without sending the document again
+        print(f"Forking conversation {conversation_id} from the shared opening for note: {note['filename']}")
+        print(rng.choice(config['synapse_thoughts']))
+        user_problem = shared_opening.response
+        append_message("user", "Joseph", user_problem, model_conversation_history, user_conversation_history, output_sink, conversation_id, 0)
+        if quality is not None:
+            quality.accept(user_problem, "Joseph")
+        last_role = "user"
+        run_stats.add('forked_conversations')
+    else:
+        # Initial user problem generation with document access
+        print(f"Generating user problem for note: {note['filename']}")
+        user_problem_prompt = f"Document:\n{note['content']}\n\n**You are now Joseph!**, and are about to begin your conversation with Prof. Come up with the problem you face based on the provided text, and respond in the first person as Joseph:**"
+        record_prompt_tokens(config['system_prompts']['user_system_prompt'], user_problem_prompt, "", user_conversation_history, model_conversation_history)
+        user_problem, last_role = yield from generate_and_append_step(
+            "user",
+            user_problem_prompt,
             model_conversation_history,
             user_conversation_history,
-            output_file,
+            output_sink,
             conversation_id,
-            turn,
-            response_type="professor_synapse",
-            name="Professor",
+            0,
+            response_type="user",
+            name="Joseph",
             last_role=last_role,
             config=config,
-            use_openai=use_openai,
             use_claude=use_claude,
-            use_groq=use_groq,
-            use_gemini=use_gemini,
-            use_local=use_local,
-            gemini_model=gemini_model
+            rng=rng,
+            system_prompt=config['system_prompts']['user_system_prompt'],
+            share_key=shared_opening,
+            quality=quality,
+            cache_scope=cache_scope
         )
-        if synapse_response is None or not synapse_response.strip():
-            return model_conversation_history
+    
+        if user_problem is None or not user_problem.strip():
+            print("Failed to generate user problem or user problem is empty.")
+            return None
+        if shared_opening is not None:
+            shared_opening.set(user_problem)
+
+    if checkpoint_state is None:
+        num_turns = rng.randint(6, 10)  # Randomly choose the number of turns between 6 and 10
+        if note.get('max_turns'):
+            # Short notes run out of material before a full-length conversation
+            num_turns = min(num_turns, note['max_turns'])
+        num_turns = budget_governor.turns(num_turns)
+        start_turn = 1
+        save_checkpoint(checkpoint, output_sink, conversation_id, model_conversation_history, last_role, num_turns, 0, rng)
+
+    for turn in range(start_turn, num_turns + 1):
+        fused_response = None
+        if fused_turns:
+            fused_response = yield from generate_fused_turn_step(model_conversation_history, user_conversation_history, output_sink, conversation_id, turn, config, rng, quality, cache_scope)
+            if fused_response is None:
+                fused_fallbacks += 1
+                # A model that keeps missing the format would cost an extra request every turn
+                if fused_fallbacks >= 2:
+                    print(f"Generating the remaining turns of conversation {conversation_id} with two requests per turn.")
+                    fused_turns = False
+        if fused_response is not None:
+            last_role = "assistant"
+        else:
+            print(f"Generating CoR response for turn {turn}")
+            history_text = model_conversation_history.render("cor")
+            cor_prompt = f"Conversation History:\n{history_text}\n\nFilled-in CoR:"
+            record_prompt_tokens(config['system_prompts']['cor_system_prompt'], cor_prompt, history_text, model_conversation_history, model_conversation_history)
+            cor_response, last_role = yield from generate_and_append_step(
+                "assistant",
+                cor_prompt,
+                model_conversation_history,
+                user_conversation_history,
+                output_sink,
+                conversation_id,
+                turn,
+                response_type="cor",
+                name="CoR",
+                last_role=last_role,
+                config=config,
+                use_claude=use_claude,
+                rng=rng,
+                system_prompt=config['system_prompts']['cor_system_prompt'],
+                quality=quality,
+                cache_scope=cache_scope
+            )
+            if cor_response is None or not cor_response.strip():
+                return model_conversation_history.messages
+
+            print(f"Generating Professor Synapse response for turn {turn}")
+            history_text = model_conversation_history.render("professor_synapse")
+            synapse_prompt = f"Conversation History:\n{history_text}\n\n🧙🏿‍♂️:"
+            record_prompt_tokens(config['system_prompts']['synapse_system_prompt'], synapse_prompt, history_text, model_conversation_history, model_conversation_history)
+            synapse_response, last_role = yield from generate_and_append_step(
+                "assistant",
+                synapse_prompt,
+                model_conversation_history,
+                user_conversation_history,
+                output_sink,
+                conversation_id,
+                turn,
+                response_type="professor_synapse",
+                name="Professor",
+                last_role=last_role,
+                config=config,
+                use_claude=use_claude,
+                rng=rng,
+                system_prompt=config['system_prompts']['synapse_system_prompt'],
+                quality=quality,
+                cache_scope=cache_scope
+            )
+            if synapse_response is None or not synapse_response.strip():
+                return model_conversation_history.messages
 
         # User follow-up prompt without document access but using the system prompt and previous user conversation history
-        user_followup_prompt = f"{config['system_prompts']['user_system_prompt']}\n\nConversation History:\n{user_conversation_history}\n\nBased on Professor Synapse's previous response, ask a specific NEW question that builds upon the information provided and helps deepen your understanding of the topic. Respond in first person as Joseph:"
-        user_followup_response, last_role = generate_and_append_response(
+        history_text = user_conversation_history.render("user")
+        user_followup_prompt = f"Conversation History:\n{history_text}\n\nBased on Professor Synapse's previous response, ask a specific NEW question that builds upon the information provided and helps deepen your understanding of the topic. Respond in first person as Joseph:"
+        record_prompt_tokens(config['system_prompts']['user_system_prompt'], user_followup_prompt, history_text, user_conversation_history, model_conversation_history)
+        user_followup_response, last_role = yield from generate_and_append_step(
             "user",
             user_followup_prompt,
             model_conversation_history,
             user_conversation_history,
-            output_file,
+            output_sink,
             conversation_id,
             turn,
             response_type="user",
             name="Joseph",
             last_role=last_role,
             config=config,
-            use_openai=use_openai,
             use_claude=use_claude,
-            use_groq=use_groq,
-            use_gemini=use_gemini,
-            use_local=use_local,
-            gemini_model=gemini_model
+            rng=rng,
+            system_prompt=config['system_prompts']['user_system_prompt'],
+            quality=quality,
+            cache_scope=cache_scope
         )
         if user_followup_response is None or not user_followup_response.strip():
-            return model_conversation_history
+            return model_conversation_history.messages
 
-    return model_conversation_history
+        save_checkpoint(checkpoint, output_sink, conversation_id, model_conversation_history, last_role, num_turns, turn, rng)
 
-def format_output(conversation):
-    """
-    Format the output of the conversation.
-
-    Args:
-        conversation (list): The conversation history.
-
-    Returns:
-        list: The formatted conversation history.
-    """
-    return conversation
+    return model_conversation_history.messages
 
 def finalize_json_output(output_file):
     """
-    Finalize the JSON output file.
+    Finalize the JSON output file by exporting the JSON Lines output to a JSON array.
 
     Args:
-        output_file (str): Path to the output JSON file.
+        output_file (str): Path to the output JSON Lines file.
+
+    Returns:
+        str: Path to the exported JSON file.
     """
-    pass
\ No newline at end of file
+    return export_jsonl_to_json(output_file)
@@ -0,0 +1,194 @@
+# credentials.py
+
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+# Environment variable holding each provider's API key
+API_KEY_VARIABLES = {
+    "openai": "OPENAI_API_KEY",
+    "claude": "CLAUDE_API_KEY",
+    "groq": "GROQ_API_KEY",
+    "gemini": "GEMINI_API_KEY",
+    "openrouter": "OPENROUTER_API_KEY",
+}
+
+class CredentialsExhausted(Exception):
+    """
+    Raised when every API key of a provider has used up its daily allowance.
+    """
+
+def load_api_keys(provider):
+    """
+    Load every API key of a provider from the environment.
+
+    Keys are read from <VARIABLE>S (comma-separated), <VARIABLE> and
+    <VARIABLE>_1, <VARIABLE>_2, ..., for example GEMINI_API_KEYS,
+    GEMINI_API_KEY and GEMINI_API_KEY_1. Duplicates are dropped.
+
+    Args:
+        provider (str): The provider name.
+
+    Returns:
+        list: The API keys, in the order found.
+    """
+    variable = API_KEY_VARIABLES.get(provider)
+    if variable is None:
+        return []
+    candidates = os.getenv(f"{variable}S", "").split(",") + [os.getenv(variable, "")]
+    index = 1
+    while os.getenv(f"{variable}_{index}"):
+        candidates.append(os.getenv(f"{variable}_{index}"))
+        index += 1
+    keys = []
+    for key in candidates:
+        key = key.strip()
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+def _today():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+class Credential:
+    """
+    One API key with its usage and cooldown state.
+    """
+
+    def __init__(self, key, usage=0):
+        """
+        Initialize the credential.
+
+        Args:
+            key (str): The API key.
+            usage (int): Requests already sent with the key today.
+        """
+        self.key = key
+        # Identifies the key in the state store and logs without revealing it
+        self.key_id = hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+        self.usage = usage
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+
+class CredentialPool:
+    """
+    Several API keys of one provider, used in parallel.
+
+    Each request goes to the healthy key with the fewest requests in flight,
+    then the lowest usage today. A key that hits a rate limit rests for its
+    Retry-After time (or the configured cooldown), and a key that reaches its
+    daily allowance is skipped until the next UTC day. Usage is persisted in the
+    state store, so the allowance holds across runs.
+    """
+
+    def __init__(self, provider, keys, max_usage=None, cooldown=60.0, state_store=None):
+        """
+        Initialize the pool.
+
+        Args:
+            provider (str): The provider name.
+            keys (list): The API keys.
+            max_usage (int, optional): Requests allowed per key per UTC day. None means unlimited.
+            cooldown (float): Seconds a key rests after a rate limit error without Retry-After.
+            state_store (StateStore, optional): Store persisting the daily usage.
+        """
+        self.provider = provider
+        self.max_usage = max_usage
+        self.cooldown = cooldown
+        self.state_store = state_store
+        self.credentials = [Credential(key) for key in keys]
+        self._lock = threading.Lock()
+        self.day = None
+        self._roll_day()
+
+    def _roll_day(self):
+        today = _today()
+        if today == self.day:
+            return
+        self.day = today
+        usage = self.state_store.load_credential_usage(self.provider, today) if self.state_store is not None else {}
+        for credential in self.credentials:
+            credential.usage = usage.get(credential.key_id, 0)
+
+    def acquire(self):
+        """
+        Take the least-loaded healthy key for a request, waiting if every key is cooling down.
+
+        Returns:
+            Credential: The key to use. Pass it to release() when the request finishes.
+
+        Raises:
+            CredentialsExhausted: If every key has reached its daily allowance.
+        """
+        while True:
+            with self._lock:
+                self._roll_day()
+                now = time.monotonic()
+                available = [c for c in self.credentials if self.max_usage is None or c.usage < self.max_usage]
+                if not available:
+                    raise CredentialsExhausted(f"All {self.provider} API keys have reached their usage limit of {self.max_usage} requests for today.")
+                ready = [c for c in available if c.cooldown_until <= now]
+                if ready:
+                    credential = min(ready, key=lambda c: (c.in_flight, c.usage))
+                    credential.in_flight += 1
+                    # Counted when taken, so concurrent requests spread over the keys
+                    credential.usage += 1
+                    day = self.day
+                    break
+                wait = min(c.cooldown_until for c in available) - now
+            time.sleep(wait)
+        if self.state_store is not None:
+            self.state_store.add_credential_usage(self.provider, credential.key_id, day)
+        return credential
+
+    def release(self, credential, rate_limited=False, retry_after=None):
+        """
+        Return a key after its request finished.
+
+        Args:
+            credential (Credential): The key returned by acquire().
+            rate_limited (bool): Whether the provider rejected the request for exceeding a rate limit.
+            retry_after (float, optional): Seconds the provider asked to wait.
+        """
+        with self._lock:
+            credential.in_flight -= 1
+            if rate_limited:
+                credential.cooldown_until = max(credential.cooldown_until, time.monotonic() + (retry_after or self.cooldown))
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def configure_credentials(config, state_store=None):
+    """
+    Build the credential pool of every provider that has API keys in the environment.
+
+    The daily allowance per key comes from max_usage_per_key in the provider's
+    details section of the config, the cooldown from the 'credentials' section.
+
+    Args:
+        config (dict): Configuration settings.
+        state_store (StateStore, optional): Store persisting the key usage across runs.
+    """
+    cooldown = (config.get('credentials') or {}).get('cooldown', 60.0)
+    with _pools_lock:
+        _pools.clear()
+        for provider in API_KEY_VARIABLES:
+            keys = load_api_keys(provider)
+            if keys:
+                details = config.get(f"{provider}_details") or {}
+                _pools[provider] = CredentialPool(provider, keys, details.get('max_usage_per_key'), cooldown, state_store)
+
+def get_credential_pool(provider):
+    """
+    Return the credential pool of a provider.
+
+    Args:
+        provider (str): The provider name.
+
+    Returns:
+        CredentialPool: The pool, or None if the provider has no pool (for example the local model).
+    """
+    with _pools_lock:
+        return _pools.get(provider)
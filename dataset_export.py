@@ -0,0 +1,242 @@
+# dataset_export.py
+
+import argparse
+import json
+import os
+from collections import OrderedDict
+from output_sinks import SHARD_EXTENSIONS, decompress_frame, iter_jsonl_records
+
+class DatasetReader:
+    """
+    Random access to the conversations of a dataset written by DatasetSink.
+
+    The manifest is read once into an index of frame locations; conversation
+    records are only read, one frame at a time, when asked for.
+    """
+
+    def __init__(self, path):
+        """
+        Open a dataset.
+
+        Args:
+            path (str): Directory of the dataset.
+        """
+        self.path = path
+        manifest_path = os.path.join(path, "manifest.jsonl")
+        if not os.path.exists(manifest_path):
+            raise ValueError(f"Not a dataset (no manifest.jsonl): {path}")
+        # A conversation resumed after it was interrupted has a frame per run
+        self._frames = OrderedDict()
+        for entry in iter_jsonl_records(manifest_path):
+            self._frames.setdefault(entry['conversation_id'], []).append(entry)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def conversation_ids(self, run_prefix=None):
+        """
+        Return the IDs of the conversations in the dataset, in the order they were written.
+
+        Args:
+            run_prefix (str, optional): Only conversations written by runs whose name starts with this.
+
+        Returns:
+            list: The conversation IDs.
+        """
+        if run_prefix is None:
+            return list(self._frames)
+        return [conversation_id for conversation_id, entries in self._frames.items() if any(entry['run'].startswith(run_prefix) for entry in entries)]
+
+    def read_conversation(self, conversation_id):
+        """
+        Read the message records of one conversation.
+
+        Args:
+            conversation_id (str): The conversation ID.
+
+        Returns:
+            list: The message records, or None if the conversation is not in the dataset.
+        """
+        entries = self._frames.get(conversation_id)
+        if entries is None:
+            return None
+        records = []
+        for entry in entries:
+            with open(os.path.join(self.path, entry['shard']), 'rb') as file:
+                file.seek(entry['offset'])
+                frame = file.read(entry['length'])
+            compression = next(name for name, extension in SHARD_EXTENSIONS.items() if entry['shard'].endswith(extension))
+            records.extend(json.loads(line) for line in decompress_frame(frame, compression).decode('utf-8').splitlines() if line)
+        return records
+
+    def iter_conversations(self, run_prefix=None):
+        """
+        Iterate over the conversations of the dataset, one at a time.
+
+        Args:
+            run_prefix (str, optional): Only conversations written by runs whose name starts with this.
+
+        Yields:
+            tuple: The conversation ID and its message records.
+        """
+        for conversation_id in self.conversation_ids(run_prefix):
+            yield conversation_id, self.read_conversation(conversation_id)
+
+def iter_jsonl_conversations(jsonl_path):
+    """
+    Iterate over the conversations of a JSON Lines file of interleaved message records.
+
+    A first pass records the offset of every line by conversation; the second
+    reads one conversation at a time, so memory use does not grow with the
+    size of the messages.
+
+    Args:
+        jsonl_path (str): Path to the .jsonl file.
+
+    Yields:
+        tuple: The conversation ID and its message records.
+    """
+    offsets = OrderedDict()
+    with open(jsonl_path, 'rb') as file:
+        while True:
+            offset = file.tell()
+            line = file.readline()
+            if not line:
+                break
+            try:
+                conversation_id = json.loads(line)['conversation_id']
+            except (json.JSONDecodeError, KeyError, UnicodeDecodeError):
+                continue
+            offsets.setdefault(conversation_id, []).append(offset)
+        for conversation_id, line_offsets in offsets.items():
+            records = []
+            for offset in line_offsets:
+                file.seek(offset)
+                records.append(json.loads(file.readline()))
+            yield conversation_id, records
+
+def iter_conversations(source):
+    """
+    Iterate over the conversations of any output SynthGen has written.
+
+    Args:
+        source (str): A dataset directory, a JSON Lines output file, or a JSON array file of older runs.
+
+    Yields:
+        tuple: The conversation ID and its message records.
+    """
+    if os.path.isdir(source):
+        yield from DatasetReader(source).iter_conversations()
+    elif source.endswith(".jsonl"):
+        yield from iter_jsonl_conversations(source)
+    else:
+        # JSON array files of older runs are small enough to load one at a time
+        with open(source, 'r', encoding='utf-8') as file:
+            records = json.load(file)
+        conversations = OrderedDict()
+        for record in records:
+            conversations.setdefault(record.get('conversation_id'), []).append(record)
+        yield from conversations.items()
+
+def chat_example(conversation_id, records):
+    """
+    Turn the message records of a conversation into a chat-format training example.
+
+    Args:
+        conversation_id (str): The conversation ID.
+        records (list): The message records, in order.
+
+    Returns:
+        dict: The conversation ID and its messages, each with its role, name and content.
+    """
+    return {
+        "conversation_id": conversation_id,
+        "messages": [{"role": record['role'], "name": record.get('name'), "content": record['content']} for record in records],
+    }
+
+def export_chat_jsonl(sources, output_path):
+    """
+    Export conversations as chat-format JSON Lines, one conversation per line.
+
+    Args:
+        sources (list): Dataset directories and output files, see iter_conversations().
+        output_path (str): Path of the .jsonl file to write.
+
+    Returns:
+        int: The number of conversations exported.
+    """
+    count = 0
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as out:
+        for source in sources:
+            for conversation_id, records in iter_conversations(source):
+                out.write(json.dumps(chat_example(conversation_id, records), ensure_ascii=False) + "\n")
+                count += 1
+    os.replace(tmp_path, output_path)
+    return count
+
+def export_parquet(sources, output_path, row_group_size=1000):
+    """
+    Export conversations to a Parquet file, one row per conversation, written a row group at a time.
+
+    Needs the optional pyarrow package.
+
+    Args:
+        sources (list): Dataset directories and output files, see iter_conversations().
+        output_path (str): Path of the .parquet file to write.
+        row_group_size (int): Conversations per row group.
+
+    Returns:
+        int: The number of conversations exported.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Parquet export needs the pyarrow package: pip install pyarrow")
+
+    message_type = pa.struct([("role", pa.string()), ("name", pa.string()), ("content", pa.string())])
+    schema = pa.schema([("conversation_id", pa.string()), ("messages", pa.list_(message_type))])
+    count = 0
+    rows = []
+    tmp_path = output_path + ".tmp"
+    with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+        for source in sources:
+            for conversation_id, records in iter_conversations(source):
+                rows.append(chat_example(conversation_id, records))
+                if len(rows) >= row_group_size:
+                    writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                    count += len(rows)
+                    rows = []
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            count += len(rows)
+    os.replace(tmp_path, output_path)
+    return count
+
+EXPORT_FORMATS = {
+    "chat": export_chat_jsonl,
+    "parquet": export_parquet,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export SynthGen output to training formats, or print one conversation.")
+    parser.add_argument("sources", nargs="+", help="Dataset directories, .jsonl output files or .json files of older runs")
+    parser.add_argument("--output", help="File to export to")
+    parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="chat", help="chat: chat-format JSON Lines; parquet: needs pyarrow")
+    parser.add_argument("--conversation", help="Print the records of this conversation of a dataset instead of exporting")
+    args = parser.parse_args()
+
+    if args.conversation:
+        records = DatasetReader(args.sources[0]).read_conversation(args.conversation)
+        if records is None:
+            raise SystemExit(f"Conversation not found: {args.conversation}")
+        for record in records:
+            print(json.dumps(record, ensure_ascii=False))
+    else:
+        if not args.output:
+            parser.error("--output is required to export")
+        try:
+            print(f"Exported {EXPORT_FORMATS[args.format](args.sources, args.output)} conversations to {args.output}")
+        except ValueError as e:
+            raise SystemExit(str(e))
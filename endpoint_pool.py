@@ -0,0 +1,317 @@
+# endpoint_pool.py
+
+import os
+import threading
+import time
+import urllib.request
+import httpx
+from providers import get_endpoint_provider
+from stats import run_stats
+
+class LocalEndpoint:
+    """
+    One OpenAI-compatible inference server (llama.cpp, LM Studio, vLLM) with its load and health.
+    """
+
+    def __init__(self, url, model_id=None, max_concurrency=None, health_url=None):
+        """
+        Initialize the endpoint.
+
+        Args:
+            url (str): Full URL of the chat completions endpoint.
+            model_id (str, optional): Model ID the server expects. Defaults to the model ID of the request.
+            max_concurrency (int, optional): Requests sent to the server at once. None means unlimited.
+            health_url (str, optional): URL probed by the health checks. Defaults to the /models URL next to the endpoint.
+        """
+        self.url = url
+        self.model_id = model_id
+        self.max_concurrency = max_concurrency
+        self.health_url = health_url or _models_url(url)
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.ejected_until = 0.0
+        self.last_used = 0
+
+    def provider(self):
+        """
+        Return the shared provider sending requests to the endpoint.
+        """
+        return get_endpoint_provider(self.url)
+
+    def has_capacity(self):
+        return self.max_concurrency is None or self.in_flight < self.max_concurrency
+
+    def __repr__(self):
+        return self.url
+
+def _models_url(url):
+    base = url.rstrip("/")
+    if base.endswith("/chat/completions"):
+        base = base[:-len("/chat/completions")]
+    return f"{base}/models"
+
+def _is_endpoint_failure(error):
+    # A server that is down or broken, as opposed to one rejecting a request or asking to slow down
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+class EndpointPool:
+    """
+    Spread local model requests over several inference servers.
+
+    Each request goes to the admitted endpoint with the fewest requests in
+    flight, waiting while every admitted endpoint is at its concurrency cap.
+    An endpoint failing 'failure_threshold' requests in a row, or a health
+    check, is ejected for at least 'ejection_seconds', and re-admitted once a
+    health check passes again (with health checks off, once that time is up).
+    While every endpoint is ejected, requests still go to the least loaded one.
+    """
+
+    def __init__(self, endpoints, failure_threshold=3, ejection_seconds=30.0, health_check_interval=10.0, health_check_timeout=5.0):
+        """
+        Initialize the pool.
+
+        Args:
+            endpoints (list): LocalEndpoint objects.
+            failure_threshold (int): Consecutive failed requests after which an endpoint is ejected.
+            ejection_seconds (float): Minimum time an ejected endpoint gets no requests.
+            health_check_interval (float): Seconds between health checks of every endpoint. 0 or None disables them.
+            health_check_timeout (float): Seconds a health check waits for an answer.
+        """
+        self.endpoints = list(endpoints)
+        self.failure_threshold = failure_threshold
+        self.ejection_seconds = ejection_seconds
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self._condition = threading.Condition()
+        self._sequence = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the health checks in a background thread, if they are enabled and there is more than one endpoint.
+        """
+        if self.health_check_interval and len(self.endpoints) > 1 and self._thread is None:
+            self._thread = threading.Thread(target=self._run_health_checks, name="synthgen-endpoint-health", daemon=True)
+            self._thread.start()
+
+    def _admitted(self, endpoint, now):
+        if endpoint.healthy:
+            return True
+        if not self.health_check_interval and now >= endpoint.ejected_until:
+            # Without health checks the next request is the trial
+            endpoint.healthy = True
+            print(f"Re-admitting local endpoint {endpoint} after {self.ejection_seconds:.0f}s.")
+            return True
+        return False
+
+    def acquire(self):
+        """
+        Take the least loaded admitted endpoint for a request, waiting while all of them are busy.
+
+        Returns:
+            LocalEndpoint: The endpoint. Pass it to release() when the request ends.
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                candidates = [endpoint for endpoint in self.endpoints if self._admitted(endpoint, now)] or self.endpoints
+                ready = [endpoint for endpoint in candidates if endpoint.has_capacity()]
+                if ready:
+                    # Ties go to the least recently used endpoint, so a re-admitted server is not flooded to catch up
+                    endpoint = min(ready, key=lambda endpoint: (endpoint.in_flight, endpoint.last_used))
+                    self._sequence += 1
+                    endpoint.last_used = self._sequence
+                    endpoint.in_flight += 1
+                    endpoint.requests += 1
+                    return endpoint
+                # Wake up now and then, so an endpoint re-admitted by time alone is noticed
+                self._condition.wait(timeout=1.0)
+
+    def release(self, endpoint, error=None):
+        """
+        Return an endpoint after its request ended.
+
+        Args:
+            endpoint (LocalEndpoint): The endpoint returned by acquire().
+            error (Exception, optional): The error the request raised, if any.
+        """
+        with self._condition:
+            endpoint.in_flight -= 1
+            if error is not None and _is_endpoint_failure(error):
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.failure_threshold:
+                    self._eject(endpoint, f"{endpoint.consecutive_failures} failed requests in a row")
+            elif error is None:
+                endpoint.consecutive_failures = 0
+            self._condition.notify_all()
+
+    def _eject(self, endpoint, reason):
+        # Called with the condition held
+        endpoint.consecutive_failures = 0
+        endpoint.ejected_until = time.monotonic() + self.ejection_seconds
+        if endpoint.healthy:
+            endpoint.healthy = False
+            run_stats.add('local_endpoint_ejections')
+            print(f"Ejecting local endpoint {endpoint}: {reason}.")
+
+    def request(self, make_request):
+        """
+        Take an endpoint and start a request to it.
+
+        Args:
+            make_request (callable): Called with the LocalEndpoint; returns the request coroutine.
+
+        Returns:
+            coroutine: The request, which gives the endpoint back when it ends.
+        """
+        endpoint = self.acquire()
+        try:
+            coro = make_request(endpoint)
+        except BaseException:
+            self.release(endpoint)
+            raise
+        return self._finish(endpoint, coro)
+
+    async def _finish(self, endpoint, coro):
+        error = None
+        try:
+            return await coro
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release(endpoint, error)
+
+    def check_health(self, endpoint):
+        """
+        Probe an endpoint, ejecting it if it does not answer and re-admitting it once it does.
+
+        Args:
+            endpoint (LocalEndpoint): The endpoint.
+
+        Returns:
+            bool: Whether the endpoint answered.
+        """
+        try:
+            with urllib.request.urlopen(endpoint.health_url, timeout=self.health_check_timeout) as response:
+                ok = response.status < 400
+        except OSError:
+            ok = False
+        with self._condition:
+            if not ok:
+                self._eject(endpoint, "health check failed")
+            elif not endpoint.healthy and time.monotonic() >= endpoint.ejected_until:
+                endpoint.healthy = True
+                print(f"Re-admitting local endpoint {endpoint}: health check passed.")
+                self._condition.notify_all()
+        return ok
+
+    def _run_health_checks(self):
+        while not self._stop.wait(self.health_check_interval):
+            for endpoint in self.endpoints:
+                self.check_health(endpoint)
+
+    def report(self):
+        """
+        Print how the requests were spread over the endpoints.
+        """
+        if len(self.endpoints) < 2:
+            return
+        print("\nLocal endpoints:")
+        with self._condition:
+            for endpoint in self.endpoints:
+                state = "" if endpoint.healthy else " (ejected)"
+                print(f"  {endpoint}: {endpoint.requests:,} requests, {endpoint.failures:,} failed{state}")
+
+    def close(self):
+        """
+        Stop the health checks.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+def create_endpoint_pool(config):
+    """
+    Create the pool of local endpoints from the 'local_endpoints' section of the config.
+
+    Without endpoints in the config, the pool holds the URLs in LOCAL_API_URLS
+    (comma-separated) and LOCAL_API_URL, or else the url in 'api_details'.
+
+    Args:
+        config (dict): Configuration settings.
+
+    Returns:
+        EndpointPool: The pool, not started.
+    """
+    settings = config.get('local_endpoints') or {}
+    specs = settings.get('endpoints')
+    if not specs:
+        urls = os.getenv('LOCAL_API_URLS', "").split(",") + [os.getenv('LOCAL_API_URL', "")]
+        urls = list(dict.fromkeys(url.strip() for url in urls if url.strip()))
+        if not urls and (config.get('api_details') or {}).get('url'):
+            urls = [config['api_details']['url']]
+        specs = [{"url": url} for url in urls]
+    endpoints = [
+        LocalEndpoint(spec['url'], spec.get('model_id'), spec.get('max_concurrency', settings.get('max_concurrency')), spec.get('health_url'))
+        for spec in specs
+    ]
+    return EndpointPool(
+        endpoints,
+        settings.get('failure_threshold', 3),
+        settings.get('ejection_seconds', 30.0),
+        settings.get('health_check_interval', 10.0),
+        settings.get('health_check_timeout', 5.0),
+    )
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def configure_endpoint_pool(config):
+    """
+    Create the pool of local endpoints that local model requests are sent to, and start its health checks.
+
+    Args:
+        config (dict): Configuration settings.
+
+    Returns:
+        EndpointPool: The pool.
+    """
+    global _pool
+    pool = create_endpoint_pool(config)
+    with _pool_lock:
+        previous, _pool = _pool, pool
+    if previous is not None:
+        previous.close()
+    pool.start()
+    return pool
+
+def get_endpoint_pool():
+    """
+    Return the pool of local endpoints, created from the environment if configure_endpoint_pool() was not called.
+
+    Returns:
+        EndpointPool: The pool.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = create_endpoint_pool({})
+        return _pool
+
+def close_endpoint_pool():
+    """
+    Stop the health checks of the pool.
+    """
+    with _pool_lock:
+        pool = _pool
+    if pool is not None:
+        pool.close()
@@ -1,4 +1,6 @@
 import os
+import sqlite3
+from state_store import get_state_store
 
 def read_obsidian_note(file_path):
     """
@@ -24,66 +26,52 @@ def read_obsidian_note(file_path):
 
 def load_processed_notes(file_path):
     """
-    Load the processed notes from a file.
+    Load the processed notes from the state store.
 
     Args:
-        file_path (str): The path to the processed notes file.
+        file_path (str): The path to the state store database.
 
     Returns:
         set: A set containing the processed note paths.
     """
-    processed_notes = set()
-    if os.path.exists(file_path):
-        try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                for line in file:
-                    processed_notes.add(line.strip())
-        except IOError as e:
-            print(f"Error loading processed notes from {file_path}")
-            print(f"Error details: {str(e)}")
-    return processed_notes
+    try:
+        return get_state_store(file_path).processed_notes()
+    except sqlite3.Error as e:
+        print(f"Error loading processed notes from {file_path}")
+        print(f"Error details: {str(e)}")
+        return set()
 
 def save_processed_note(file_path, note_path):
     """
-    Append a processed note path to the processed notes file.
+    Mark a note as processed in the state store.
 
     Args:
-        file_path (str): The path to the processed notes file.
-        note_path (str): The path of the processed note to be appended.
+        file_path (str): The path to the state store database.
+        note_path (str): The path of the processed note.
     """
     try:
-        with open(file_path, 'a', encoding='utf-8') as file:
-            file.write(f"{note_path}\n")
-    except IOError as e:
-        print(f"Error appending processed note to {file_path}")
+        get_state_store(file_path).add_processed(note_path)
+    except sqlite3.Error as e:
+        print(f"Error saving processed note to {file_path}")
         print(f"Error details: {str(e)}")
 
 def delete_processed_note(file_path, note_path):
     """
-    Delete a processed note path from the processed notes file.
+    Remove a processed note from the state store.
 
     Args:
-        file_path (str): The path to the processed notes file.
+        file_path (str): The path to the state store database.
         note_path (str): The path of the processed note to be deleted.
 
     Returns:
         bool: True if the note was successfully deleted, False otherwise.
     """
     try:
-        if not os.path.exists(file_path):
-            print(f"Processed notes file not found: {file_path}")
+        if not get_state_store(file_path).remove_processed(note_path):
+            print(f"Processed note not found: {note_path}")
             return False
-        
-        with open(file_path, 'r', encoding='utf-8') as file:
-            lines = file.readlines()
-
-        with open(file_path, 'w', encoding='utf-8') as file:
-            for line in lines:
-                if line.strip() != note_path:
-                    file.write(line)
-
         return True
-    except IOError as e:
+    except sqlite3.Error as e:
         print(f"Error deleting processed note from {file_path}")
         print(f"Error details: {str(e)}")
         return False
@@ -0,0 +1,55 @@
+# gemini_provider.py
+
+import os
+from google.ai import generativelanguage as glm
+from providers import AsyncProvider
+from metrics import record_usage
+
+class GeminiProvider(AsyncProvider):
+    """
+    Provider for Gemini. Each instance has its own async gRPC client bound to its API key,
+    so several keys can be used side by side.
+    """
+
+    name = "gemini"
+
+    def __init__(self, api_key=None):
+        """
+        Initialize the provider.
+
+        Args:
+            api_key (str, optional): The Gemini API key. Defaults to GEMINI_API_KEY from the environment.
+        """
+        self.api_key = api_key or os.getenv('GEMINI_API_KEY')
+        self._client = None
+
+    async def generate_content(self, model, message):
+        """
+        Generate content with a Gemini model.
+
+        Args:
+            model (str or GenerativeModel): The model ID, or a GenerativeModel object for Gemini.
+            message (str): The message to generate a response for.
+
+        Returns:
+            str: The generated response.
+        """
+        if self._client is None:
+            # Created on the event loop thread, which the gRPC channel is bound to
+            self._client = glm.GenerativeServiceAsyncClient(client_options={"api_key": self.api_key})
+        model_name = getattr(model, 'model_name', model)
+        if "/" not in model_name:
+            model_name = f"models/{model_name}"
+        request = glm.GenerateContentRequest(
+            model=model_name,
+            contents=[glm.Content(role="user", parts=[glm.Part(text=message)])],
+        )
+        response = await self._client.generate_content(request)
+        usage = response.usage_metadata
+        record_usage(usage.prompt_token_count, usage.candidates_token_count)
+        return "".join(part.text for part in response.candidates[0].content.parts)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.transport.close()
+            self._client = None
@@ -0,0 +1,214 @@
+# history.py
+
+import re
+from functools import lru_cache
+
+# tiktoken is optional; without it token counts are estimated from character length
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+SEPARATOR = "\n\n"
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+def count_tokens(text):
+    """
+    Count the tokens in a piece of text.
+
+    Uses the cached tiktoken cl100k_base encoding when tiktoken is installed, and
+    falls back to an estimate of four characters per token otherwise.
+
+    Args:
+        text (str): The text to count.
+
+    Returns:
+        int: The number of tokens.
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+@lru_cache(maxsize=64)
+def count_static_tokens(text):
+    """
+    Count the tokens in a static piece of text, such as a system prompt, caching the result.
+
+    Args:
+        text (str): The text to count.
+
+    Returns:
+        int: The number of tokens.
+    """
+    return count_tokens(text)
+
+def summarize_message(message, max_chars=200):
+    """
+    Build a one-line extractive summary of a message: its first sentence, capped at max_chars.
+
+    Args:
+        message (dict): The message with 'name' and 'content' keys.
+        max_chars (int): Maximum length of the summary text.
+
+    Returns:
+        str: The summary line.
+    """
+    content = " ".join(message['content'].split())
+    first_sentence = _SENTENCE_END.split(content, maxsplit=1)[0]
+    if len(first_sentence) > max_chars:
+        first_sentence = first_sentence[:max_chars].rstrip() + "..."
+    return f"- {message.get('name', message['role'])}: {first_sentence}"
+
+class ConversationHistory:
+    """
+    Conversation history that renders its transcript incrementally.
+
+    Each message is rendered and token-counted once, when it is appended. A
+    prompt for a response type gets the cached full transcript when it fits the
+    configured budget, or the opening messages plus the newest messages that fit,
+    with the dropped middle either omitted (truncate) or replaced by one-line
+    summaries (summarize).
+    """
+
+    def __init__(self, config=None):
+        """
+        Initialize an empty history.
+
+        Args:
+            config (dict, optional): Configuration settings. Budgets and strategy come from the 'history' section.
+        """
+        history_config = (config or {}).get('history', {})
+        self.budgets = history_config.get('max_tokens', {})
+        self.strategy = history_config.get('strategy', 'truncate')
+        self.keep_first = history_config.get('keep_first', 1)
+        self.messages = []
+        self._lines = []
+        self._tokens = []
+        self._summaries = []
+        self._full = ""
+        self._full_tokens = 0
+        self._repr_tokens = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def append(self, message):
+        """
+        Append a message and extend the rendered transcript.
+
+        Args:
+            message (dict): The message with 'role', 'content' and 'name' keys.
+        """
+        line = f"{message.get('name', message['role'])} ({message['role']}):\n{message['content']}"
+        tokens = count_tokens(line)
+        self.messages.append(message)
+        self._lines.append(line)
+        self._tokens.append(tokens)
+        if self.strategy == 'summarize':
+            self._summaries.append(summarize_message(message))
+        self._full = f"{self._full}{SEPARATOR}{line}" if self._full else line
+        self._full_tokens += tokens
+        # What the previous repr()-based prompt paid for this message, for run stats
+        self._repr_tokens += len(repr(message)) // 4 + 1
+
+    def budget_for(self, response_type):
+        """
+        Return the history token budget for a response type.
+
+        Args:
+            response_type (str): The response type (user, cor, professor_synapse).
+
+        Returns:
+            int: The budget in tokens, or None for no limit.
+        """
+        return self.budgets.get(response_type, self.budgets.get('default'))
+
+    @property
+    def full_tokens(self):
+        """
+        int: Tokens in the full rendered transcript.
+        """
+        return self._full_tokens
+
+    @property
+    def repr_tokens(self):
+        """
+        int: Estimated tokens of the history embedded as a Python repr(), as prompts did before budgeting.
+        """
+        return self._repr_tokens
+
+    def render(self, response_type=None):
+        """
+        Render the transcript within the budget for a response type.
+
+        Args:
+            response_type (str, optional): The response type whose budget applies.
+
+        Returns:
+            str: The rendered transcript.
+        """
+        budget = self.budget_for(response_type)
+        if budget is None or self._full_tokens <= budget:
+            return self._full
+
+        head_count = min(self.keep_first, len(self._lines))
+        head_tokens = sum(self._tokens[:head_count])
+        remaining = budget - head_tokens
+        # Summaries get a quarter of what is left so recent turns cannot crowd them out
+        reserved = remaining // 4 if self.strategy == 'summarize' else 0
+        remaining -= reserved
+
+        # Walk back from the newest message while it still fits
+        start = len(self._lines)
+        while start > head_count and self._tokens[start - 1] <= remaining:
+            start -= 1
+            remaining -= self._tokens[start]
+        remaining += reserved
+
+        if start == len(self._lines) and start > head_count:
+            # Not even the newest message fits, so keep its beginning
+            newest = self._lines[-1][:max(0, remaining) * 4]
+            return SEPARATOR.join(self._lines[:head_count] + [newest])
+
+        dropped = start - head_count
+        middle = []
+        if dropped:
+            if self.strategy == 'summarize':
+                middle = self._summarize(head_count, start, remaining)
+            if not middle:
+                middle = [f"[... {dropped} earlier messages omitted ...]"]
+
+        return SEPARATOR.join(self._lines[:head_count] + middle + self._lines[start:])
+
+    def _summarize(self, first, end, remaining):
+        # Keep the summaries of the most recent dropped messages that fit
+        summaries = []
+        for summary in reversed(self._summaries[first:end]):
+            tokens = count_tokens(summary)
+            if tokens > remaining:
+                break
+            summaries.append(summary)
+            remaining -= tokens
+        if not summaries:
+            return []
+        omitted = end - first - len(summaries)
+        header = f"[Summary of {end - first} earlier messages" + (f", {omitted} omitted" if omitted else "") + "]"
+        return [header + "\n" + "\n".join(reversed(summaries))]
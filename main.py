@@ -1,106 +1,463 @@
 # main.py
 
+import argparse
+import itertools
 import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from chunking import chunk_note
 from config import load_config
-from conversation import generate_conversation, format_output
-from file_utils import read_obsidian_note, load_processed_notes, save_processed_note
-from google.api_core import exceptions
+from conversation import SharedOpening, generate_conversation, generate_conversation_steps, finalize_json_output
+from file_utils import read_obsidian_note, save_processed_note
+from output_sinks import create_sink
+from state_store import ConversationCheckpoint, get_state_store, close_state_stores
+from vault_index import VaultIndex
+from scheduler import create_scheduler
+from batching import create_batch_runner
+from providers import configure_providers, close_providers
+from endpoint_pool import configure_endpoint_pool, close_endpoint_pool, get_endpoint_pool
+from rate_limiter import configure_rate_limits
+from credentials import CredentialsExhausted, configure_credentials
+from budget import BudgetExceeded, budget_governor, configure_budget
+from stats import run_stats
+from metrics import configure_metrics, request_metrics
+from response_cache import close_response_cache
+from router import configure_router
+from sharding import LeaseKeeper, connect_coordinator, note_key, shard_run_name, worker_config
+from api_clients import RESPONSE_GENERATORS
 from datetime import datetime
 
-def process_note(note_path, config, use_openai, use_claude, use_groq, use_gemini, use_openrouter, processed_notes_file, max_usage):
+# Providers offered by the interactive prompt
+MODEL_CHOICES = {"1": "openai", "2": "claude", "3": "groq", "4": "gemini", "5": "openrouter", "6": "local"}
+
+class NoteProgress:
+    """
+    Track the generation units of every note in the run.
+
+    A note is split into chunks, each generated from on its own, possibly by
+    different workers. The note is marked as processed once all of its units
+    have ended and every chunk has a conversation that succeeded, unless the
+    API keys ran out on the way. Otherwise its checkpoints are kept, so the
+    next run skips the conversations that completed and retries the rest.
+    """
+
+    def __init__(self, processed_notes_file):
+        """
+        Initialize the tracker.
+
+        Args:
+            processed_notes_file (str): State store tracking processed notes and conversation checkpoints.
+        """
+        self.processed_notes_file = processed_notes_file
+        self.processed = 0
+        self.exhausted = False
+        self._notes = {}
+        self._lock = threading.Lock()
+
+    def add(self, note_path, chunks, units_per_chunk=1):
+        """
+        Register the units of a note, before any of them is started.
+
+        Args:
+            note_path (str): The note path.
+            chunks (int): Number of chunks of the note.
+            units_per_chunk (int): Number of units of each chunk that will report to finish().
+        """
+        with self._lock:
+            self._notes[note_path] = {"remaining": chunks * units_per_chunk, "chunks": chunks, "succeeded": set(), "exhausted": False}
+
+    def finish(self, chunk, succeeded, exhausted=False):
+        """
+        Record that a unit of a note chunk ended.
+
+        Args:
+            chunk (NoteChunk): The chunk the unit generated from.
+            succeeded (bool): Whether the unit generated a conversation.
+            exhausted (bool): Whether the unit stopped because the API keys ran out.
+        """
+        note_path = chunk.note_path
+        with self._lock:
+            progress = self._notes[note_path]
+            if succeeded:
+                progress["succeeded"].add(chunk.index)
+            progress["exhausted"] = progress["exhausted"] or exhausted
+            self.exhausted = self.exhausted or exhausted
+            progress["remaining"] -= 1
+            if progress["remaining"]:
+                return
+            del self._notes[note_path]
+            self.processed += 1
+        budget_governor.note_finished()
+        generated = len(progress["succeeded"])
+        if generated == progress["chunks"] and not progress["exhausted"]:
+            save_processed_note(self.processed_notes_file, note_path)
+            get_state_store(self.processed_notes_file).delete_checkpoints(note_path)
+            print(f"Processed note {note_path} and saved it to {self.processed_notes_file}")
+        elif generated and not progress["exhausted"]:
+            print(f"Generated {generated} of the {progress['chunks']} chunks of note {note_path}; the next run retries the rest")
+        print(f"Finished processing note: {note_path}")
+
+def note_chunks(note_paths, config, progress, units_per_chunk=1):
     """
-    Process a single note and generate conversations.
+    Read and chunk every note, yielding each chunk as a unit of work.
+
+    Notes with too little text to generate from are marked as processed and skipped.
 
     Args:
-        note_path (str): Path to the note file.
+        note_paths (iterable): Note paths to process.
         config (dict): Configuration settings.
-        use_openai (bool): Flag to use OpenAI.
-        use_claude (bool): Flag to use Claude.
-        use_groq (bool): Flag to use Groq.
-        use_gemini (bool): Flag to use Gemini.
-        use_openrouter (bool): Flag to use OpenRouter.
-        processed_notes_file (str): File to track processed notes.
-        max_usage (int): Maximum usage per API key.
+        progress (NoteProgress): Tracker the units of each note are registered with.
+        units_per_chunk (int): Units reported to the tracker for every chunk.
+
+    Yields:
+        NoteChunk: Each chunk of each note.
+    """
+    for note_path in note_paths:
+        note = read_obsidian_note(note_path)
+        if note is None:
+            continue
+        chunks = chunk_note(note_path, note['content'], config)
+        if not chunks:
+            print(f"Skipping note with too little text: {note_path}")
+            save_processed_note(progress.processed_notes_file, note_path)
+            continue
+        if len(chunks) > 1:
+            print(f"Split note {note_path} into {len(chunks)} chunks")
+        progress.add(note_path, len(chunks), units_per_chunk)
+        yield from chunks
+
+def process_chunk(chunk, config, processed_notes_file, output_sink, progress, rng=None):
+    """
+    Generate the conversations of a single note chunk.
+
+    With conversation variants enabled, the first conversation generates the
+    opening user problem and the others fork from it, all running concurrently.
+
+    Args:
+        chunk (NoteChunk): The chunk to generate from.
+        config (dict): Configuration settings.
+        processed_notes_file (str): State store tracking processed notes and conversation checkpoints.
+        output_sink (OutputSink): The sink receiving message records for the run.
+        progress (NoteProgress): Tracker marking the note as processed once its last chunk ends.
+        rng (random.Random, optional): Random generator for the chunk's conversations.
 
     Returns:
-        list: List of generated conversations.
+        bool: Whether a conversation was generated.
     """
-    # Create the synth_conversations folder if it doesn't exist
-    synth_conversations_folder = "synth_conversations"
-    os.makedirs(synth_conversations_folder, exist_ok=True)
-    
-    # Generate a unique output file name based on the current date/time
-    current_datetime = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    output_file = os.path.join(synth_conversations_folder, f"synthgen_{current_datetime}.json")
-    
-    conversations = []
-    
-    for i in range(config['conversation_generation']['num_conversations']):
-        print(f"\nGenerating conversation {i + 1} for note: {note_path}")
+    state_store = get_state_store(processed_notes_file)
+    note = chunk.as_note()
+    num_conversations = config['conversation_generation']['num_conversations']
+
+    def generate(i, rng, shared_opening=None):
+        print(f"\nGenerating conversation {i + 1} for note: {chunk}")
         try:
-            note = read_obsidian_note(note_path)
-            conversation = generate_conversation(
+            # Only whether it succeeded is kept; the messages are already in the output sink
+            return bool(generate_conversation(
                 note,
-                output_file,
+                output_sink,
                 config,
-                use_openai,
-                use_claude,
-                use_groq,
-                use_gemini,
-                use_openrouter,
-            )
-            if conversation:
-                formatted_output = format_output(conversation)
-                conversations.append(formatted_output)
-                save_processed_note(processed_notes_file, note_path)
-                print(f"Processed note {note_path} and appended to processed_notes.txt")
-        except exceptions.ResourceExhausted as e:
+                rng=rng,
+                checkpoint=ConversationCheckpoint(state_store, chunk.note_path, chunk.checkpoint_index(i)),
+                shared_opening=shared_opening,
+            ))
+        except CredentialsExhausted as e:
+            # Checkpoints are kept, so the next run resumes this note where it stopped
             print(str(e))
-            print("Exhausted API key usage. Please try again later.")
-            return conversations
-    
-    print(f"Finished processing note: {note_path}")
-    return conversations
+            if not isinstance(e, BudgetExceeded):
+                print("Exhausted API key usage. Please try again later.")
+            return e
+
+    if config['conversation_generation'].get('variants', False) and num_conversations > 1:
+        shared_opening = SharedOpening()
+        rngs = [random.Random(rng.getrandbits(64)) if rng is not None else None for _ in range(num_conversations)]
+        with ThreadPoolExecutor(max_workers=num_conversations, thread_name_prefix="synthgen-variant") as executor:
+            futures = [executor.submit(generate, 0, rngs[0], shared_opening)]
+            # The other variants fork from the opening of the first
+            shared_opening.wait()
+            futures += [executor.submit(generate, i, rngs[i], shared_opening) for i in range(1, num_conversations)]
+            results = [future.result() for future in futures]
+    else:
+        results = []
+        for i in range(num_conversations):
+            results.append(generate(i, rng))
+            if isinstance(results[-1], CredentialsExhausted):
+                break
+
+    succeeded = any(result is True for result in results)
+    exhausted = any(isinstance(result, CredentialsExhausted) for result in results)
+    progress.finish(chunk, succeeded, exhausted)
+    return succeeded
 
-def main():
+def note_conversations(note_paths, config, use_claude, output_sink, progress):
     """
-    The main function to run the script.
+    Yield the conversations of every note chunk for the batch runner.
+
+    A note is marked as processed once all of its conversations have ended and
+    every chunk has one that succeeded, see NoteProgress.
+
+    Args:
+        note_paths (iterable): Note paths to process.
+        config (dict): Configuration settings.
+        use_claude (bool): Flag to use Claude.
+        output_sink (OutputSink): The sink receiving message records for the run.
+        progress (NoteProgress): Tracker marking each note as processed once its last conversation ends.
+
+    Yields:
+        tuple: A conversation step generator and the callback to call when it ends.
+    """
+    state_store = get_state_store(progress.processed_notes_file)
+    num_conversations = config['conversation_generation']['num_conversations']
+    concurrency = config.get('concurrency', {})
+    deterministic = concurrency.get('deterministic', False)
+    seed = concurrency.get('seed', 0)
+
+    variants = config['conversation_generation'].get('variants', False) and num_conversations > 1
+
+    for chunk in note_chunks(note_paths, config, progress, num_conversations):
+        def on_finish(conversation, error=None, chunk=chunk):
+            if isinstance(error, CredentialsExhausted):
+                # Checkpoints are kept, so the next run resumes this note where it stopped
+                print(str(error))
+            elif error is not None:
+                print(f"Error generating conversation for note {chunk.note_path}: {str(error)}")
+            progress.finish(chunk, error is None and bool(conversation), isinstance(error, CredentialsExhausted))
+
+        note = chunk.as_note()
+        # Variants queued together request their opening in the same batch, which sends it once
+        shared_opening = SharedOpening() if variants else None
+        for i in range(num_conversations):
+            rng = random.Random(f"{seed}:{chunk}#{i}") if deterministic else random.Random()
+            steps = generate_conversation_steps(note, output_sink, config, use_claude, rng, ConversationCheckpoint(state_store, chunk.note_path, chunk.checkpoint_index(i)), shared_opening)
+            yield steps, on_finish
+
+def generate_notes(notes, config, router, output_sink, progress):
     """
-    config = load_config('config.yaml')
-    processed_notes_file = 'processed_notes.txt'
-    processed_notes = load_processed_notes(processed_notes_file)
+    Generate the conversations of notes, with the batch runner or the note scheduler.
+
+    Args:
+        notes (iterable): Note paths to process.
+        config (dict): Configuration settings.
+        router (Router): The router requests are sent through.
+        output_sink (OutputSink): The sink receiving message records.
+        progress (NoteProgress): Tracker marking each note as processed once it ends.
+
+    Returns:
+        bool: Whether the run was stopped with Ctrl-C, leaving notes unstarted.
+    """
+    # Notes already started finish, but none is started once the budget says stop
+    notes = itertools.takewhile(lambda _: budget_governor.accepts_notes(), notes)
+    if config.get('batching', {}).get('enabled', False):
+        # Advance the conversations of many notes in lockstep, one batch per step
+        runner = create_batch_runner(config)
+        runner.run(note_conversations(notes, config, router.uses("claude"), output_sink, progress))
+        return runner.interrupted
+
+    def worker(chunk, rng):
+        if not budget_governor.accepts_notes():
+            # Queued before the budget stopped new notes; left unprocessed for the next run
+            progress.finish(chunk, False, exhausted=True)
+            return
+        process_chunk(chunk, config, progress.processed_notes_file, output_sink, progress, rng)
 
-    model_choice = input("Type the number of the model you wish to use: 1. OpenAI, 2. Claude, 3. Groq, 4. Gemini, 5. OpenRouter, 6. Local Model: ").strip()
+    # Process note chunks concurrently while discovery keeps filling the work queue
+    scheduler = create_scheduler(config, worker)
+    scheduler.run(note_chunks(notes, config, progress))
+    return scheduler.interrupted
+
+def run_worker(config, router, leases, worker_id, notes, run_suffix):
+    """
+    Claim shards of a distributed run and generate from their notes until no shard is left.
+
+    Each shard is written to its own output file, named after the round and the
+    shard, for the merge step. Ctrl-C stops the worker after the notes in flight;
+    a shard with notes left is released rather than completed. The lease is renewed while the shard is generated;
+    a worker that loses it stops queuing the shard's notes and does not complete it.
+
+    Args:
+        config (dict): The worker's configuration settings.
+        router (Router): The router requests are sent through.
+        leases (ShardLeases or CoordinatorClient): The leases of the round.
+        worker_id (str): The worker ID.
+        notes (list): Paths of the notes the worker's state store has not processed.
+        run_suffix (str): Suffix of the output file names, unique to this run of the worker.
+
+    Returns:
+        int: The number of notes processed.
+    """
+    vault_path = config['file_paths']['obsidian_vault_path']
+    lease_seconds = (config.get('distributed') or {}).get('lease_seconds', 300)
+    queued = {note_key(vault_path, path): path for path in notes}
+    processed = 0
+    while True:
+        claim = leases.claim(worker_id, lease_seconds)
+        if claim is None:
+            print("No shards left to claim.")
+            return processed
+        shard = claim['shard']
+        shard_notes = [queued[key] for key in claim['notes'] if key in queued]
+        print(f"Claimed shard {shard}: {len(shard_notes)} of its {len(claim['notes'])} notes to process")
+        budget_governor.plan(len(shard_notes))
+
+        keeper = LeaseKeeper(leases, shard, worker_id, lease_seconds)
+        output_sink = create_sink(config, f"{shard_run_name(claim['round'], shard)}_{run_suffix}")
+        progress = NoteProgress(config['file_paths']['state_store'])
+        try:
+            interrupted = generate_notes(itertools.takewhile(lambda _: not keeper.lost.is_set(), shard_notes), config, router, output_sink, progress)
+        finally:
+            keeper.stop()
+            output_sink.close()
+        processed += progress.processed
+
+        if interrupted and progress.processed < len(shard_notes):
+            # The notes left unstarted are generated by whichever worker claims the shard next
+            leases.release(shard, worker_id)
+            print(f"Released shard {shard}: interrupted.")
+            return processed
+
+        if progress.exhausted or not budget_governor.accepts_notes():
+            # Hand the shard over to a worker that still has API keys and budget
+            leases.release(shard, worker_id)
+            print(f"Released shard {shard}: {'API key usage' if budget_governor.accepts_notes() else 'budget'} exhausted.")
+            return processed
+        if not keeper.lost.is_set() and leases.complete(shard, worker_id):
+            print(f"Completed shard {shard}")
+        else:
+            print(f"Shard {shard} was taken over by another worker; its output from this worker will not be merged.")
+        if interrupted:
+            return processed
+
+def parse_args(argv=None):
+    """
+    Parse the command line.
+
+    Args:
+        argv (list, optional): The arguments. Defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Generate synthetic conversations from the notes of an Obsidian vault.")
+    parser.add_argument("--provider", action="append", choices=sorted(RESPONSE_GENERATORS),
+                        help="Provider to generate with, using the model of its section in the config. Repeat to route requests over "
+                             "several providers. Defaults to the backends in the 'routing' section of the config, or a prompt if it has none.")
+    parser.add_argument("--config", default="config.yaml", help="Path of the config file")
+    parser.add_argument("--non-interactive", action="store_true", help="Exit instead of prompting for a model when no provider is given")
+    parser.add_argument("--coordinator", help="Run as a worker of a distributed run: the lease database planned with 'python sharding.py plan', "
+                                              "or the URL of a coordinator started with 'python sharding.py serve'")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}",
+                        help="ID of the worker, unique among the workers of the run. Reuse it to resume a stopped worker from its checkpoints")
+    return parser.parse_args(argv)
+
+def select_providers(args, config):
+    """
+    Return the providers selected on the command line or at the prompt.
+
+    Args:
+        args (argparse.Namespace): The parsed command line.
+        config (dict): Configuration settings.
+
+    Returns:
+        list: The provider names, or None to route over the backends in the 'routing' section of the config.
+    """
+    if args.provider:
+        return args.provider
+    if (config.get('routing') or {}).get('backends'):
+        return None
+    if args.non_interactive:
+        raise SystemExit("No provider selected: pass --provider or add backends to the 'routing' section of the config.")
+    try:
+        model_choice = input("Type the number of the model you wish to use: 1. OpenAI, 2. Claude, 3. Groq, 4. Gemini, 5. OpenRouter, 6. Local Model: ").strip()
+    except EOFError:
+        raise SystemExit("No provider selected: pass --provider or add backends to the 'routing' section of the config.")
     print(f"User selected model choice: {model_choice}")
-    use_openai = model_choice == "1"
-    use_claude = model_choice == "2"
-    use_groq = model_choice == "3"
-    use_gemini = model_choice == "4"
-    use_openrouter = model_choice == "5"
-    use_local = model_choice == "6"
+    if model_choice not in MODEL_CHOICES:
+        raise SystemExit(f"Invalid model choice: {model_choice}")
+    return [MODEL_CHOICES[model_choice]]
+
+def main(argv=None):
+    """
+    The main function to run the script.
+
+    Args:
+        argv (list, optional): Command line arguments. Defaults to sys.argv[1:].
+    """
+    args = parse_args(argv)
+    config = load_config(args.config)
+    if args.coordinator:
+        # Each worker keeps its own state store and output, combined by 'python sharding.py merge'
+        config = worker_config(config, args.worker_id)
+        print(f"Running as worker {args.worker_id} of {args.coordinator}")
+    configure_providers(config)
+    configure_rate_limits(config)
+    configure_endpoint_pool(config)
+    processed_notes_file = config['file_paths'].get('state_store', 'synthgen_state.db')
+
+    router = configure_router(config, select_providers(args, config))
+    print(f"Routing requests to: {', '.join(str(backend) for backend in router.backends)}")
 
     print("Starting to process notes...")
-    
-    notes = []
-    for root, dirs, files in os.walk(config['file_paths']['obsidian_vault_path']):
-        for file in files:
-            if file.endswith(".md"):
-                note_path = os.path.join(root, file)
-                if note_path in processed_notes:
-                    print(f"\nSkipping already processed note: {note_path}")
-                    continue
-
-                notes.append(note_path)
 
-    try:
-        max_usage = config['gemini_details']['max_usage_per_key']  # Define max usage per key
-    except KeyError:
-        print("Error: 'max_usage_per_key' not found in 'gemini_details' section of the config file.")
+    # Only new notes and notes edited since they were processed are queued
+    start_time = time.perf_counter()
+    notes = VaultIndex(get_state_store(processed_notes_file)).refresh(config['file_paths']['obsidian_vault_path'])
+    print(f"Indexed vault in {time.perf_counter() - start_time:.2f}s: {len(notes)} notes to process")
+
+    # Spread requests over every API key in the environment, within each key's max_usage_per_key
+    configure_credentials(config, get_state_store(processed_notes_file))
+    # The ledger lives in the state store, so the budget holds across resumed runs,
+    # and with the leases for workers, so the workers of a round share one budget
+    leases = connect_coordinator(args.coordinator) if args.coordinator else None
+    configure_budget(config, leases or get_state_store(processed_notes_file))
+
+    # Generate a unique output file name based on the current date/time
+    current_datetime = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    configure_metrics(config, f"synthgen_{current_datetime}")
+
+    if leases is not None:
+        try:
+            processed = run_worker(config, router, leases, args.worker_id, notes, current_datetime)
+        finally:
+            leases.close()
+            request_metrics.close()
+            close_endpoint_pool()
+            close_providers()
+            close_response_cache()
+            close_state_stores()
+        print(f"Processed {processed} notes.")
+        run_stats.report()
+        request_metrics.report()
+        get_endpoint_pool().report()
+        budget_governor.report()
+        print("Script finished.")
         return
 
-    # Process notes sequentially
-    for note in notes:
-        process_note(note, config, use_openai, use_claude, use_groq, use_gemini, use_openrouter, processed_notes_file, max_usage)
+    output_sink = create_sink(config, f"synthgen_{current_datetime}")
+    print(f"Writing conversations to {output_sink.path}")
+    progress = NoteProgress(processed_notes_file)
+    budget_governor.plan(len(notes))
+    try:
+        generate_notes(notes, config, router, output_sink, progress)
+    finally:
+        output_sink.close()
+        request_metrics.close()
+        close_endpoint_pool()
+        close_providers()
+        close_response_cache()
+        close_state_stores()
+    print(f"Processed {progress.processed} notes.")
+    run_stats.report()
+    request_metrics.report()
+    get_endpoint_pool().report()
+    budget_governor.report()
+
+    if config.get('output', {}).get('export_json', False):
+        if os.path.isdir(output_sink.path):
+            print(f"export_json only applies to the jsonl sink; export the dataset with: python dataset_export.py {output_sink.path} --output <file>")
+        else:
+            print(f"Exported JSON output to {finalize_json_output(output_sink.path)}")
 
     print("Script finished.")
 
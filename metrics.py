@@ -0,0 +1,421 @@
+# metrics.py
+
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from history import count_tokens
+
+# The request being generated; context variables follow the call onto the provider event loop
+_current_request = contextvars.ContextVar('current_request', default=None)
+
+# Latency quantiles reported at the end of the run and exported to Prometheus
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Exported metric name, help text and column of the per-label rows built by prometheus_text()
+_PROMETHEUS_COUNTERS = (
+    ("synthgen_requests_total", "Generation requests, including failed ones.", 1),
+    ("synthgen_request_errors_total", "Generation requests that returned no response.", 2),
+    ("synthgen_request_retries_total", "Retried attempts of generation requests.", 3),
+    ("synthgen_prompt_tokens_total", "Prompt tokens sent.", 4),
+    ("synthgen_completion_tokens_total", "Completion tokens generated.", 5),
+)
+_PROMETHEUS_SUMMARIES = (
+    ("synthgen_request_duration_seconds", "Wall time of successful generation requests, including retries.", 6),
+    ("synthgen_time_to_first_byte_seconds", "Time to the first byte of the response of successful generation requests.", 7),
+)
+
+class RequestMetrics:
+    """
+    Measurements of one generation request, including its retries.
+    """
+
+    def __init__(self, provider, model_id, response_type):
+        """
+        Initialize the measurements and start the clock.
+
+        Args:
+            provider (str): The provider name.
+            model_id (str): The model ID.
+            response_type (str): The type of response requested.
+        """
+        self.provider = provider
+        self.model_id = model_id
+        self.response_type = response_type
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.attempt_start = self.start
+        self.wall_seconds = None
+        self.first_byte_seconds = None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.estimated_prompt_tokens = None
+        self.token_source = None
+        self.retries = 0
+        self.error = None
+        self.response = None
+
+    @property
+    def label(self):
+        return (self.provider, self.model_id or "", self.response_type or "default")
+
+    def finish(self, response):
+        """
+        Stop the clock and fill in the token counts the provider did not report.
+
+        Args:
+            response (str): The generated response, None if generation failed.
+        """
+        self.wall_seconds = time.perf_counter() - self.start
+        if response is None and self.error is None:
+            self.error = "NoResponse"
+        if self.prompt_tokens is not None and self.completion_tokens is not None:
+            self.token_source = "usage"
+            return
+        self.token_source = "tokenizer"
+        if self.prompt_tokens is None:
+            self.prompt_tokens = self.estimated_prompt_tokens or 0
+        if self.completion_tokens is None:
+            self.completion_tokens = count_tokens(response) if response else 0
+
+    def to_record(self):
+        """
+        Return the measurements as a JSON-serializable record.
+
+        Returns:
+            dict: The record.
+        """
+        return {
+            "timestamp": self.timestamp,
+            "provider": self.provider,
+            "model_id": self.model_id,
+            "response_type": self.response_type,
+            "wall_seconds": self.wall_seconds,
+            "first_byte_seconds": self.first_byte_seconds,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "token_source": self.token_source,
+            "retries": self.retries,
+            "error": self.error,
+        }
+
+@contextmanager
+def track_request(provider, model_id, response_type):
+    """
+    Measure a generation request and record it when the block exits.
+
+    Assign the response to the yielded object's 'response' attribute; a request
+    that ends without one (or raises) is recorded as an error.
+
+    Args:
+        provider (str): The provider name.
+        model_id (str): The model ID.
+        response_type (str): The type of response requested.
+
+    Yields:
+        RequestMetrics: The measurements of the request.
+    """
+    request = RequestMetrics(provider, model_id, response_type)
+    token = _current_request.set(request)
+    try:
+        yield request
+    except BaseException as e:
+        request.error = request.error or type(e).__name__
+        raise
+    finally:
+        _current_request.reset(token)
+        request.finish(request.response)
+        request_metrics.record(request)
+
+def start_attempt(estimated_prompt_tokens=None):
+    """
+    Record that an attempt of the current request is being sent.
+
+    Args:
+        estimated_prompt_tokens (int, optional): Tokenizer estimate of the prompt, used when the provider reports no usage.
+    """
+    request = _current_request.get()
+    if request is not None:
+        request.attempt_start = time.perf_counter()
+        if estimated_prompt_tokens is not None:
+            request.estimated_prompt_tokens = estimated_prompt_tokens
+
+def record_retry():
+    """
+    Record that an attempt of the current request failed and will be retried.
+    """
+    request = _current_request.get()
+    if request is not None:
+        request.retries += 1
+        request.error = None
+
+def record_error(error):
+    """
+    Record the error that ended the current request.
+
+    Args:
+        error (Exception): The error.
+    """
+    request = _current_request.get()
+    if request is not None:
+        request.error = type(error).__name__
+
+def mark_first_byte():
+    """
+    Record the time to first byte of the current request's attempt, if not yet recorded.
+    """
+    request = _current_request.get()
+    if request is not None and request.first_byte_seconds is None:
+        request.first_byte_seconds = time.perf_counter() - request.attempt_start
+
+def record_usage(prompt_tokens=None, completion_tokens=None):
+    """
+    Record the token counts reported by the provider for the current request.
+
+    Args:
+        prompt_tokens (int, optional): Prompt tokens, including any served from a prompt cache.
+        completion_tokens (int, optional): Generated tokens.
+    """
+    request = _current_request.get()
+    if request is None:
+        return
+    if prompt_tokens is not None:
+        request.prompt_tokens = prompt_tokens
+    if completion_tokens is not None:
+        request.completion_tokens = completion_tokens
+
+def percentile(sorted_values, quantile):
+    """
+    Return a quantile of sorted values by the nearest-rank method.
+
+    Args:
+        sorted_values (list): The values, in ascending order.
+        quantile (float): The quantile, between 0 and 1.
+
+    Returns:
+        float: The value, None if there are no values.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(quantile * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+class _LabelMetrics:
+    """
+    Aggregated measurements of the requests sharing a provider, model and response type.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.wall_seconds = []
+        self.first_byte_seconds = []
+
+class MetricsCollector:
+    """
+    Thread-safe collector of per-request metrics.
+
+    Every request is appended to a JSON Lines metrics file as it finishes, the
+    aggregates can be scraped in Prometheus text format while the run is going,
+    and report() prints throughput and latency percentiles per provider, model
+    and response type.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._labels = defaultdict(_LabelMetrics)
+        self._file = None
+        self._server = None
+        self.path = None
+        self.enabled = True
+        self.first_start = None
+        self.last_end = None
+
+    def configure(self, config, run_name):
+        """
+        Apply the 'metrics' section of the config: open the metrics file and start the Prometheus endpoint.
+
+        Args:
+            config (dict): Configuration settings.
+            run_name (str): Base name of the run's output files.
+        """
+        metrics_config = config.get('metrics') or {}
+        self.close()
+        with self._lock:
+            self._labels.clear()
+            self.first_start = self.last_end = None
+            self.enabled = metrics_config.get('enabled', True)
+            if not self.enabled:
+                return
+            if metrics_config.get('write_file', True):
+                directory = (config.get('output') or {}).get('directory', 'synth_conversations')
+                os.makedirs(directory, exist_ok=True)
+                self.path = os.path.join(directory, f"{run_name}.metrics.jsonl")
+                self._file = open(self.path, 'a', encoding='utf-8')
+        port = metrics_config.get('prometheus_port')
+        if port:
+            self.start_server(metrics_config.get('prometheus_host', '127.0.0.1'), port)
+
+    def record(self, request):
+        """
+        Add a finished request.
+
+        Args:
+            request (RequestMetrics): The measurements of the request.
+        """
+        if not self.enabled:
+            return
+        line = json.dumps(request.to_record(), ensure_ascii=False) + "\n"
+        with self._lock:
+            label = self._labels[request.label]
+            label.requests += 1
+            label.retries += request.retries
+            label.prompt_tokens += request.prompt_tokens or 0
+            label.completion_tokens += request.completion_tokens or 0
+            if request.error is not None:
+                label.errors += 1
+            else:
+                label.wall_seconds.append(request.wall_seconds)
+                if request.first_byte_seconds is not None:
+                    label.first_byte_seconds.append(request.first_byte_seconds)
+            end = request.start + request.wall_seconds
+            self.first_start = request.start if self.first_start is None else min(self.first_start, request.start)
+            self.last_end = end if self.last_end is None else max(self.last_end, end)
+            if self._file is not None:
+                self._file.write(line)
+
+    def prometheus_text(self):
+        """
+        Render the aggregated metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics.
+        """
+        with self._lock:
+            rows = [
+                (_prometheus_labels(key), label.requests, label.errors, label.retries, label.prompt_tokens, label.completion_tokens, sorted(label.wall_seconds), sorted(label.first_byte_seconds))
+                for key, label in sorted(self._labels.items())
+            ]
+        lines = []
+        for name, help_text, index in _PROMETHEUS_COUNTERS:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{{{row[0]}}} {row[index]}" for row in rows)
+        for name, help_text, index in _PROMETHEUS_SUMMARIES:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} summary")
+            for row in rows:
+                observations = row[index]
+                for quantile in QUANTILES:
+                    value = percentile(observations, quantile)
+                    lines.append(f'{name}{{{row[0]},quantile="{quantile}"}} {value if value is not None else "NaN"}')
+                lines.append(f"{name}_sum{{{row[0]}}} {sum(observations)}")
+                lines.append(f"{name}_count{{{row[0]}}} {len(observations)}")
+        return "\n".join(lines) + "\n"
+
+    def start_server(self, host, port):
+        """
+        Serve the metrics at /metrics in the Prometheus text format from a background thread.
+
+        Args:
+            host (str): The address to listen on.
+            port (int): The port to listen on.
+        """
+        collector = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = collector.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            print(f"Error starting the metrics endpoint on {host}:{port}: {str(e)}")
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="synthgen-metrics", daemon=True).start()
+        print(f"Serving metrics at http://{host}:{port}/metrics")
+
+    def report(self):
+        """
+        Print throughput and latency percentiles per provider, model and response type.
+        """
+        with self._lock:
+            labels = sorted(self._labels.items())
+            elapsed = self.last_end - self.first_start if self.first_start is not None else 0
+        if not labels:
+            return
+
+        total_requests = sum(label.requests for _, label in labels)
+        total_completion_tokens = sum(label.completion_tokens for _, label in labels)
+        total_seconds = sum(sum(label.wall_seconds) for _, label in labels)
+        print("\nRequest metrics:")
+        if elapsed:
+            print(f"  Throughput: {total_requests / elapsed:,.2f} requests/s, {total_completion_tokens / elapsed:,.1f} completion tokens/s over {elapsed:,.1f}s")
+        for (provider, model_id, response_type), label in labels:
+            print(f"  {provider} {model_id} {response_type}: {label.requests} requests, {label.errors} errors, {label.retries} retries")
+            wall_seconds = sorted(label.wall_seconds)
+            if wall_seconds:
+                latencies = ", ".join(f"p{int(quantile * 100)} {percentile(wall_seconds, quantile):,.2f}s" for quantile in QUANTILES)
+                share = f", {sum(wall_seconds) / total_seconds:.1%} of request time" if total_seconds else ""
+                print(f"    latency {latencies}{share}")
+            first_byte_seconds = sorted(label.first_byte_seconds)
+            if first_byte_seconds:
+                print(f"    time to first byte p50 {percentile(first_byte_seconds, 0.5) * 1000:,.0f} ms, p95 {percentile(first_byte_seconds, 0.95) * 1000:,.0f} ms")
+            print(f"    tokens: {label.prompt_tokens:,} prompt, {label.completion_tokens:,} completion")
+        if self.path:
+            print(f"  Per-request metrics written to {self.path}")
+
+    def close(self):
+        """
+        Close the metrics file and stop the Prometheus endpoint.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+def _prometheus_labels(key):
+    provider, model_id, response_type = key
+    values = {"provider": provider, "model_id": model_id, "response_type": response_type}
+    return ",".join(f'{name}="{_escape_label(value)}"' for name, value in values.items())
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Shared by every worker thread of the process
+request_metrics = MetricsCollector()
+
+def configure_metrics(config, run_name):
+    """
+    Apply the metrics settings of the config to the shared collector.
+
+    Args:
+        config (dict): Configuration settings.
+        run_name (str): Base name of the run's output files.
+    """
+    request_metrics.configure(config, run_name)
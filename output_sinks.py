@@ -0,0 +1,517 @@
+# output_sinks.py
+
+import gzip
+import json
+import os
+import sys
+import threading
+
+# zstd shards need the optional zstandard package (pip install zstandard)
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    zstandard = None
+    ZSTD_AVAILABLE = False
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# File extension of the shards of each compression
+SHARD_EXTENSIONS = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst", "none": ".jsonl"}
+
+class OutputSink:
+    """
+    Base class for conversation output sinks.
+
+    A sink receives one message record at a time and is told when a conversation
+    ends, so backends can decide when data must be durable on disk.
+    """
+
+    path = None
+
+    def write(self, record):
+        """
+        Write a single message record.
+
+        Args:
+            record (dict): The message record to write.
+        """
+        raise NotImplementedError
+
+    def write_partial(self, record):
+        """
+        Write a piece of a response that is still being streamed.
+
+        Sinks that do not keep partial output ignore it.
+
+        Args:
+            record (dict): The partial record, holding the text received so far in 'delta'.
+        """
+
+    def end_conversation(self, conversation_id):
+        """
+        Mark the end of a conversation.
+
+        Args:
+            conversation_id (str): The ID of the conversation that ended.
+        """
+
+    def sync(self):
+        """
+        Make every record written so far durable, for example before a checkpoint is saved.
+        """
+
+    def close(self):
+        """
+        Flush and release any resources held by the sink.
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+class JSONLSink(OutputSink):
+    """
+    Append-only JSON Lines sink.
+
+    The file stays open for the whole run. Records are buffered and the file is
+    flushed and fsynced at every conversation boundary, so the cost per message
+    is constant and a crash can only lose the conversation in progress. Writes
+    are serialized with a lock, so one sink can be shared by worker threads.
+
+    With partials enabled, streamed text is also appended to a .partial.jsonl
+    file next to the output as it arrives, so long generations can be watched
+    and inspected before they finish.
+    """
+
+    def __init__(self, path, buffer_size=65536, fsync=True, partials=False):
+        """
+        Open a JSON Lines sink.
+
+        Args:
+            path (str): Path to the .jsonl output file.
+            buffer_size (int): Size of the write buffer in bytes.
+            fsync (bool): Whether to fsync the file at conversation boundaries.
+            partials (bool): Whether to keep streamed partial output in a .partial.jsonl file.
+        """
+        self.path = path
+        self.fsync = fsync
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8', buffering=buffer_size)
+        self._partial_file = None
+        if partials:
+            self.partial_path = os.path.splitext(path)[0] + ".partial.jsonl"
+            self._partial_file = open(self.partial_path, 'a', encoding='utf-8', buffering=buffer_size)
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def write_partial(self, record):
+        if self._partial_file is None:
+            return
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._partial_file.write(line)
+
+    def end_conversation(self, conversation_id):
+        self.sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync()
+            self._file.close()
+            if self._partial_file is not None:
+                self._partial_file.close()
+
+    def _sync(self):
+        if self._partial_file is not None:
+            self._partial_file.flush()
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+class TurnBuffer(OutputSink):
+    """
+    Hold the records of a checkpointed conversation until their turn is saved.
+
+    A conversation stopped in the middle of a turn resumes at the start of that
+    turn, so records written before it stopped would be generated and written
+    again. Records are kept here until the turn's checkpoint syncs the sink, and
+    the records of an unfinished turn are dropped when the conversation ends.
+    Partial records go straight through.
+    """
+
+    def __init__(self, output_sink):
+        """
+        Initialize the buffer.
+
+        Args:
+            output_sink (OutputSink): The sink the records are written to once their turn is saved.
+        """
+        self.output_sink = output_sink
+        self.path = output_sink.path
+        self._records = []
+
+    def write(self, record):
+        self._records.append(record)
+
+    def write_partial(self, record):
+        self.output_sink.write_partial(record)
+
+    def commit(self):
+        """
+        Write the held records to the sink, for a turn that was saved or that ends the conversation.
+        """
+        for record in self._records:
+            self.output_sink.write(record)
+        self._records = []
+
+    def sync(self):
+        self.commit()
+        self.output_sink.sync()
+
+    def end_conversation(self, conversation_id):
+        self._records = []
+        self.output_sink.end_conversation(conversation_id)
+
+def compress_frame(data, compression, level=None):
+    """
+    Compress one frame of a dataset shard.
+
+    Args:
+        data (bytes): The frame content.
+        compression (str): "gzip", "zstd" or "none".
+        level (int, optional): Compression level. Defaults to the codec's default.
+
+    Returns:
+        bytes: A complete gzip member or zstd frame, which can be decompressed on its own.
+    """
+    if compression == "gzip":
+        # mtime=0 keeps identical conversations byte-identical
+        return gzip.compress(data, compresslevel=9 if level is None else level, mtime=0)
+    if compression == "zstd":
+        if not ZSTD_AVAILABLE:
+            raise ValueError("zstd compression needs the zstandard package: pip install zstandard")
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    if compression == "none":
+        return data
+    raise ValueError(f"Unknown compression: {compression}")
+
+def decompress_frame(data, compression):
+    """
+    Decompress one frame of a dataset shard.
+
+    Args:
+        data (bytes): The frame, as written by compress_frame().
+        compression (str): "gzip", "zstd" or "none".
+
+    Returns:
+        bytes: The frame content.
+    """
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        if not ZSTD_AVAILABLE:
+            raise ValueError("zstd compression needs the zstandard package: pip install zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == "none":
+        return data
+    raise ValueError(f"Unknown compression: {compression}")
+
+class DatasetSink(OutputSink):
+    """
+    Dataset of compressed shards, written one conversation at a time, with a manifest.
+
+    Records are grouped by conversation as they arrive. When a conversation ends,
+    its records are compressed into one frame (a gzip member or a zstd frame)
+    appended to the current shard, and a line of manifest.jsonl records the
+    shard, offset and length of the frame. Concatenated frames are a valid
+    .gz or .zst file, so shards can be read with the standard tools, and a
+    conversation is read back with a single seek (see dataset_export.py).
+    Shards rotate once they reach max_shard_bytes or max_shard_records, and
+    every run writing to the dataset starts a new shard.
+
+    Records of conversations still in progress are appended to a journal
+    (pending.jsonl), which is what sync() makes durable, so a checkpoint never
+    covers records that are not on disk. Conversations still open when the sink
+    closes or the run stops stay in the journal, and the next run writing to the
+    dataset carries them on, so a resumed conversation still ends up in one frame.
+    One run writes to a dataset at a time.
+    """
+
+    def __init__(self, path, run_name, compression="gzip", level=None, max_shard_bytes=256 * 1024 * 1024, max_shard_records=None,
+                 buffer_size=65536, fsync=True, partials=False):
+        """
+        Open (or create) a dataset.
+
+        Args:
+            path (str): Directory of the dataset.
+            run_name (str): Name of the run, recorded in the manifest with each conversation.
+            compression (str): "gzip", "zstd" or "none".
+            level (int, optional): Compression level.
+            max_shard_bytes (int): Size at which a shard is closed and a new one started.
+            max_shard_records (int, optional): Number of records at which a shard is closed and a new one started.
+            buffer_size (int): Size of the journal's write buffer in bytes.
+            fsync (bool): Whether to fsync shards, the manifest and the journal when they are written or synced.
+            partials (bool): Whether to keep streamed partial output in a <run_name>.partial.jsonl file.
+        """
+        if compression not in SHARD_EXTENSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+        if compression == "zstd" and not ZSTD_AVAILABLE:
+            raise ValueError("zstd compression needs the zstandard package: pip install zstandard")
+        self.path = path
+        self.run_name = run_name
+        self.compression = compression
+        self.level = level
+        self.max_shard_bytes = max_shard_bytes
+        self.max_shard_records = max_shard_records
+        self.fsync = fsync
+        self._buffer_size = buffer_size
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        self._lock_file = open(os.path.join(path, ".lock"), 'w')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                raise ValueError(f"Another run is writing to the dataset {path}")
+
+        self._manifest_path = os.path.join(path, "manifest.jsonl")
+        self._journal_path = os.path.join(path, "pending.jsonl")
+        numbers = [int(name[5:10]) for name in os.listdir(path) if name.startswith("part-") and name[5:10].isdigit()]
+        self._next_shard = max(numbers, default=-1) + 1
+        self._shard = None
+        self._shard_name = None
+        self._shard_records = 0
+
+        # Carry over the conversations a previous run left open
+        self._pending = {}
+        if os.path.exists(self._journal_path):
+            written = set()
+            if os.path.exists(self._manifest_path):
+                written = {entry['conversation_id'] for entry in iter_jsonl_records(self._manifest_path)}
+            with open(self._journal_path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        conversation_id = json.loads(line)['conversation_id']
+                    except (json.JSONDecodeError, KeyError):
+                        # A line cut off by a crash
+                        continue
+                    if conversation_id not in written:
+                        self._pending.setdefault(conversation_id, []).append(line)
+            if self._pending:
+                print(f"Carried over {len(self._pending)} unfinished conversations from {self._journal_path}")
+        self._pending_bytes = sum(len(line) for lines in self._pending.values() for line in lines)
+        self._compact_journal()
+
+        self._manifest = open(self._manifest_path, 'a', encoding='utf-8')
+        self._partial_file = None
+        if partials:
+            self.partial_path = os.path.join(path, f"{run_name}.partial.jsonl")
+            self._partial_file = open(self.partial_path, 'a', encoding='utf-8', buffering=buffer_size)
+
+    def _compact_journal(self):
+        # Rewrite the journal with the records of open conversations only
+        tmp_path = self._journal_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            for lines in self._pending.values():
+                file.writelines(lines)
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+        os.replace(tmp_path, self._journal_path)
+        self._journal = open(self._journal_path, 'a', encoding='utf-8', buffering=self._buffer_size)
+        self._journal_bytes = self._pending_bytes
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._journal.write(line)
+            self._journal_bytes += len(line)
+            self._pending.setdefault(record['conversation_id'], []).append(line)
+            self._pending_bytes += len(line)
+
+    def write_partial(self, record):
+        if self._partial_file is None:
+            return
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._partial_file.write(line)
+
+    def end_conversation(self, conversation_id):
+        with self._lock:
+            lines = self._pending.pop(conversation_id, None)
+            if not lines:
+                return
+            self._pending_bytes -= sum(len(line) for line in lines)
+            frame = compress_frame("".join(lines).encode('utf-8'), self.compression, self.level)
+            if self._shard is not None and (self._shard.tell() >= self.max_shard_bytes or (self.max_shard_records and self._shard_records >= self.max_shard_records)):
+                self._close_shard()
+            if self._shard is None:
+                self._shard_name = f"part-{self._next_shard:05d}{SHARD_EXTENSIONS[self.compression]}"
+                self._next_shard += 1
+                self._shard = open(os.path.join(self.path, self._shard_name), 'ab')
+                self._shard_records = 0
+            offset = self._shard.tell()
+            self._shard.write(frame)
+            self._shard.flush()
+            if self.fsync:
+                os.fsync(self._shard.fileno())
+            self._shard_records += len(lines)
+            # The manifest line goes last, so it never points at a frame that is not on disk
+            entry = {"conversation_id": conversation_id, "shard": self._shard_name, "offset": offset, "length": len(frame), "records": len(lines), "run": self.run_name}
+            self._manifest.write(json.dumps(entry) + "\n")
+            self._manifest.flush()
+            if self.fsync:
+                os.fsync(self._manifest.fileno())
+            # Keep the journal from growing with conversations that are already in a shard
+            if self._journal_bytes > max(4 * self._pending_bytes, 16 * 1024 * 1024):
+                self._journal.close()
+                self._compact_journal()
+
+    def _close_shard(self):
+        self._shard.close()
+        self._shard = None
+
+    def sync(self):
+        with self._lock:
+            if self._partial_file is not None:
+                self._partial_file.flush()
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._journal.closed:
+                return
+            self._journal.close()
+            self._compact_journal()
+            self._journal.close()
+            if not self._pending:
+                os.remove(self._journal_path)
+            if self._shard is not None:
+                self._close_shard()
+            self._manifest.close()
+            if self._partial_file is not None:
+                self._partial_file.close()
+            self._lock_file.close()
+
+SINK_BACKENDS = {
+    "jsonl": (JSONLSink, ".jsonl"),
+    "dataset": (DatasetSink, ""),
+}
+
+def create_sink(config, run_name):
+    """
+    Create the output sink configured in the 'output' section of the config.
+
+    Args:
+        config (dict): Configuration settings.
+        run_name (str): Base name of the output file (without extension).
+
+    Returns:
+        OutputSink: The opened output sink.
+    """
+    output_config = config.get('output', {})
+    backend = output_config.get('sink', 'jsonl')
+    if backend not in SINK_BACKENDS:
+        raise ValueError(f"Unknown output sink: {backend}")
+
+    sink_class, extension = SINK_BACKENDS[backend]
+    if sink_class is DatasetSink:
+        # Every run adds its shards to the same dataset
+        return DatasetSink(
+            os.path.join(output_config.get('directory', 'synth_conversations'), output_config.get('dataset', 'dataset')),
+            run_name,
+            compression=output_config.get('compression', 'gzip'),
+            level=output_config.get('compression_level'),
+            max_shard_bytes=output_config.get('max_shard_mb', 256) * 1024 * 1024,
+            max_shard_records=output_config.get('max_shard_records'),
+            buffer_size=output_config.get('buffer_size', 65536),
+            fsync=output_config.get('fsync', True),
+            partials=output_config.get('write_partials', False),
+        )
+    path = os.path.join(output_config.get('directory', 'synth_conversations'), f"{run_name}{extension}")
+    return sink_class(
+        path,
+        buffer_size=output_config.get('buffer_size', 65536),
+        fsync=output_config.get('fsync', True),
+        partials=output_config.get('write_partials', False),
+    )
+
+def iter_jsonl_records(jsonl_path):
+    """
+    Iterate over the records of a JSON Lines file.
+
+    A truncated last line (for example after a crash mid-write) is skipped.
+
+    Args:
+        jsonl_path (str): Path to the .jsonl file.
+
+    Yields:
+        dict: Each record in the file.
+    """
+    with open(jsonl_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping malformed line in {jsonl_path}")
+
+def export_jsonl_to_json(jsonl_path, json_path=None):
+    """
+    Compact a JSON Lines file into the JSON array format used by downstream tools.
+
+    The output matches json.dump(records, f, indent=4) and is written record by
+    record, so memory use does not grow with the size of the input.
+
+    Args:
+        jsonl_path (str): Path to the .jsonl file.
+        json_path (str, optional): Path to the output .json file. Defaults to the input path with a .json extension.
+
+    Returns:
+        str: The path of the exported JSON file.
+    """
+    if json_path is None:
+        json_path = os.path.splitext(jsonl_path)[0] + ".json"
+
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as out:
+        out.write("[")
+        first = True
+        for record in iter_jsonl_records(jsonl_path):
+            out.write("\n" if first else ",\n")
+            first = False
+            out.write("\n".join("    " + line for line in json.dumps(record, indent=4).split("\n")))
+        out.write("]" if first else "\n]")
+    os.replace(tmp_path, json_path)
+    return json_path
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python output_sinks.py <input.jsonl> [output.json]")
+        sys.exit(1)
+    print(f"Exported to {export_jsonl_to_json(*sys.argv[1:])}")
@@ -0,0 +1,479 @@
+# providers.py
+
+import asyncio
+import importlib
+import json
+import os
+import threading
+import time
+import httpx
+from dotenv import load_dotenv
+from stats import run_stats
+from history import count_tokens
+from metrics import mark_first_byte, record_usage
+
+# Load environment variables from a .env file
+load_dotenv()
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Connection pool settings shared by every provider, see configure_providers()
+pool_settings = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30.0,
+    "http2": True,
+    "timeout": 600.0,
+}
+
+# Provider-side prompt caching, see configure_providers()
+prompt_cache_settings = {
+    "enabled": False,
+}
+
+def record_prompt_cache(cached_tokens, written_tokens=0):
+    """
+    Record whether a request reused a cached prompt prefix.
+
+    Args:
+        cached_tokens (int): Prompt tokens served from the provider's cache.
+        written_tokens (int): Prompt tokens written to the provider's cache.
+    """
+    run_stats.add('prompt_cache_hits' if cached_tokens else 'prompt_cache_misses')
+    run_stats.add('prompt_cache_read_tokens', cached_tokens or 0)
+    if written_tokens:
+        run_stats.add('prompt_cache_write_tokens', written_tokens)
+
+class StreamOptions:
+    """
+    Options for a streamed request: where partial output goes and when to stop early.
+    """
+
+    def __init__(self, response_type=None, on_delta=None, stop_condition=None, max_chars=None):
+        """
+        Initialize the options.
+
+        Args:
+            response_type (str, optional): The response type, used to label throughput stats.
+            on_delta (callable, optional): Called with each piece of text as it arrives.
+            stop_condition (object, optional): Object whose feed(delta) returns True once the response is complete.
+            max_chars (int, optional): Stop once the response reaches this many characters.
+        """
+        self.response_type = response_type
+        self.on_delta = on_delta
+        self.stop_condition = stop_condition
+        self.max_chars = max_chars
+
+async def consume_stream(deltas, stream_options):
+    """
+    Collect a stream of text deltas, applying the stop conditions and recording throughput.
+
+    Time to first token, generation time and completion tokens are added to the
+    run stats under the response type.
+
+    Args:
+        deltas (async iterator): The text deltas of the response.
+        stream_options (StreamOptions): The streaming options.
+
+    Returns:
+        str: The collected response.
+    """
+    start = time.perf_counter()
+    first_token_time = None
+    parts = []
+    length = 0
+    try:
+        async for delta in deltas:
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+                mark_first_byte()
+            parts.append(delta)
+            length += len(delta)
+            if stream_options.on_delta is not None:
+                stream_options.on_delta(delta)
+            if stream_options.stop_condition is not None and stream_options.stop_condition.feed(delta):
+                run_stats.add('stream_stopped_complete')
+                break
+            if stream_options.max_chars and length >= stream_options.max_chars:
+                run_stats.add('stream_stopped_max_chars')
+                break
+    finally:
+        # Closing the generator closes the HTTP response, which tells the server to stop generating
+        await deltas.aclose()
+
+    text = "".join(parts)
+    if first_token_time is not None:
+        label = stream_options.response_type or "default"
+        end = time.perf_counter()
+        run_stats.add(f"stream_responses:{label}")
+        run_stats.add(f"stream_ttft_seconds:{label}", first_token_time - start)
+        run_stats.add(f"stream_generation_seconds:{label}", end - first_token_time)
+        run_stats.add(f"stream_completion_tokens:{label}", count_tokens(text))
+    return text
+
+class AsyncProvider:
+    """
+    Base class for async chat providers holding one long-lived pooled client.
+    """
+
+    name = None
+
+    async def generate(self, messages, model_id, temperature, max_tokens, system_prompt=None):
+        """
+        Generate a chat completion.
+
+        Args:
+            messages (list): Chat messages, each a dict with 'role' and 'content'.
+            model_id (str): The model ID.
+            temperature (float): Sampling temperature.
+            max_tokens (int): Maximum number of tokens to generate.
+            system_prompt (str, optional): Static system prompt sent ahead of the messages.
+
+        Returns:
+            str: The generated response.
+        """
+        raise NotImplementedError
+
+    async def generate_stream(self, messages, model_id, temperature, max_tokens, system_prompt=None, stream_options=None):
+        """
+        Generate a chat completion, streaming the response as it is produced.
+
+        Providers without streaming support generate the whole response and pass it on in one piece.
+
+        Args:
+            messages (list): Chat messages, each a dict with 'role' and 'content'.
+            model_id (str): The model ID.
+            temperature (float): Sampling temperature.
+            max_tokens (int): Maximum number of tokens to generate.
+            system_prompt (str, optional): Static system prompt sent ahead of the messages.
+            stream_options (StreamOptions, optional): Partial output handler and stop conditions.
+
+        Returns:
+            str: The generated response.
+        """
+        response = await self.generate(messages, model_id, temperature, max_tokens, system_prompt)
+        if stream_options is not None and stream_options.on_delta is not None:
+            stream_options.on_delta(response)
+        return response
+
+    async def aclose(self):
+        """
+        Close the underlying client and its connections.
+        """
+
+async def _on_response_headers(response):
+    # Called by httpx once the status line and headers arrive, before the body is read
+    if response.status_code < 400:
+        mark_first_byte()
+
+class OpenAICompatibleProvider(AsyncProvider):
+    """
+    Provider for any OpenAI-compatible chat completions endpoint (OpenAI, Groq, LM Studio, llama.cpp, vLLM).
+
+    All requests share one httpx.AsyncClient, so connections are kept alive and
+    reused (over HTTP/2 when available) instead of paying for TCP and TLS setup
+    on every turn.
+    """
+
+    def __init__(self, name, url, api_key=None, supports_cache_prompt=False):
+        """
+        Initialize the provider.
+
+        Args:
+            name (str): The provider name.
+            url (str): Full URL of the chat completions endpoint.
+            api_key (str, optional): Bearer token sent with every request.
+            supports_cache_prompt (bool): Whether the server accepts llama.cpp's 'cache_prompt' option.
+        """
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.supports_cache_prompt = supports_cache_prompt
+        self._client = None
+
+    def _get_client(self):
+        # Created on first use so the client is bound to the provider event loop
+        if self._client is None:
+            headers = {"Content-Type": "application/json"}
+            if self.api_key:
+                headers["Authorization"] = f"Bearer {self.api_key}"
+            self._client = httpx.AsyncClient(
+                headers=headers,
+                event_hooks={"response": [_on_response_headers]},
+                http2=pool_settings["http2"] and HTTP2_AVAILABLE,
+                timeout=pool_settings["timeout"],
+                limits=httpx.Limits(
+                    max_connections=pool_settings["max_connections"],
+                    max_keepalive_connections=pool_settings["max_keepalive_connections"],
+                    keepalive_expiry=pool_settings["keepalive_expiry"],
+                ),
+            )
+        return self._client
+
+    def build_payload(self, messages, model_id, temperature, max_tokens, system_prompt=None):
+        """
+        Build the JSON body of a chat completions request.
+
+        The system prompt goes first and is passed through unchanged, so every
+        request for a step shares a byte-identical prefix that servers can cache.
+
+        Args:
+            messages (list): Chat messages.
+            model_id (str): The model ID.
+            temperature (float): Sampling temperature.
+            max_tokens (int): Maximum number of tokens to generate.
+            system_prompt (str, optional): Static system prompt sent ahead of the messages.
+
+        Returns:
+            dict: The request body.
+        """
+        if system_prompt:
+            messages = [{"role": "system", "content": system_prompt}] + messages
+        payload = {
+            "model": model_id,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": False,
+        }
+        if self.supports_cache_prompt and prompt_cache_settings["enabled"]:
+            # llama.cpp/LM Studio: reuse the KV cache of the longest matching prefix
+            payload["cache_prompt"] = True
+        return payload
+
+    async def post(self, payload):
+        """
+        Send a chat completions request and return the decoded JSON response.
+
+        Args:
+            payload (dict): The request body.
+
+        Returns:
+            dict: The response data.
+        """
+        response = await self._get_client().post(self.url, json=payload)
+        response.raise_for_status()
+        response_data = response.json()
+        self._record_usage(response_data)
+        return response_data
+
+    def _record_usage(self, response_data):
+        usage = response_data.get('usage') or {}
+        record_usage(usage.get('prompt_tokens'), usage.get('completion_tokens'))
+        details = usage.get('prompt_tokens_details') or {}
+        timings = response_data.get('timings') or {}
+        if 'cached_tokens' in details:
+            # OpenAI automatic prefix caching
+            record_prompt_cache(details['cached_tokens'])
+        elif 'cache_n' in timings:
+            # llama.cpp server
+            record_prompt_cache(timings['cache_n'])
+        elif 'tokens_cached' in response_data:
+            # Older llama.cpp server
+            record_prompt_cache(response_data['tokens_cached'])
+
+    async def stream(self, payload):
+        """
+        Send a streaming chat completions request and yield the content deltas of its server-sent events.
+
+        Args:
+            payload (dict): The request body.
+
+        Yields:
+            str: Each piece of generated text.
+        """
+        # Ask for a final chunk carrying the token usage
+        payload = dict(payload, stream=True, stream_options={"include_usage": True})
+        async with self._get_client().stream("POST", self.url, json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if chunk.get('usage'):
+                    self._record_usage(chunk)
+                choices = chunk.get('choices') or []
+                if choices:
+                    delta = (choices[0].get('delta') or {}).get('content')
+                    if delta:
+                        yield delta
+
+    async def generate(self, messages, model_id, temperature, max_tokens, system_prompt=None):
+        response_data = await self.post(self.build_payload(messages, model_id, temperature, max_tokens, system_prompt))
+        return response_data['choices'][0]['message']['content']
+
+    async def generate_stream(self, messages, model_id, temperature, max_tokens, system_prompt=None, stream_options=None):
+        payload = self.build_payload(messages, model_id, temperature, max_tokens, system_prompt)
+        return await consume_stream(self.stream(payload), stream_options or StreamOptions())
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+# Provider backends by name: a factory called with the API key, or a "module:attribute"
+# string naming one. Backends named by string are imported on first use, so the SDK of
+# a provider that is never selected is never loaded.
+_backends = {}
+
+def register_provider(name, factory):
+    """
+    Register a provider backend.
+
+    Args:
+        name (str): The provider name.
+        factory (callable or str): Called with the API key (None for the provider's default key) to create
+            the provider, or a "module:attribute" string naming such a callable, imported on first use.
+    """
+    with _providers_lock:
+        _backends[name] = factory
+
+def provider_names():
+    """
+    Return the names of every registered provider.
+
+    Returns:
+        list: The provider names.
+    """
+    with _providers_lock:
+        return list(_backends)
+
+def _create_provider(name, api_key=None):
+    factory = _backends.get(name)
+    if factory is None:
+        raise ValueError(f"Unknown provider: {name}")
+    if isinstance(factory, str):
+        module_name, _, attribute = factory.partition(":")
+        factory = _backends[name] = getattr(importlib.import_module(module_name), attribute)
+    return factory(api_key)
+
+def get_provider(name, api_key=None):
+    """
+    Return the shared provider instance for a name and API key, creating it on first use.
+
+    Args:
+        name (str): The provider name, one of provider_names().
+        api_key (str, optional): The API key to use. Defaults to the provider's key in the environment.
+
+    Returns:
+        AsyncProvider: The provider instance.
+    """
+    with _providers_lock:
+        if (name, api_key) not in _providers:
+            _providers[(name, api_key)] = _create_provider(name, api_key)
+        return _providers[(name, api_key)]
+
+def get_endpoint_provider(url, api_key=None):
+    """
+    Return the shared provider of one local inference server, creating it on first use.
+
+    Args:
+        url (str): Full URL of the server's chat completions endpoint.
+        api_key (str, optional): Bearer token sent with every request.
+
+    Returns:
+        OpenAICompatibleProvider: The provider instance.
+    """
+    with _providers_lock:
+        key = ("local", api_key, url)
+        if key not in _providers:
+            _providers[key] = OpenAICompatibleProvider("local", url, api_key, supports_cache_prompt=True)
+        return _providers[key]
+
+def configure_providers(config):
+    """
+    Apply the 'http_pool' and 'prompt_caching' sections of the config.
+
+    Pool settings apply to provider clients created afterwards.
+
+    Args:
+        config (dict): Configuration settings.
+    """
+    pool_settings.update(config.get('http_pool', {}))
+    prompt_cache_settings.update(config.get('prompt_caching', {}))
+
+# Built-in providers
+register_provider("openai", lambda api_key: OpenAICompatibleProvider("openai", "https://api.openai.com/v1/chat/completions", api_key or os.getenv('OPENAI_API_KEY')))
+register_provider("groq", lambda api_key: OpenAICompatibleProvider("groq", "https://api.groq.com/openai/v1/chat/completions", api_key or os.getenv('GROQ_API_KEY')))
+register_provider("openrouter", lambda api_key: OpenAICompatibleProvider("openrouter", "https://openrouter.ai/api/v1/chat/completions", api_key or os.getenv('OPENROUTER_API_KEY')))
+register_provider("local", lambda api_key: OpenAICompatibleProvider("local", os.getenv('LOCAL_API_URL'), supports_cache_prompt=True))
+register_provider("claude", "claude_provider:ClaudeProvider")
+register_provider("gemini", "gemini_provider:GeminiProvider")
+
+class _LoopThread:
+    """
+    A background thread running the event loop that owns every provider client.
+
+    Keeping a single loop alive for the whole process is what lets pooled
+    connections be reused across calls made from any worker thread.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._loop.run_forever, name="synthgen-providers", daemon=True)
+                thread.start()
+            return self._loop
+
+    def run(self, coro):
+        loop = self._ensure_started()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            coro.close()
+            raise RuntimeError("run_sync() cannot be called from the provider event loop; await the coroutine instead")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def close(self):
+        with self._lock:
+            loop = self._loop
+            self._loop = None
+        if loop is None:
+            return
+
+        async def close_all():
+            for provider in list(_providers.values()):
+                await provider.aclose()
+
+        asyncio.run_coroutine_threadsafe(close_all(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+_loop_thread = _LoopThread()
+
+def run_sync(coro):
+    """
+    Run a provider coroutine on the shared provider event loop and wait for its result.
+
+    Args:
+        coro (coroutine): The coroutine to run.
+
+    Returns:
+        The result of the coroutine.
+    """
+    return _loop_thread.run(coro)
+
+def close_providers():
+    """
+    Close every provider client and stop the provider event loop.
+    """
+    _loop_thread.close()
+    with _providers_lock:
+        _providers.clear()
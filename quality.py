@@ -0,0 +1,188 @@
+# quality.py
+
+import re
+from history import count_tokens
+from stats import run_stats
+
+_WORD = re.compile(r"\w+")
+_SPEAKER_LABEL = re.compile(r"^\W*(joseph|user|human|assistant|professor(?: synapse)?)\s*:", re.IGNORECASE | re.MULTILINE)
+_DISCLAIMER = re.compile(r"\bas an ai(?: language model)?\b|\bi(?:'m| am) (?:just )?an ai\b", re.IGNORECASE)
+_COR_KEY = re.compile(r'"(?:🗺️|🎯|🚦|🧭)"\s*:')
+_UNFILLED_VALUE = re.compile(r':\s*null\b')
+
+# Speaker labels that mean a response is written as someone else
+_FOREIGN_LABELS = {
+    "Joseph": {"professor", "professor synapse", "assistant"},
+    "Professor": {"joseph", "user", "human"},
+}
+
+class QualityMonitor:
+    """
+    Validate the responses of one conversation as they are generated.
+
+    Each configured check looks at a response before it is appended and
+    returns the reason it is rejected, if any. The word n-grams of accepted
+    responses are kept per speaker, so a response can be compared with all the
+    earlier turns of its speaker without rescanning them.
+    """
+
+    def __init__(self, checks, settings):
+        """
+        Initialize the monitor.
+
+        Args:
+            checks (list): Names of the checks to run, keys of QUALITY_CHECKS.
+            settings (dict): The 'quality_gate' section of the config.
+        """
+        self.checks = [(name, QUALITY_CHECKS[name]) for name in checks]
+        self.settings = settings
+        self.action = settings.get('action', "retry")
+        self.max_retries = settings.get('max_retries', 1)
+        self.ngram_size = settings.get('ngram_size', 4)
+        self._ngrams = {}
+
+    def ngrams(self, text):
+        """
+        Return the word n-grams of a text.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            list: Hashes of the n-grams, in order, repeats included.
+        """
+        words = _WORD.findall(text.lower())
+        n = self.ngram_size
+        return [hash(tuple(words[index:index + n])) for index in range(len(words) - n + 1)]
+
+    def earlier_ngrams(self, name):
+        """
+        Return the n-grams of the accepted responses of a speaker.
+        """
+        return self._ngrams.get(name, set())
+
+    def check(self, response, response_type, name):
+        """
+        Run the checks on a response.
+
+        Args:
+            response (str): The generated response.
+            response_type (str): The type of response, such as user, cor or professor_synapse.
+            name (str): The speaker of the response.
+
+        Returns:
+            str: The reason the response is rejected, or None if it passes.
+        """
+        for check_name, check in self.checks:
+            reason = check(self, response, response_type, name)
+            if reason is not None:
+                run_stats.add(f'quality_rejected:{check_name}')
+                print(f"Quality check {check_name} rejected the {response_type} response: {reason}")
+                return reason
+        return None
+
+    def accept(self, response, name):
+        """
+        Record a response that is part of the conversation.
+
+        Args:
+            response (str): The response.
+            name (str): The speaker of the response.
+        """
+        self._ngrams.setdefault(name, set()).update(self.ngrams(response))
+
+def check_repetition(monitor, response, response_type, name):
+    """
+    Reject responses that loop on themselves or repeat the earlier turns of their speaker.
+    """
+    ngrams = monitor.ngrams(response)
+    # Too short to judge by n-grams; the length check covers these
+    if len(ngrams) < monitor.settings.get('min_ngrams', 8):
+        return None
+    repeated = 1 - len(set(ngrams)) / len(ngrams)
+    if repeated > monitor.settings.get('max_self_repetition', 0.5):
+        return f"{repeated:.0%} of its {monitor.ngram_size}-grams repeat within the response"
+    earlier = monitor.earlier_ngrams(name)
+    if earlier:
+        overlap = sum(1 for ngram in ngrams if ngram in earlier) / len(ngrams)
+        if overlap > monitor.settings.get('max_overlap', 0.6):
+            return f"{overlap:.0%} of its {monitor.ngram_size}-grams repeat earlier turns"
+    return None
+
+def check_length(monitor, response, response_type, name):
+    """
+    Reject responses outside the token bounds configured for their response type.
+    """
+    bounds = (monitor.settings.get('lengths') or {}).get(response_type)
+    if not bounds:
+        return None
+    minimum, maximum = bounds
+    tokens = count_tokens(response)
+    if minimum is not None and tokens < minimum:
+        return f"{tokens} tokens, below the minimum of {minimum}"
+    if maximum is not None and tokens > maximum:
+        return f"{tokens} tokens, above the maximum of {maximum}"
+    return None
+
+def check_format(monitor, response, response_type, name):
+    """
+    Reject CoRs that are not a filled-in template, and replies that drift out of their speaker's role.
+    """
+    if response_type == "cor":
+        start = response.find("{")
+        if start < 0 or response.rfind("}") < start:
+            return "no CoR template object"
+        unfilled = len(_UNFILLED_VALUE.findall(response))
+        if unfilled > monitor.settings.get('max_unfilled_cor_fields', 3):
+            return f"{unfilled} CoR fields left null"
+        return None
+    if _DISCLAIMER.search(response):
+        return "speaks as an AI model"
+    if _COR_KEY.search(response):
+        return "contains the CoR template"
+    foreign = _FOREIGN_LABELS.get(name, set())
+    for label in _SPEAKER_LABEL.findall(response):
+        if label.lower() in foreign:
+            return f"writes the turn of {label}"
+    if name == "Joseph" and "🧙" in response:
+        return "speaks as Professor Synapse"
+    return None
+
+# Checks run by the quality gate, in order; register more with register_check()
+QUALITY_CHECKS = {
+    "format": check_format,
+    "length": check_length,
+    "repetition": check_repetition,
+}
+
+def register_check(name, check):
+    """
+    Add a check that can be enabled in the 'checks' list of the 'quality_gate' section of the config.
+
+    Args:
+        name (str): The check name.
+        check (callable): Called with the QualityMonitor, the response, the response type and the
+            speaker name; returns the reason the response is rejected, or None if it passes.
+    """
+    QUALITY_CHECKS[name] = check
+
+def create_quality_monitor(config):
+    """
+    Create the quality monitor of a conversation from the 'quality_gate' section of the config.
+
+    Args:
+        config (dict): Configuration settings.
+
+    Returns:
+        QualityMonitor: The monitor, or None if the quality gate is disabled.
+    """
+    settings = config.get('quality_gate') or {}
+    if not settings.get('enabled', False):
+        return None
+    checks = settings.get('checks') or list(QUALITY_CHECKS)
+    unknown = [name for name in checks if name not in QUALITY_CHECKS]
+    if unknown:
+        raise ValueError(f"Unknown quality checks: {', '.join(unknown)}")
+    if settings.get('action', "retry") not in ("retry", "cut", "log"):
+        raise ValueError(f"Unknown quality gate action: {settings['action']}")
+    return QualityMonitor(checks, settings)
@@ -0,0 +1,408 @@
+# rate_limiter.py
+
+import email.utils
+import random
+import sys
+import threading
+import time
+
+import httpx
+
+from credentials import get_credential_pool
+from history import count_tokens, count_static_tokens
+from providers import run_sync
+from metrics import record_error, record_retry, start_attempt
+from stats import run_stats
+
+# Error classes returned by classify_error
+RATE_LIMITED = "rate_limited"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a provider's circuit breaker is open and requests fail fast.
+    """
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously from a per-minute quota.
+
+    Reservations may take the bucket below zero. The caller then waits until the
+    debt is repaid, so concurrent callers are served in the order they reserved
+    instead of polling.
+    """
+
+    def __init__(self, per_minute):
+        """
+        Initialize a full bucket.
+
+        Args:
+            per_minute (float): The quota per minute, also the burst capacity.
+        """
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now, rate_factor=1.0):
+        """
+        Take tokens from the bucket.
+
+        Args:
+            amount (float): The number of tokens to take.
+            now (float): The current monotonic time.
+            rate_factor (float): Fraction of the nominal refill rate currently allowed.
+
+        Returns:
+            float: Seconds to wait before the reservation is covered.
+        """
+        rate = self.rate * rate_factor
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / rate
+
+    def refund(self, amount):
+        """
+        Return tokens that were reserved but not used (or take more when amount is negative).
+
+        Args:
+            amount (float): The number of tokens to return.
+        """
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def drain(self):
+        """
+        Empty the bucket so no burst is sent right after the provider pushed back.
+        """
+        self.tokens = min(self.tokens, 0)
+
+class ProviderRateLimiter:
+    """
+    Request and token quotas, adaptive backoff and a circuit breaker for one provider.
+
+    Every request reserves one request from the RPM bucket and its estimated
+    tokens from the TPM bucket, and waits until both are covered. When the
+    provider answers 429 the refill rate is halved and requests are held back
+    until its Retry-After time; successful requests restore the rate step by
+    step. After too many consecutive server or connection errors the circuit
+    opens and requests fail fast until a cooldown has passed, then a single
+    trial request decides whether it closes again.
+    """
+
+    def __init__(self, name, rpm=None, tpm=None, failure_threshold=5, cooldown=60.0):
+        """
+        Initialize the limiter.
+
+        Args:
+            name (str): The provider name.
+            rpm (float, optional): Requests per minute. None means unlimited.
+            tpm (float, optional): Tokens per minute. None means unlimited.
+            failure_threshold (int): Consecutive failures that open the circuit.
+            cooldown (float): Seconds the circuit stays open before a trial request.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.rate_factor = 1.0
+        self._requests = TokenBucket(rpm) if rpm else None
+        self._tokens = TokenBucket(tpm) if tpm else None
+        self._lock = threading.Lock()
+        self._blocked_until = 0.0
+        self._failures = 0
+        self._open_until = 0.0
+
+    def acquire(self, tokens=0):
+        """
+        Wait until a request of the given size is within the quotas.
+
+        Args:
+            tokens (int): Estimated tokens of the request, prompt and completion.
+
+        Raises:
+            CircuitOpenError: If the circuit breaker is open.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._failures >= self.failure_threshold:
+                if now < self._open_until:
+                    raise CircuitOpenError(f"Circuit open for {self.name} after {self._failures} consecutive failures")
+                # Let this request through as a trial; others keep failing fast until it finishes
+                self._open_until = now + self.cooldown
+            wait = max(0.0, self._blocked_until - now)
+            if self._requests is not None:
+                wait = max(wait, self._requests.reserve(1, now, self.rate_factor))
+            if self._tokens is not None and tokens:
+                wait = max(wait, self._tokens.reserve(tokens, now, self.rate_factor))
+        if wait > 0:
+            run_stats.add('rate_limit_wait_seconds', wait)
+            time.sleep(wait)
+
+    def record_success(self, estimated_tokens, actual_tokens=None):
+        """
+        Record a successful request.
+
+        Args:
+            estimated_tokens (int): The tokens reserved for the request.
+            actual_tokens (int, optional): The tokens the request actually used, if known.
+        """
+        with self._lock:
+            if self._tokens is not None and actual_tokens is not None:
+                self._tokens.refund(estimated_tokens - actual_tokens)
+            self._failures = 0
+            self.rate_factor = min(1.0, self.rate_factor + 0.1)
+
+    def record_rate_limited(self, retry_after=None):
+        """
+        Record that the provider rejected a request for exceeding its rate limit.
+
+        Args:
+            retry_after (float, optional): Seconds the provider asked to wait.
+        """
+        with self._lock:
+            self.rate_factor = max(0.1, self.rate_factor / 2)
+            for bucket in (self._requests, self._tokens):
+                if bucket is not None:
+                    bucket.drain()
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def record_failure(self):
+        """
+        Record a server or connection error, opening the circuit after too many in a row.
+        """
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self.cooldown
+                print(f"Opening circuit for {self.name} for {self.cooldown:.0f}s after {self._failures} consecutive failures.")
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter.
+    """
+
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=60.0):
+        """
+        Initialize the policy.
+
+        Args:
+            max_retries (int): Maximum number of retries of a request.
+            base_delay (float): Upper bound of the first backoff in seconds.
+            max_delay (float): Upper bound of any backoff in seconds.
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Return how long to wait before retrying.
+
+        Args:
+            attempt (int): The number of the failed attempt, starting at 0.
+            retry_after (float, optional): Seconds the provider asked to wait. The limiter already holds requests back until then, so only jitter is added.
+
+        Returns:
+            float: The delay in seconds.
+        """
+        if retry_after:
+            return random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+def parse_retry_after(headers):
+    """
+    Read the wait time from Retry-After style response headers.
+
+    Args:
+        headers (Mapping): The response headers.
+
+    Returns:
+        float: Seconds to wait, or None if the headers do not say.
+    """
+    if headers is None:
+        return None
+    value = headers.get('retry-after-ms')
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def classify_error(error):
+    """
+    Decide whether a failed request should be retried.
+
+    Args:
+        error (Exception): The error raised by the provider client.
+
+    Returns:
+        tuple: The error class (RATE_LIMITED, TRANSIENT or FATAL) and the Retry-After delay in seconds, if any.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    status = getattr(error, 'status_code', None) or getattr(response, 'status_code', None)
+    # SDK exception types are only checked once their provider backend has been imported
+    google_exceptions = sys.modules.get('google.api_core.exceptions')
+    if status is None and google_exceptions is not None and isinstance(error, google_exceptions.GoogleAPICallError):
+        status = error.code
+    if isinstance(status, int):
+        if status == 429:
+            return RATE_LIMITED, parse_retry_after(headers)
+        if status >= 500 or status == 408:
+            return TRANSIENT, parse_retry_after(headers)
+        return FATAL, None
+    anthropic = sys.modules.get('anthropic')
+    if isinstance(error, (httpx.TransportError, TimeoutError)) or (anthropic is not None and isinstance(error, anthropic.APIConnectionError)):
+        return TRANSIENT, None
+    return FATAL, None
+
+def estimate_prompt_tokens(messages, system_prompt=None):
+    """
+    Estimate the prompt tokens of a request for the TPM quota.
+
+    Args:
+        messages (list): Chat messages, each a dict with 'content'.
+        system_prompt (str, optional): Static system prompt sent ahead of the messages.
+
+    Returns:
+        int: The estimated number of prompt tokens.
+    """
+    tokens = sum(count_tokens(message['content']) for message in messages)
+    if system_prompt:
+        tokens += count_static_tokens(system_prompt)
+    return tokens
+
+class RateLimitRegistry:
+    """
+    The rate limiters of every provider and API key, and the shared retry policy.
+
+    Providers enforce quotas per key, so each key of a credential pool gets its
+    own limiter with the provider's configured limits.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limiters = {}
+        self._limits = {}
+        self._breaker = {}
+        self.retry_policy = RetryPolicy()
+
+    def configure(self, config):
+        """
+        Apply the 'rate_limits' and 'retry' sections of the config.
+
+        Args:
+            config (dict): Configuration settings.
+        """
+        retry_config = config.get('retry') or {}
+        with self._lock:
+            self._limits = dict(config.get('rate_limits') or {})
+            self._breaker = {
+                "failure_threshold": retry_config.get('circuit_breaker_failures', 5),
+                "cooldown": retry_config.get('circuit_breaker_cooldown', 60.0),
+            }
+            self.retry_policy = RetryPolicy(
+                max_retries=retry_config.get('max_retries', 5),
+                base_delay=retry_config.get('base_delay', 1.0),
+                max_delay=retry_config.get('max_delay', 60.0),
+            )
+            self._limiters = {}
+
+    def limiter(self, provider, key_id=None):
+        """
+        Return the rate limiter of a provider and key, creating it on first use.
+
+        Args:
+            provider (str): The provider name.
+            key_id (str, optional): The ID of the API key, if the provider has a credential pool.
+
+        Returns:
+            ProviderRateLimiter: The rate limiter.
+        """
+        with self._lock:
+            if (provider, key_id) not in self._limiters:
+                limits = self._limits.get(provider) or self._limits.get('default') or {}
+                name = f"{provider} key {key_id}" if key_id else provider
+                self._limiters[(provider, key_id)] = ProviderRateLimiter(name, limits.get('rpm'), limits.get('tpm'), **self._breaker)
+            return self._limiters[(provider, key_id)]
+
+# Shared by every worker thread of the process
+rate_limits = RateLimitRegistry()
+
+def configure_rate_limits(config):
+    """
+    Apply the rate limit and retry settings of the config to the shared registry.
+
+    Args:
+        config (dict): Configuration settings.
+    """
+    rate_limits.configure(config)
+
+def call_with_retries(provider, make_request, prompt_tokens=0, max_tokens=0):
+    """
+    Run a provider request within the provider's quotas, retrying rate limits and transient errors.
+
+    If the provider has a credential pool, every attempt takes the least-loaded
+    healthy key, so a retry after a rate limit goes to another key.
+
+    Args:
+        provider (str): The provider name.
+        make_request (callable): Called with the API key to use (None for the default key) and returns a new request coroutine for every attempt.
+        prompt_tokens (int): Estimated prompt tokens of the request.
+        max_tokens (int): Maximum number of tokens to generate.
+
+    Returns:
+        The result of the request.
+
+    Raises:
+        Exception: The last error once retries are exhausted, or any error that is not worth retrying.
+    """
+    pool = get_credential_pool(provider)
+    policy = rate_limits.retry_policy
+    estimated_tokens = prompt_tokens + (max_tokens or 0)
+    attempt = 0
+    while True:
+        credential = pool.acquire() if pool is not None else None
+        limiter = rate_limits.limiter(provider, credential.key_id if credential is not None else None)
+        error_class = retry_after = None
+        try:
+            limiter.acquire(estimated_tokens)
+            start_attempt(prompt_tokens)
+            result = run_sync(make_request(credential.key if credential is not None else None))
+        except Exception as e:
+            error_class, retry_after = classify_error(e)
+            if error_class == RATE_LIMITED:
+                run_stats.add('rate_limited')
+                limiter.record_rate_limited(retry_after)
+            elif error_class == TRANSIENT:
+                limiter.record_failure()
+            if error_class == FATAL or attempt >= policy.max_retries:
+                record_error(e)
+                raise
+            reason = str(e).splitlines()[0] if str(e) else type(e).__name__
+        finally:
+            if credential is not None:
+                pool.release(credential, error_class == RATE_LIMITED, retry_after)
+        if error_class is None:
+            actual_tokens = prompt_tokens + count_tokens(result) if isinstance(result, str) else None
+            limiter.record_success(estimated_tokens, actual_tokens)
+            return result
+        delay = policy.delay(attempt, retry_after)
+        attempt += 1
+        run_stats.add('retries')
+        record_retry()
+        print(f"{provider} request failed ({reason}). Retrying in {delay:.1f}s (attempt {attempt} of {policy.max_retries}).")
+        time.sleep(delay)
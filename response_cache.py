@@ -0,0 +1,202 @@
+# response_cache.py
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_MODES = ("off", "read_through", "record", "replay")
+
+class ResponseCache:
+    """
+    Content-addressed cache of model responses stored in SQLite.
+
+    Entries are keyed by a hash of everything that determines a response and
+    evicted least-recently-used first once the store grows past its size limit.
+    Entries older than the TTL are treated as misses and removed.
+
+    Modes:
+        read_through: return cached responses, call the provider on a miss and store the result.
+        record: always call the provider and store the result.
+        replay: only return cached responses; a miss fails the request without calling a provider.
+    """
+
+    def __init__(self, path, mode="read_through", max_bytes=512 * 1024 * 1024, ttl_seconds=None):
+        """
+        Open (or create) the cache store.
+
+        Args:
+            path (str): Path to the SQLite database file.
+            mode (str): One of read_through, record or replay.
+            max_bytes (int): Size limit of the stored responses in bytes.
+            ttl_seconds (float, optional): Maximum age of an entry. None keeps entries until evicted.
+        """
+        if mode not in CACHE_MODES or mode == "off":
+            raise ValueError(f"Invalid response cache mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(provider, model_id, temperature, max_tokens, messages, seed=None, scope=None):
+        """
+        Build the cache key of a request.
+
+        Args:
+            provider (str): The provider name.
+            model_id (str): The model ID.
+            temperature (float): Sampling temperature.
+            max_tokens (int): Maximum number of tokens to generate.
+            messages (list): The full message list sent to the provider, system prompt included.
+            seed (int, optional): Sampling seed.
+            scope (str, optional): What the request belongs to, such as a conversation's checkpoint key. Requests of
+                different scopes never share a response, even with the same messages.
+
+        Returns:
+            str: The hex SHA-256 digest identifying the request.
+        """
+        request = {
+            "provider": provider,
+            "model_id": model_id,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "messages": [{"role": message["role"], "content": message["content"]} for message in messages],
+            "seed": seed,
+        }
+        if scope is not None:
+            request["scope"] = scope
+        encoded = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a cached response.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            str: The cached response, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, size, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            response, size, created = row
+            if self.ttl_seconds is not None and now - created > self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self._size -= size
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return response
+
+    def put(self, key, response):
+        """
+        Store a response, evicting old entries if the store is over its size limit.
+
+        Args:
+            key (str): The cache key.
+            response (str): The response to store.
+        """
+        size = len(response.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now),
+            )
+            self._size += size - (row[0] if row else 0)
+            if self._size > self.max_bytes:
+                self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        # Drop expired entries first, then least recently used ones down to 90% of the limit
+        if self.ttl_seconds is not None:
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = self.max_bytes * 0.9
+        if self._size <= target:
+            return
+        evicted_keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if self._size <= target:
+                break
+            evicted_keys.append((key,))
+            self._size -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted_keys)
+
+    def close(self):
+        """
+        Close the underlying database connection.
+        """
+        with self._lock:
+            self._conn.close()
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_response_cache(config, stable_scope=True):
+    """
+    Return the process-wide response cache configured in the 'response_cache' section.
+
+    Args:
+        config (dict): Configuration settings.
+        stable_scope (bool): Whether the caller's cache scopes are the same in every run.
+
+    Returns:
+        ResponseCache: The cache, or None when caching is off.
+
+    Raises:
+        ValueError: If the cache replays responses for a caller whose scopes change between runs, as it would find none.
+    """
+    global _cache
+    cache_config = config.get('response_cache') or {}
+    mode = cache_config.get('mode') or "off"
+    if mode == "off":
+        return None
+    if mode == "replay" and not stable_scope:
+        raise ValueError("The replay response cache needs conversations with a checkpoint, or concurrency.deterministic, "
+                         "to find their responses from an earlier run.")
+    with _cache_lock:
+        if _cache is None:
+            ttl_days = cache_config.get('ttl_days')
+            _cache = ResponseCache(
+                cache_config.get('path', os.path.join("cache", "responses.sqlite")),
+                mode=mode,
+                max_bytes=int(cache_config.get('max_size_mb', 512) * 1024 * 1024),
+                ttl_seconds=ttl_days * 86400 if ttl_days else None,
+            )
+        return _cache
+
+def close_response_cache():
+    """
+    Close the process-wide response cache, if one was opened.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is not None:
+            _cache.close()
+            _cache = None
@@ -0,0 +1,273 @@
+# router.py
+
+import os
+import random
+import threading
+import time
+from collections import deque
+from api_clients import RESPONSE_GENERATORS
+
+class Backend:
+    """
+    A provider and model that requests can be routed to.
+    """
+
+    def __init__(self, provider, model_id, weight=1.0, response_types=None):
+        """
+        Initialize the backend.
+
+        Args:
+            provider (str): The provider name, a key of RESPONSE_GENERATORS.
+            model_id (str): The model ID.
+            weight (float): Relative share of requests, and preference between backends of similar latency.
+            response_types (list, optional): Response types the backend serves. Defaults to all of them.
+        """
+        self.provider = provider
+        self.model_id = model_id
+        self.weight = max(float(weight), 0.001)
+        self.response_types = set(response_types) if response_types else None
+
+    def accepts(self, response_type):
+        return self.response_types is None or response_type in self.response_types
+
+    def __repr__(self):
+        return f"{self.provider}/{self.model_id}"
+
+class Router:
+    """
+    Spread requests over several backends, preferring the fastest healthy one
+    for each response type and failing over to the others on errors.
+
+    Latencies are tracked per backend and response type over the last 'window'
+    requests, and error rates per backend. A backend failing 'failure_threshold'
+    times in a row, or more often than 'max_error_rate' over the window, is
+    skipped for 'cooldown' seconds while other backends are available.
+
+    With the "fastest" strategy the backend with the lowest expected latency
+    (its mean latency inflated by its error rate, divided by its weight) comes
+    first, except for an 'explore' share of requests that go to a backend picked
+    at random by weight, so the latencies of the others stay current. With the
+    "weighted" strategy every request goes to a backend picked at random by weight.
+    """
+
+    def __init__(self, backends, strategy="fastest", explore=0.1, window=50, max_error_rate=0.5, failure_threshold=3, cooldown=30.0, rng=None):
+        """
+        Initialize the router.
+
+        Args:
+            backends (list): Backend objects, in order of preference before any latency is known.
+            strategy (str): "fastest" or "weighted".
+            explore (float): Share of requests routed at random by weight with the "fastest" strategy.
+            window (int): Requests per backend kept for latencies and error rates.
+            max_error_rate (float): Error rate over the window above which a backend cools down.
+            failure_threshold (int): Consecutive failures after which a backend cools down.
+            cooldown (float): Seconds a failing backend is skipped.
+            rng (random.Random, optional): Random generator for the weighted picks.
+        """
+        if not backends:
+            raise ValueError("The router needs at least one backend.")
+        if strategy not in ("fastest", "weighted"):
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        self.backends = list(backends)
+        self.strategy = strategy
+        self.explore = explore
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._rng = rng or random.Random()
+        self._latencies = {}
+        self._outcomes = [deque(maxlen=window) for _ in self.backends]
+        self._consecutive_failures = [0] * len(self.backends)
+        self._cooldown_until = [0.0] * len(self.backends)
+        self._lock = threading.Lock()
+
+    def uses(self, provider):
+        """
+        Return whether any backend is served by a provider.
+
+        Args:
+            provider (str): The provider name.
+
+        Returns:
+            bool: True if a backend uses the provider.
+        """
+        return any(backend.provider == provider for backend in self.backends)
+
+    def order(self, response_type):
+        """
+        Return the backends to try for a request, best first.
+
+        Backends cooling down come last, soonest available first, so a request
+        is still attempted when every backend is failing.
+
+        Args:
+            response_type (str): The type of response to generate.
+
+        Returns:
+            list: Backend objects.
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [index for index, backend in enumerate(self.backends) if backend.accepts(response_type)]
+            if not candidates:
+                candidates = list(range(len(self.backends)))
+            healthy = [index for index in candidates if self._cooldown_until[index] <= now]
+            cooling = sorted((index for index in candidates if index not in healthy), key=lambda index: self._cooldown_until[index])
+            ranked = sorted(healthy, key=lambda index: self._expected_seconds(index, response_type))
+            if len(ranked) > 1 and (self.strategy == "weighted" or self._rng.random() < self.explore):
+                chosen = self._rng.choices(ranked, weights=[self.backends[index].weight for index in ranked])[0]
+                ranked.remove(chosen)
+                ranked.insert(0, chosen)
+        return [self.backends[index] for index in ranked + cooling]
+
+    def _expected_seconds(self, index, response_type):
+        latencies = self._latencies.get((index, response_type))
+        if not latencies:
+            # Unmeasured backends go first, so every backend gets a latency
+            return 0.0
+        outcomes = self._outcomes[index]
+        error_rate = outcomes.count(False) / len(outcomes) if outcomes else 0.0
+        return sum(latencies) / len(latencies) / max(1.0 - error_rate, 0.05) / self.backends[index].weight
+
+    def record(self, backend, response_type, seconds, succeeded):
+        """
+        Record the outcome of a request.
+
+        Args:
+            backend (Backend): The backend that served the request.
+            response_type (str): The type of response generated.
+            seconds (float): Duration of the request.
+            succeeded (bool): Whether a response was generated.
+        """
+        # Backends from outside the router, such as the cheaper model of the budget, are not ranked
+        if backend not in self.backends:
+            return
+        index = self.backends.index(backend)
+        with self._lock:
+            outcomes = self._outcomes[index]
+            outcomes.append(succeeded)
+            if succeeded:
+                self._consecutive_failures[index] = 0
+                self._latencies.setdefault((index, response_type), deque(maxlen=self.window)).append(seconds)
+                return
+            self._consecutive_failures[index] += 1
+            error_rate = outcomes.count(False) / len(outcomes)
+            # A handful of requests is too few to judge the error rate by
+            if self._consecutive_failures[index] >= self.failure_threshold or (len(outcomes) >= 5 and error_rate > self.max_error_rate):
+                self._cooldown_until[index] = time.monotonic() + self.cooldown
+                self._consecutive_failures[index] = 0
+                # Start afresh once the cooldown is over
+                outcomes.clear()
+                print(f"Routing away from {backend} for {self.cooldown:.0f}s after repeated failures.")
+
+def default_model_id(config, provider):
+    """
+    Return the configured model ID of a provider.
+
+    Args:
+        config (dict): Configuration settings.
+        provider (str): The provider name.
+
+    Returns:
+        str: The model ID from the provider's '<provider>_details' section, or LOCAL_API_MODEL for the local model.
+    """
+    if provider == "local":
+        return os.getenv('LOCAL_API_MODEL')
+    details = config.get(f'{provider}_details') or {}
+    if 'model_id' not in details:
+        raise ValueError(f"No model_id configured for {provider} in '{provider}_details'.")
+    return details['model_id']
+
+def create_router(config, providers=None):
+    """
+    Create a router from the 'routing' section of the config.
+
+    Args:
+        config (dict): Configuration settings.
+        providers (list, optional): Provider names to route over with their configured models,
+            instead of the backends in the config.
+
+    Returns:
+        Router: The router.
+    """
+    routing = config.get('routing') or {}
+    specs = [{"provider": provider} for provider in providers] if providers else routing.get('backends') or []
+    backends = []
+    for spec in specs:
+        provider = spec['provider']
+        if provider not in RESPONSE_GENERATORS:
+            raise ValueError(f"Unknown provider: {provider}")
+        backends.append(Backend(provider, spec.get('model_id') or default_model_id(config, provider), spec.get('weight', 1.0), spec.get('response_types')))
+
+    concurrency = config.get('concurrency', {})
+    rng = random.Random(concurrency.get('seed', 0)) if concurrency.get('deterministic', False) else None
+    return Router(
+        backends,
+        routing.get('strategy', "fastest"),
+        routing.get('explore', 0.1),
+        routing.get('window', 50),
+        routing.get('max_error_rate', 0.5),
+        routing.get('failure_threshold', 3),
+        routing.get('cooldown', 30.0),
+        rng,
+    )
+
+def flag_provider(use_openai=False, use_claude=False, use_groq=False, use_gemini=False, use_local=False):
+    """
+    Return the provider selected by the provider flags.
+
+    Returns:
+        str: The provider name, or None if no flag is set.
+    """
+    for provider, selected in (("openai", use_openai), ("claude", use_claude), ("groq", use_groq), ("gemini", use_gemini), ("local", use_local)):
+        if selected:
+            return provider
+    return None
+
+_router = None
+_flag_routers = {}
+_router_lock = threading.Lock()
+
+def configure_router(config, providers=None):
+    """
+    Create the router that requests without provider flags are routed through.
+
+    Args:
+        config (dict): Configuration settings.
+        providers (list, optional): Provider names to route over, instead of the backends in the config.
+
+    Returns:
+        Router: The router.
+    """
+    global _router
+    _router = create_router(config, providers)
+    return _router
+
+def active_router(config, use_openai=False, use_claude=False, use_groq=False, use_gemini=False, use_local=False):
+    """
+    Return the router for a request.
+
+    A provider flag routes the request to that provider alone; otherwise the
+    router set up by configure_router() is used.
+
+    Args:
+        config (dict): Configuration settings.
+        use_openai (bool): Flag to use OpenAI.
+        use_claude (bool): Flag to use Claude.
+        use_groq (bool): Flag to use Groq.
+        use_gemini (bool): Flag to use Gemini.
+        use_local (bool): Flag to use local model.
+
+    Returns:
+        Router: The router.
+    """
+    provider = flag_provider(use_openai, use_claude, use_groq, use_gemini, use_local)
+    if provider is not None:
+        with _router_lock:
+            if provider not in _flag_routers:
+                _flag_routers[provider] = Router([Backend(provider, default_model_id(config, provider))])
+            return _flag_routers[provider]
+    if _router is None:
+        raise ValueError("No valid AI model selected for response generation.")
+    return _router
@@ -0,0 +1,207 @@
+# scheduler.py
+
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Sentinel telling a worker thread that no more notes will be queued
+_STOP = object()
+
+class ProviderLimiter:
+    """
+    Cap the number of concurrent requests sent to each provider.
+    """
+
+    def __init__(self, limits=None, default_limit=None):
+        """
+        Initialize the limiter.
+
+        Args:
+            limits (dict, optional): Maximum concurrent requests keyed by provider name.
+            default_limit (int, optional): Limit for providers missing from limits. None means unlimited.
+        """
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self.configure(limits or {}, default_limit)
+
+    def configure(self, limits, default_limit=None):
+        """
+        Replace the per-provider limits.
+
+        Args:
+            limits (dict): Maximum concurrent requests keyed by provider name.
+            default_limit (int, optional): Limit for providers missing from limits. None means unlimited.
+        """
+        with self._lock:
+            self._limits = dict(limits)
+            self._default_limit = default_limit
+            self._semaphores = {}
+
+    def _semaphore(self, provider):
+        with self._lock:
+            if provider not in self._semaphores:
+                limit = self._limits.get(provider, self._default_limit)
+                self._semaphores[provider] = threading.BoundedSemaphore(limit) if limit else None
+            return self._semaphores[provider]
+
+    @contextmanager
+    def slot(self, provider):
+        """
+        Hold one request slot for a provider for the duration of the block.
+
+        Args:
+            provider (str): The provider name.
+        """
+        semaphore = self._semaphore(provider)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+# Shared by every worker thread of the process
+provider_limiter = ProviderLimiter()
+
+class NoteScheduler:
+    """
+    Process notes from a bounded work queue with a pool of worker threads.
+
+    Discovery runs in its own thread and feeds the queue, so generation starts
+    before the vault walk finishes. In deterministic mode a single worker handles
+    notes in discovery order and each note gets its own seeded random generator,
+    so runs are reproducible.
+    """
+
+    def __init__(self, worker, max_workers=4, queue_size=64, deterministic=False, seed=0):
+        """
+        Initialize the scheduler.
+
+        Args:
+            worker (callable): Called as worker(note_path, rng) for every note.
+            max_workers (int): Number of worker threads.
+            queue_size (int): Maximum number of notes waiting in the queue.
+            deterministic (bool): Use a single worker and per-note seeded random generators.
+            seed (int): Seed for the per-note random generators in deterministic mode.
+        """
+        self.worker = worker
+        self.max_workers = 1 if deterministic else max(1, max_workers)
+        self.deterministic = deterministic
+        self.seed = seed
+        self.stop_event = threading.Event()
+        # Set by Ctrl-C, so callers can tell a stopped run from a finished one
+        self.interrupted = False
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._processed = 0
+        self._processed_lock = threading.Lock()
+        self._live_threads = 0
+        self._live_lock = threading.Lock()
+
+    def _rng_for(self, note_path):
+        if self.deterministic:
+            return random.Random(f"{self.seed}:{note_path}")
+        return random.Random()
+
+    def _put(self, item):
+        # Poll so the producer notices a shutdown while the queue is full
+        while not self.stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, note_paths):
+        try:
+            for note_path in note_paths:
+                if not self._put(note_path):
+                    break
+        except Exception as e:
+            print(f"Error while discovering notes: {str(e)}")
+        finally:
+            for _ in range(self.max_workers):
+                self._queue.put(_STOP)
+
+    def _consume(self):
+        while True:
+            note_path = self._queue.get()
+            if note_path is _STOP:
+                return
+            if self.stop_event.is_set():
+                continue
+            try:
+                self.worker(note_path, self._rng_for(note_path))
+                with self._processed_lock:
+                    self._processed += 1
+            except Exception as e:
+                print(f"Error processing note {note_path}: {str(e)}")
+
+    def run(self, note_paths):
+        """
+        Process every note yielded by note_paths and wait for the workers to finish.
+
+        The first Ctrl-C stops scheduling new notes and lets in-flight notes
+        finish; a second Ctrl-C returns immediately.
+
+        Args:
+            note_paths (iterable): Note paths to process, typically a discovery generator.
+
+        Returns:
+            int: The number of notes processed.
+        """
+        threads = [threading.Thread(target=self._run_thread, args=(self._produce, note_paths), name="synthgen-discovery", daemon=True)]
+        threads += [threading.Thread(target=self._run_thread, args=(self._consume,), name=f"synthgen-worker-{i}", daemon=True) for i in range(self.max_workers)]
+        self._live_threads = len(threads)
+        for thread in threads:
+            thread.start()
+
+        try:
+            self._join()
+        except KeyboardInterrupt:
+            print("\nInterrupted: finishing in-flight notes. Press Ctrl-C again to stop immediately.")
+            self.interrupted = True
+            self.stop_event.set()
+            try:
+                self._join()
+            except KeyboardInterrupt:
+                print("\nStopping immediately.")
+
+        return self._processed
+
+    def _run_thread(self, target, *args):
+        try:
+            target(*args)
+        finally:
+            with self._live_lock:
+                self._live_threads -= 1
+
+    def _join(self):
+        # Poll a count the threads keep themselves: a Thread.join() interrupted by
+        # Ctrl-C can report a thread as finished while it is still running
+        while self._live_threads:
+            time.sleep(0.2)
+
+def create_scheduler(config, worker):
+    """
+    Create a scheduler from the 'concurrency' section of the config.
+
+    Also applies the configured per-provider limits to the shared provider limiter.
+
+    Args:
+        config (dict): Configuration settings.
+        worker (callable): Called as worker(note_path, rng) for every note.
+
+    Returns:
+        NoteScheduler: The configured scheduler.
+    """
+    concurrency = config.get('concurrency', {})
+    provider_limiter.configure(concurrency.get('provider_limits', {}), concurrency.get('default_provider_limit'))
+    return NoteScheduler(
+        worker,
+        max_workers=concurrency.get('max_workers', 4),
+        queue_size=concurrency.get('queue_size', 64),
+        deterministic=concurrency.get('deterministic', False),
+        seed=concurrency.get('seed', 0),
+    )
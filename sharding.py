@@ -0,0 +1,706 @@
+# sharding.py
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataset_export import DatasetReader, iter_jsonl_conversations
+from output_sinks import create_sink
+from state_store import StateStore, get_state_store, close_state_stores
+from vault_index import VaultIndex
+
+def note_key(vault_path, note_path):
+    """
+    Return the key of a note: its path relative to the vault, with forward slashes.
+
+    Keys are the same on every machine, wherever the vault is mounted.
+
+    Args:
+        vault_path (str): Path to the Obsidian vault.
+        note_path (str): Path of the note.
+
+    Returns:
+        str: The note key.
+    """
+    return os.path.relpath(note_path, vault_path).replace(os.sep, "/")
+
+def shard_of(key, num_shards):
+    """
+    Return the shard a note belongs to.
+
+    The shard is derived from a hash of the note key, so it does not depend on
+    the process, the machine or the other notes of the vault.
+
+    Args:
+        key (str): The note key.
+        num_shards (int): Number of shards.
+
+    Returns:
+        int: The shard number.
+    """
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % num_shards
+
+class ShardLeases:
+    """
+    Shards of a distributed run and the leases workers hold on them, kept in SQLite.
+
+    A worker claims a shard for 'lease_seconds' and renews the lease while it
+    works. A shard whose lease ran out without being completed, for example
+    because its worker died, is claimed again by the next worker that asks.
+    Only the worker holding the lease can complete a shard, so every shard is
+    completed by exactly one worker.
+
+    Claims go through an immediate transaction, so worker processes on one
+    machine can share the database file directly. Workers on other machines go
+    through serve_coordinator() instead.
+
+    The budget ledger of the round is kept here as well, so the workers spend
+    from one budget rather than each from its own.
+    """
+
+    def __init__(self, path):
+        """
+        Open (or create) the lease database.
+
+        Args:
+            path (str): Path to the SQLite database file.
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            "shard INTEGER PRIMARY KEY, worker TEXT, lease_until REAL NOT NULL DEFAULT 0, "
+            "attempts INTEGER NOT NULL DEFAULT 0, completed_by TEXT, merged INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS shard_notes (note TEXT PRIMARY KEY, shard INTEGER NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS shard_notes_shard ON shard_notes (shard)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS budget_ledger ("
+            "ledger TEXT NOT NULL, provider TEXT NOT NULL, model_id TEXT NOT NULL, requests INTEGER NOT NULL, "
+            "prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, cost REAL NOT NULL, "
+            "PRIMARY KEY (ledger, provider, model_id))"
+        )
+
+    def plan(self, note_keys, num_shards):
+        """
+        Partition notes into shards and start a new round of work.
+
+        Shards without notes are completed right away.
+
+        Args:
+            note_keys (list): Keys of the notes to generate from.
+            num_shards (int): Number of shards.
+
+        Returns:
+            str: The round ID, which names the output files of the round.
+        """
+        round_id = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        assignments = [(key, shard_of(key, num_shards)) for key in note_keys]
+        used = {shard for _, shard in assignments}
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM shards LIMIT 1").fetchone():
+                raise ValueError(f"{self.path} already holds a round; use a new lease database for a new round.")
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany("INSERT OR REPLACE INTO run (key, value) VALUES (?, ?)", [("round", round_id), ("num_shards", str(num_shards))])
+            self._conn.executemany(
+                "INSERT INTO shards (shard, completed_by) VALUES (?, ?)",
+                [(shard, None if shard in used else "") for shard in range(num_shards)],
+            )
+            self._conn.executemany("INSERT INTO shard_notes (note, shard) VALUES (?, ?)", assignments)
+            self._conn.execute("COMMIT")
+        return round_id
+
+    def round_id(self):
+        """
+        Return the ID of the round, or None if no round was planned.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM run WHERE key = 'round'").fetchone()
+        return row[0] if row else None
+
+    def claim(self, worker_id, lease_seconds):
+        """
+        Lease the next shard to work on.
+
+        A shard the worker already holds comes first, so a restarted worker
+        picks up where it stopped.
+
+        Args:
+            worker_id (str): The worker ID.
+            lease_seconds (float): Duration of the lease.
+
+        Returns:
+            dict: The round ID, the shard and the keys of its notes, or None if no shard is left to claim.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT shard FROM shards WHERE completed_by IS NULL AND (worker = ? OR lease_until <= ?) "
+                    "ORDER BY worker = ? DESC, shard LIMIT 1",
+                    (worker_id, now, worker_id),
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                shard = row[0]
+                self._conn.execute(
+                    "UPDATE shards SET worker = ?, lease_until = ?, attempts = attempts + 1 WHERE shard = ?",
+                    (worker_id, now + lease_seconds, shard),
+                )
+                notes = [key for key, in self._conn.execute("SELECT note FROM shard_notes WHERE shard = ? ORDER BY note", (shard,))]
+                round_id = self._conn.execute("SELECT value FROM run WHERE key = 'round'").fetchone()[0]
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+        return {"round": round_id, "shard": shard, "notes": notes}
+
+    def renew(self, shard, worker_id, lease_seconds):
+        """
+        Extend a lease.
+
+        Args:
+            shard (int): The shard.
+            worker_id (str): The worker holding the lease.
+            lease_seconds (float): New duration of the lease, from now.
+
+        Returns:
+            bool: False if the worker no longer holds the lease.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE shards SET lease_until = ? WHERE shard = ? AND worker = ? AND completed_by IS NULL",
+                (time.time() + lease_seconds, shard, worker_id),
+            )
+            return cursor.rowcount > 0
+
+    def complete(self, shard, worker_id):
+        """
+        Record that a worker generated every note of a shard.
+
+        Args:
+            shard (int): The shard.
+            worker_id (str): The worker holding the lease.
+
+        Returns:
+            bool: False if the worker no longer holds the lease, in which case its output for the shard is not merged.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE shards SET completed_by = ?, lease_until = 0 WHERE shard = ? AND worker = ? AND completed_by IS NULL",
+                (worker_id, shard, worker_id),
+            )
+            return cursor.rowcount > 0
+
+    def release(self, shard, worker_id):
+        """
+        Give a lease up early, so another worker can claim the shard at once.
+
+        Args:
+            shard (int): The shard.
+            worker_id (str): The worker holding the lease.
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE shards SET worker = NULL, lease_until = 0 WHERE shard = ? AND worker = ? AND completed_by IS NULL",
+                (shard, worker_id),
+            )
+
+    def status(self):
+        """
+        Summarize the progress of the round.
+
+        Returns:
+            dict: The round ID and the number of shards and notes that are done, leased and waiting.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT s.completed_by IS NOT NULL, s.lease_until > ?, COUNT(DISTINCT s.shard), COUNT(n.note) "
+                "FROM shards s LEFT JOIN shard_notes n ON n.shard = s.shard GROUP BY 1, 2",
+                (now,),
+            ).fetchall()
+        status = {"round": self.round_id(), "shards": {"done": 0, "leased": 0, "waiting": 0}, "notes": {"done": 0, "leased": 0, "waiting": 0}}
+        for completed, leased, shards, notes in rows:
+            state = "done" if completed else "leased" if leased else "waiting"
+            status["shards"][state] += shards
+            status["notes"][state] += notes
+        return status
+
+    def completed_shards(self, unmerged_only=False):
+        """
+        Return the completed shards with notes, the worker that completed each and the keys of its notes.
+
+        Args:
+            unmerged_only (bool): Leave out shards already merged.
+
+        Returns:
+            dict: (worker_id, note keys) tuples keyed by shard.
+        """
+        query = "SELECT shard, completed_by FROM shards WHERE completed_by IS NOT NULL AND completed_by != ''"
+        if unmerged_only:
+            query += " AND merged = 0"
+        with self._lock:
+            completed = {}
+            for shard, worker_id in self._conn.execute(query + " ORDER BY shard").fetchall():
+                notes = [key for key, in self._conn.execute("SELECT note FROM shard_notes WHERE shard = ? ORDER BY note", (shard,))]
+                completed[shard] = (worker_id, notes)
+            return completed
+
+    def mark_merged(self, shards):
+        """
+        Record that the output of shards was merged.
+
+        Args:
+            shards (list): The shards.
+        """
+        with self._lock:
+            self._conn.executemany("UPDATE shards SET merged = 1 WHERE shard = ?", [(shard,) for shard in shards])
+
+    def load_budget_ledger(self, ledger):
+        """
+        Load the usage recorded in a budget ledger of the round, like StateStore.load_budget_ledger().
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT provider, model_id, requests, prompt_tokens, completion_tokens, cost FROM budget_ledger WHERE ledger = ? ORDER BY provider, model_id",
+                (ledger,),
+            ).fetchall()
+
+    def add_budget_usage(self, ledger, provider, model_id, prompt_tokens, completion_tokens, cost):
+        """
+        Add the usage of one request to a budget ledger of the round, like StateStore.add_budget_usage().
+
+        Returns:
+            tuple: The cost and tokens of the whole ledger, spent by every worker of the round.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO budget_ledger (ledger, provider, model_id, requests, prompt_tokens, completion_tokens, cost) VALUES (?, ?, ?, 1, ?, ?, ?) "
+                "ON CONFLICT (ledger, provider, model_id) DO UPDATE SET requests = requests + 1, "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "cost = cost + excluded.cost",
+                (ledger, provider, model_id, prompt_tokens, completion_tokens, cost),
+            )
+            return self._conn.execute(
+                "SELECT COALESCE(SUM(cost), 0), COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM budget_ledger WHERE ledger = ?",
+                (ledger,),
+            ).fetchone()
+
+    def set_budget_ledger(self, ledger, usage):
+        """
+        Replace the usage recorded in a budget ledger of the round, like StateStore.set_budget_ledger().
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM budget_ledger WHERE ledger = ?", (ledger,))
+                self._conn.executemany(
+                    "INSERT INTO budget_ledger (ledger, provider, model_id, requests, prompt_tokens, completion_tokens, cost) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(ledger, *row) for row in usage],
+                )
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class CoordinatorClient:
+    """
+    Client for the leases of a coordinator started with serve_coordinator(),
+    with the claim, renew, complete, release and status methods of ShardLeases
+    and the budget ledger methods the budget governor uses.
+    """
+
+    def __init__(self, url, timeout=30):
+        """
+        Initialize the client.
+
+        Args:
+            url (str): Base URL of the coordinator, such as http://host:8765.
+            timeout (float): Timeout of each request in seconds.
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _post(self, action, **payload):
+        request = urllib.request.Request(
+            f"{self.url}/{action}",
+            data=json.dumps(payload).encode('utf-8'),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def claim(self, worker_id, lease_seconds):
+        return self._post("claim", worker=worker_id, lease_seconds=lease_seconds)
+
+    def renew(self, shard, worker_id, lease_seconds):
+        return self._post("renew", shard=shard, worker=worker_id, lease_seconds=lease_seconds)
+
+    def complete(self, shard, worker_id):
+        return self._post("complete", shard=shard, worker=worker_id)
+
+    def release(self, shard, worker_id):
+        self._post("release", shard=shard, worker=worker_id)
+
+    def status(self):
+        with urllib.request.urlopen(f"{self.url}/status", timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def load_budget_ledger(self, ledger):
+        return self._post("load_budget_ledger", ledger=ledger)
+
+    def add_budget_usage(self, ledger, provider, model_id, prompt_tokens, completion_tokens, cost):
+        return self._post("add_budget_usage", ledger=ledger, provider=provider, model_id=model_id,
+                          prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cost=cost)
+
+    def close(self):
+        pass
+
+def serve_coordinator(leases, host="0.0.0.0", port=8765):
+    """
+    Serve the leases of a round over HTTP, for workers on other machines.
+
+    Workers POST JSON to /claim, /renew, /complete and /release, and to
+    /load_budget_ledger and /add_budget_usage for the round's budget; GET
+    /status reports progress. Blocks until interrupted.
+
+    Args:
+        leases (ShardLeases): The leases of the round.
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+    """
+    actions = {
+        "claim": lambda body: leases.claim(body["worker"], body["lease_seconds"]),
+        "renew": lambda body: leases.renew(body["shard"], body["worker"], body["lease_seconds"]),
+        "complete": lambda body: leases.complete(body["shard"], body["worker"]),
+        "release": lambda body: leases.release(body["shard"], body["worker"]),
+        "load_budget_ledger": lambda body: leases.load_budget_ledger(body["ledger"]),
+        "add_budget_usage": lambda body: leases.add_budget_usage(body["ledger"], body["provider"], body["model_id"],
+                                                                 body["prompt_tokens"], body["completion_tokens"], body["cost"]),
+    }
+
+    class CoordinatorHandler(BaseHTTPRequestHandler):
+        def _send_json(self, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip('/') != '/status':
+                self.send_error(404)
+                return
+            self._send_json(leases.status())
+
+        def do_POST(self):
+            action = actions.get(self.path.strip('/'))
+            if action is None:
+                self.send_error(404)
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            try:
+                self._send_json(action(body))
+            except (KeyError, sqlite3.Error) as e:
+                self.send_error(400, str(e))
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), CoordinatorHandler)
+    server.daemon_threads = True
+    print(f"Serving shard leases of {leases.path} at http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def connect_coordinator(address):
+    """
+    Connect to the leases of a round.
+
+    Args:
+        address (str): An http(s) URL of a coordinator, or the path of a lease database on a shared disk.
+
+    Returns:
+        ShardLeases or CoordinatorClient: The leases.
+    """
+    if address.startswith(("http://", "https://")):
+        return CoordinatorClient(address)
+    if not os.path.exists(address):
+        raise ValueError(f"Lease database not found: {address}")
+    return ShardLeases(address)
+
+class LeaseKeeper:
+    """
+    Renew the lease of a shard in a background thread while a worker generates from it.
+    """
+
+    def __init__(self, leases, shard, worker_id, lease_seconds):
+        """
+        Start renewing the lease every third of its duration.
+
+        Args:
+            leases (ShardLeases or CoordinatorClient): The leases.
+            shard (int): The leased shard.
+            worker_id (str): The worker holding the lease.
+            lease_seconds (float): Duration of the lease.
+        """
+        self.leases = leases
+        self.shard = shard
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"synthgen-lease-{shard}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                renewed = self.leases.renew(self.shard, self.worker_id, self.lease_seconds)
+            except (OSError, sqlite3.Error) as e:
+                # The coordinator may be back before the lease runs out
+                print(f"Error renewing the lease of shard {self.shard}: {str(e)}")
+                continue
+            if not renewed:
+                print(f"Lost the lease of shard {self.shard}; its output will not be merged.")
+                self.lost.set()
+                return
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+def worker_directory(config, worker_id):
+    """
+    Return the directory holding a worker's state store and output.
+
+    Args:
+        config (dict): Configuration settings.
+        worker_id (str): The worker ID.
+
+    Returns:
+        str: The directory, under the 'work_dir' of the 'distributed' section of the config.
+    """
+    distributed = config.get('distributed') or {}
+    return os.path.join(distributed.get('work_dir', 'synth_distributed'), worker_id)
+
+def worker_config(config, worker_id):
+    """
+    Return the config of a worker, with its state store and output in its own directory.
+
+    Args:
+        config (dict): Configuration settings.
+        worker_id (str): The worker ID.
+
+    Returns:
+        dict: The worker's configuration settings.
+    """
+    directory = worker_directory(config, worker_id)
+    config = dict(config)
+    config['file_paths'] = dict(config['file_paths'], state_store=os.path.join(directory, "state.db"))
+    config['output'] = dict(config.get('output') or {}, directory=os.path.join(directory, "output"))
+    os.makedirs(directory, exist_ok=True)
+    # The merge step maps the worker's note paths back to note keys with the vault path
+    with open(os.path.join(directory, "worker.json"), 'w', encoding='utf-8') as file:
+        json.dump({"worker_id": worker_id, "vault_path": config['file_paths']['obsidian_vault_path']}, file)
+    return config
+
+def shard_run_name(round_id, shard):
+    """
+    Return the name of a worker's output file for a shard, without the time suffix and extension.
+    """
+    return f"{round_id}_shard-{shard:04d}"
+
+def plan_round(config, leases_path, num_shards):
+    """
+    Partition the notes that need generation into the shards of a new round.
+
+    The notes are those the run's state store (the one merge_round() merges
+    into) has not processed in their current version. The round's budget
+    ledger starts from the one in the run's state store, so the spend of
+    earlier runs counts against the workers' budget.
+
+    Args:
+        config (dict): Configuration settings.
+        leases_path (str): Path of the new lease database.
+        num_shards (int): Number of shards.
+
+    Returns:
+        dict: The status of the new round.
+    """
+    vault_path = config['file_paths']['obsidian_vault_path']
+    state_store = get_state_store(config['file_paths'].get('state_store', 'synthgen_state.db'))
+    notes = VaultIndex(state_store).refresh(vault_path)
+    leases = ShardLeases(leases_path)
+    try:
+        round_id = leases.plan([note_key(vault_path, note) for note in notes], num_shards)
+        ledger = (config.get('budget') or {}).get('ledger', "default")
+        leases.set_budget_ledger(ledger, state_store.load_budget_ledger(ledger))
+        print(f"Planned round {round_id}: {len(notes)} notes in {num_shards} shards")
+        return leases.status()
+    finally:
+        leases.close()
+
+def shard_conversations(output_dir, run_prefix):
+    """
+    Iterate over the conversations a worker wrote for a shard, oldest run first.
+
+    A conversation resumed by a later run is yielded once per run, and the
+    records of a dataset are yielded in the order the runs wrote them.
+
+    Args:
+        output_dir (str): The worker's output directory.
+        run_prefix (str): Prefix of the names of the shard's runs.
+
+    Yields:
+        tuple: The conversation ID and its message records.
+    """
+    for name in sorted(os.listdir(output_dir)):
+        path = os.path.join(output_dir, name)
+        if os.path.exists(os.path.join(path, "manifest.jsonl")):
+            yield from DatasetReader(path).iter_conversations(run_prefix)
+        elif name.startswith(run_prefix) and name.endswith(".jsonl") and not name.endswith((".partial.jsonl", ".metrics.jsonl")):
+            yield from iter_jsonl_conversations(path)
+
+def merge_round(config, leases_path):
+    """
+    Merge the output and processed notes of the workers of a round.
+
+    For every completed shard, only the output of the worker that completed it
+    is taken, so a shard redone after its first worker died or lost its lease is
+    merged once. The output is read from JSON Lines files and datasets alike, and
+    written with the sink configured in the 'output' section of the config.
+    A turn written more than once, such as by a run stopped in the middle of
+    the turn and the run that resumed it, is taken from the last run that wrote
+    it, so the merged conversation continues from the turn it resumed with.
+    Processed notes are marked in the run's state
+    store, and its budget ledger is brought up to the round's. Shards merged by
+    an earlier call are skipped, so a round can be merged while it is still running.
+
+    Args:
+        config (dict): Configuration settings.
+        leases_path (str): Path of the lease database of the round.
+
+    Returns:
+        str: Path of the merged output, or None if no new shard was completed.
+    """
+    leases = ShardLeases(leases_path)
+    try:
+        round_id = leases.round_id()
+        completed = leases.completed_shards(unmerged_only=True)
+        if not completed:
+            print("No completed shards left to merge.")
+            return None
+
+        vault_path = config['file_paths']['obsidian_vault_path']
+        target_store = get_state_store(config['file_paths'].get('state_store', 'synthgen_state.db'))
+        output_sink = create_sink(config, f"synthgen_{round_id}_merged_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}")
+
+        messages = 0
+        processed = 0
+        with output_sink:
+            for shard, (worker_id, keys) in completed.items():
+                directory = worker_directory(config, worker_id)
+                with open(os.path.join(directory, "worker.json"), 'r', encoding='utf-8') as file:
+                    worker_vault_path = json.load(file)['vault_path']
+
+                output_dir = os.path.join(directory, "output")
+                run_prefix = shard_run_name(round_id, shard) + "_"
+                # Counted in a first pass, so the second knows which attempt at each turn is the last
+                attempts = {}
+                for conversation_id, records in shard_conversations(output_dir, run_prefix):
+                    for turn, _ in itertools.groupby(records, key=lambda record: record.get('turn')):
+                        attempts[(conversation_id, turn)] = attempts.get((conversation_id, turn), 0) + 1
+
+                written = {}
+                for conversation_id, records in shard_conversations(output_dir, run_prefix):
+                    for turn, turn_records in itertools.groupby(records, key=lambda record: record.get('turn')):
+                        attempt = written[(conversation_id, turn)] = written.get((conversation_id, turn), 0) + 1
+                        if attempt < attempts[(conversation_id, turn)]:
+                            continue
+                        for record in turn_records:
+                            output_sink.write(record)
+                            messages += 1
+                    output_sink.end_conversation(conversation_id)
+
+                shard_keys = set(keys)
+                worker_store = StateStore(os.path.join(directory, "state.db"))
+                try:
+                    for path, content_hash in worker_store.processed_hashes().items():
+                        key = note_key(worker_vault_path, path)
+                        if key in shard_keys:
+                            target_store.add_processed(os.path.join(vault_path, *key.split("/")), content_hash)
+                            processed += 1
+                finally:
+                    worker_store.close()
+
+        leases.mark_merged(list(completed))
+        ledger = (config.get('budget') or {}).get('ledger', "default")
+        usage = leases.load_budget_ledger(ledger)
+        if usage:
+            # The round's ledger started as a copy of the run's, so it replaces it
+            target_store.set_budget_ledger(ledger, usage)
+        print(f"Merged {len(completed)} shards: {messages} messages, {processed} processed notes")
+        return output_sink.path
+    finally:
+        leases.close()
+        close_state_stores()
+
+if __name__ == "__main__":
+    from config import load_config
+
+    parser = argparse.ArgumentParser(description="Plan, serve and merge the shards of a distributed run. Workers run main.py with --coordinator.")
+    parser.add_argument("--config", default="config.yaml", help="Path of the config file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan_parser = commands.add_parser("plan", help="Partition the notes that need generation into the shards of a new round")
+    plan_parser.add_argument("leases", help="Path of the new lease database")
+    plan_parser.add_argument("--shards", type=int, help="Number of shards. Defaults to 'num_shards' in the 'distributed' section of the config")
+    serve_parser = commands.add_parser("serve", help="Serve the leases of a round to workers on other machines")
+    serve_parser.add_argument("leases", help="Path of the lease database")
+    serve_parser.add_argument("--host", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    status_parser = commands.add_parser("status", help="Report the progress of a round")
+    status_parser.add_argument("coordinator", help="Path of the lease database or URL of the coordinator")
+    merge_parser = commands.add_parser("merge", help="Merge the output and processed notes of the completed shards")
+    merge_parser.add_argument("leases", help="Path of the lease database")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve_coordinator(ShardLeases(args.leases), args.host, args.port)
+    elif args.command == "status":
+        print(json.dumps(connect_coordinator(args.coordinator).status(), indent=2))
+    else:
+        config = load_config(args.config)
+        if args.command == "plan":
+            shards = args.shards or (config.get('distributed') or {}).get('num_shards', 16)
+            print(json.dumps(plan_round(config, args.leases, shards), indent=2))
+        else:
+            path = merge_round(config, args.leases)
+            if path:
+                print(f"Wrote merged conversations to {path}")
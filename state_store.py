@@ -0,0 +1,439 @@
+# state_store.py
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+class StateStore:
+    """
+    Indexed run state kept in SQLite: processed notes, conversation checkpoints,
+    the vault index, API key usage and budget ledgers.
+
+    Lookups, inserts and deletes go through primary-key indexes, so marking or
+    unmarking a note no longer rewrites a whole file. One store can be shared by
+    worker threads.
+    """
+
+    def __init__(self, path):
+        """
+        Open (or create) the state store.
+
+        Args:
+            path (str): Path to the SQLite database file.
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS processed_notes (path TEXT PRIMARY KEY, processed_at REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "key TEXT PRIMARY KEY, note_path TEXT NOT NULL, data TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS checkpoints_note_path ON checkpoints (note_path)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vault_index ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, content_hash TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS credential_usage ("
+            "provider TEXT NOT NULL, key_id TEXT NOT NULL, day TEXT NOT NULL, requests INTEGER NOT NULL, "
+            "PRIMARY KEY (provider, key_id, day))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS budget_ledger ("
+            "ledger TEXT NOT NULL, provider TEXT NOT NULL, model_id TEXT NOT NULL, requests INTEGER NOT NULL, "
+            "prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL, cost REAL NOT NULL, "
+            "PRIMARY KEY (ledger, provider, model_id))"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(processed_notes)")}
+        if 'content_hash' not in columns:
+            # Stores created before the vault index did not record what content was processed
+            self._conn.execute("ALTER TABLE processed_notes ADD COLUMN content_hash TEXT")
+        self._conn.commit()
+
+    def import_processed_notes_file(self, file_path):
+        """
+        Import the note paths of a legacy processed_notes.txt file.
+
+        Args:
+            file_path (str): Path to the text file, one note path per line.
+
+        Returns:
+            int: The number of paths read from the file.
+        """
+        with open(file_path, 'r', encoding='utf-8') as file:
+            paths = [line.strip() for line in file if line.strip()]
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO processed_notes (path, processed_at) VALUES (?, ?)", [(path, now) for path in paths])
+            self._conn.commit()
+        return len(paths)
+
+    def processed_notes(self):
+        """
+        Return every processed note path.
+
+        Returns:
+            set: The processed note paths.
+        """
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT path FROM processed_notes")}
+
+    def is_processed(self, note_path):
+        """
+        Check whether a note has been processed.
+
+        Args:
+            note_path (str): The note path.
+
+        Returns:
+            bool: True if the note is marked as processed.
+        """
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM processed_notes WHERE path = ?", (note_path,)).fetchone() is not None
+
+    def add_processed(self, note_path, content_hash=None):
+        """
+        Mark a note as processed.
+
+        Args:
+            note_path (str): The note path.
+            content_hash (str, optional): Hash of the processed content. Defaults to the hash in the vault index.
+        """
+        with self._lock:
+            if content_hash is None:
+                row = self._conn.execute("SELECT content_hash FROM vault_index WHERE path = ?", (note_path,)).fetchone()
+                content_hash = row[0] if row else None
+            self._conn.execute(
+                "INSERT OR REPLACE INTO processed_notes (path, processed_at, content_hash) VALUES (?, ?, ?)",
+                (note_path, time.time(), content_hash),
+            )
+            self._conn.commit()
+
+    def processed_hashes(self):
+        """
+        Return the content hash recorded for every processed note.
+
+        Returns:
+            dict: Content hashes keyed by note path. The hash is None for notes processed before hashes were recorded.
+        """
+        with self._lock:
+            return dict(self._conn.execute("SELECT path, content_hash FROM processed_notes"))
+
+    def set_processed_hashes(self, hashes):
+        """
+        Record the content hash of notes that are already marked as processed.
+
+        Args:
+            hashes (list): (note_path, content_hash) tuples.
+        """
+        with self._lock:
+            self._conn.executemany("UPDATE processed_notes SET content_hash = ? WHERE path = ?", [(content_hash, path) for path, content_hash in hashes])
+            self._conn.commit()
+
+    def move_processed(self, old_path, new_path):
+        """
+        Carry the processed state of a note over to its new path after a move or rename.
+
+        Args:
+            old_path (str): The previous note path.
+            new_path (str): The current note path.
+        """
+        with self._lock:
+            self._conn.execute("UPDATE OR REPLACE processed_notes SET path = ? WHERE path = ?", (new_path, old_path))
+            self._conn.commit()
+
+    def load_vault_index(self):
+        """
+        Load the vault index.
+
+        Returns:
+            dict: (size, mtime_ns, content_hash) tuples keyed by note path.
+        """
+        with self._lock:
+            return {row[0]: row[1:] for row in self._conn.execute("SELECT path, size, mtime_ns, content_hash FROM vault_index")}
+
+    def update_vault_index(self, upserts, deleted_paths):
+        """
+        Apply changes to the vault index in one transaction.
+
+        Args:
+            upserts (list): (path, size, mtime_ns, content_hash) tuples to insert or replace.
+            deleted_paths (list): Paths to remove from the index.
+        """
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO vault_index (path, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?)", upserts)
+            self._conn.executemany("DELETE FROM vault_index WHERE path = ?", [(path,) for path in deleted_paths])
+            self._conn.commit()
+
+    def remove_processed(self, note_path):
+        """
+        Unmark a processed note.
+
+        Args:
+            note_path (str): The note path.
+
+        Returns:
+            bool: True if the note was marked as processed.
+        """
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM processed_notes WHERE path = ?", (note_path,))
+            self._conn.commit()
+            return cursor.rowcount > 0
+
+    def save_checkpoint(self, key, note_path, data):
+        """
+        Save (or replace) a conversation checkpoint.
+
+        Args:
+            key (str): The checkpoint key.
+            note_path (str): The note the conversation belongs to.
+            data (dict): JSON-serializable checkpoint data.
+        """
+        encoded = json.dumps(data, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (key, note_path, data, updated) VALUES (?, ?, ?, ?)",
+                (key, note_path, encoded, time.time()),
+            )
+            self._conn.commit()
+
+    def load_checkpoint(self, key):
+        """
+        Load a conversation checkpoint.
+
+        Args:
+            key (str): The checkpoint key.
+
+        Returns:
+            dict: The checkpoint data, or None if there is no checkpoint.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM checkpoints WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete_checkpoint(self, key):
+        """
+        Delete a conversation checkpoint.
+
+        Args:
+            key (str): The checkpoint key.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def delete_checkpoints(self, note_path):
+        """
+        Delete every checkpoint of a note.
+
+        Args:
+            note_path (str): The note path.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints WHERE note_path = ?", (note_path,))
+            self._conn.commit()
+
+    def load_credential_usage(self, provider, day):
+        """
+        Load the request counts of a provider's API keys for one day.
+
+        Args:
+            provider (str): The provider name.
+            day (str): The UTC day, as YYYY-MM-DD.
+
+        Returns:
+            dict: Request counts keyed by key ID.
+        """
+        with self._lock:
+            return dict(self._conn.execute("SELECT key_id, requests FROM credential_usage WHERE provider = ? AND day = ?", (provider, day)))
+
+    def add_credential_usage(self, provider, key_id, day, requests=1):
+        """
+        Add requests to the usage of an API key.
+
+        Args:
+            provider (str): The provider name.
+            key_id (str): The key ID (a hash, never the key itself).
+            day (str): The UTC day, as YYYY-MM-DD.
+            requests (int): The number of requests to add.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO credential_usage (provider, key_id, day, requests) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (provider, key_id, day) DO UPDATE SET requests = requests + excluded.requests",
+                (provider, key_id, day, requests),
+            )
+            self._conn.commit()
+
+    def load_budget_ledger(self, ledger):
+        """
+        Load the usage recorded in a budget ledger.
+
+        Args:
+            ledger (str): The ledger name.
+
+        Returns:
+            list: (provider, model_id, requests, prompt_tokens, completion_tokens, cost) tuples.
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT provider, model_id, requests, prompt_tokens, completion_tokens, cost FROM budget_ledger WHERE ledger = ? ORDER BY provider, model_id",
+                (ledger,),
+            ).fetchall()
+
+    def add_budget_usage(self, ledger, provider, model_id, prompt_tokens, completion_tokens, cost):
+        """
+        Add the usage of one request to a budget ledger.
+
+        Args:
+            ledger (str): The ledger name.
+            provider (str): The provider name.
+            model_id (str): The model ID.
+            prompt_tokens (int): Prompt tokens of the request.
+            completion_tokens (int): Completion tokens of the request.
+            cost (float): Cost of the request in USD.
+
+        Returns:
+            tuple: The cost and tokens of the whole ledger, including the usage of other processes sharing the store.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO budget_ledger (ledger, provider, model_id, requests, prompt_tokens, completion_tokens, cost) VALUES (?, ?, ?, 1, ?, ?, ?) "
+                "ON CONFLICT (ledger, provider, model_id) DO UPDATE SET requests = requests + 1, "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "cost = cost + excluded.cost",
+                (ledger, provider, model_id, prompt_tokens, completion_tokens, cost),
+            )
+            self._conn.commit()
+            return self._conn.execute(
+                "SELECT COALESCE(SUM(cost), 0), COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM budget_ledger WHERE ledger = ?",
+                (ledger,),
+            ).fetchone()
+
+    def set_budget_ledger(self, ledger, usage):
+        """
+        Replace the usage recorded in a budget ledger.
+
+        Args:
+            ledger (str): The ledger name.
+            usage (list): (provider, model_id, requests, prompt_tokens, completion_tokens, cost) tuples, as returned by load_budget_ledger().
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM budget_ledger WHERE ledger = ?", (ledger,))
+            self._conn.executemany(
+                "INSERT INTO budget_ledger (ledger, provider, model_id, requests, prompt_tokens, completion_tokens, cost) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(ledger, *row) for row in usage],
+            )
+            self._conn.commit()
+
+    def reset_budget_ledger(self, ledger):
+        """
+        Delete the usage recorded in a budget ledger.
+
+        Args:
+            ledger (str): The ledger name.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM budget_ledger WHERE ledger = ?", (ledger,))
+            self._conn.commit()
+
+    def close(self):
+        """
+        Close the underlying database connection.
+        """
+        with self._lock:
+            self._conn.close()
+
+class ConversationCheckpoint:
+    """
+    Checkpoint of one conversation of a note, saved after every completed turn.
+    """
+
+    def __init__(self, store, note_path, index):
+        """
+        Initialize the checkpoint handle.
+
+        Args:
+            store (StateStore): The state store holding the checkpoint.
+            note_path (str): The note the conversation belongs to.
+            index (int): The index of the conversation among the note's conversations.
+        """
+        self.store = store
+        self.note_path = note_path
+        self.key = f"{note_path}#{index}"
+
+    def load(self):
+        """
+        Load the saved state of the conversation.
+
+        Returns:
+            dict: The saved state, or None if the conversation has not started.
+        """
+        return self.store.load_checkpoint(self.key)
+
+    def save(self, data):
+        """
+        Save the state of the conversation.
+
+        Args:
+            data (dict): JSON-serializable conversation state.
+        """
+        self.store.save_checkpoint(self.key, self.note_path, data)
+
+    def complete(self, messages):
+        """
+        Record that the conversation finished, so a resumed note skips it.
+
+        Args:
+            messages (list): The final conversation history.
+        """
+        self.save({"completed": True, "model_conversation_history": messages})
+
+    def clear(self):
+        """
+        Delete the checkpoint so the conversation starts from scratch next time.
+        """
+        self.store.delete_checkpoint(self.key)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_state_store(path):
+    """
+    Return the shared state store for a path, opening it on first use.
+
+    When a new store is created next to a legacy processed_notes.txt file, the
+    paths in that file are imported.
+
+    Args:
+        path (str): Path to the SQLite database file.
+
+    Returns:
+        StateStore: The state store.
+    """
+    with _stores_lock:
+        if path not in _stores:
+            is_new = not os.path.exists(path)
+            store = StateStore(path)
+            legacy_file = os.path.join(os.path.dirname(path), "processed_notes.txt")
+            if is_new and os.path.exists(legacy_file):
+                print(f"Imported {store.import_processed_notes_file(legacy_file)} processed notes from {legacy_file}")
+            _stores[path] = store
+        return _stores[path]
+
+def close_state_stores():
+    """
+    Close every open state store.
+    """
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
@@ -0,0 +1,93 @@
+# stats.py
+
+import threading
+from collections import defaultdict
+
+class RunStats:
+    """
+    Thread-safe counters collected over a run and printed when it finishes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+
+    def add(self, name, value=1):
+        """
+        Add a value to a counter.
+
+        Args:
+            name (str): The counter name.
+            value (float): The amount to add.
+        """
+        with self._lock:
+            self._counters[name] += value
+
+    def get(self, name):
+        """
+        Return the current value of a counter.
+
+        Args:
+            name (str): The counter name.
+
+        Returns:
+            float: The counter value, 0 if it was never set.
+        """
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self):
+        """
+        Return a copy of every counter.
+
+        Returns:
+            dict: Counter values keyed by name.
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        """
+        Clear every counter.
+        """
+        with self._lock:
+            self._counters.clear()
+
+    def report(self):
+        """
+        Print a summary of the run.
+        """
+        counters = self.snapshot()
+        if not counters:
+            return
+
+        print("\nRun stats:")
+        conversations = counters.get('conversations', 0)
+        prompt_tokens = counters.get('prompt_tokens', 0)
+        baseline_tokens = counters.get('prompt_tokens_baseline', 0)
+        if conversations:
+            print(f"  Conversations: {int(conversations)}")
+            print(f"  Prompt tokens per conversation: {prompt_tokens / conversations:,.0f} (full-history baseline: {baseline_tokens / conversations:,.0f})")
+        if baseline_tokens:
+            print(f"  Prompt tokens saved by history budgeting: {1 - prompt_tokens / baseline_tokens:.1%}")
+        cache_requests = counters.get('prompt_cache_hits', 0) + counters.get('prompt_cache_misses', 0)
+        if cache_requests:
+            print(f"  Prompt cache hit rate: {counters.get('prompt_cache_hits', 0) / cache_requests:.1%} of {int(cache_requests)} requests")
+        for label in sorted(name.split(':', 1)[1] for name in counters if name.startswith('stream_responses:')):
+            responses = counters[f'stream_responses:{label}']
+            generation_seconds = counters.get(f'stream_generation_seconds:{label}', 0)
+            tokens = counters.get(f'stream_completion_tokens:{label}', 0)
+            throughput = f"{tokens / generation_seconds:,.1f} tokens/s" if generation_seconds else "n/a"
+            ttft_ms = counters.get(f'stream_ttft_seconds:{label}', 0) / responses * 1000
+            print(f"  Streaming {label}: {int(responses)} responses, time to first token {ttft_ms:,.0f} ms, {throughput}")
+        rejections = {name.split(':', 1)[1]: value for name, value in counters.items() if name.startswith('quality_rejected:')}
+        if rejections:
+            by_check = ", ".join(f"{check} {int(value)}" for check, value in sorted(rejections.items()))
+            print(f"  Quality gate rejections: {int(sum(rejections.values()))} ({by_check})")
+        for name in sorted(counters):
+            # Per-response-type counters are summarized above
+            if name not in ('conversations', 'prompt_tokens', 'prompt_tokens_baseline') and ':' not in name:
+                print(f"  {name}: {counters[name]:,.0f}")
+
+# Shared by every worker thread of the process
+run_stats = RunStats()
@@ -0,0 +1,313 @@
+# synthgen.py
+
+import asyncio
+import random
+from collections import deque
+from chunking import chunk_note
+from conversation import generate_conversation_steps, generate_response
+from file_utils import read_obsidian_note, save_processed_note
+from output_sinks import OutputSink
+from state_store import ConversationCheckpoint, get_state_store, close_state_stores
+from vault_index import VaultIndex
+from providers import configure_providers, close_providers
+from endpoint_pool import configure_endpoint_pool, close_endpoint_pool
+from rate_limiter import configure_rate_limits
+from credentials import configure_credentials
+from budget import configure_budget
+from metrics import request_metrics
+from response_cache import close_response_cache
+from router import active_router, configure_router
+
+class Message:
+    """
+    One message of a generated conversation, as it is written to the output.
+    """
+
+    __slots__ = ("role", "name", "content", "conversation_id", "turn", "token_count")
+
+    def __init__(self, role, name, content, conversation_id, turn, token_count):
+        """
+        Initialize the message.
+
+        Args:
+            role (str): The role of the message (user or assistant).
+            name (str): The name of the speaker (Joseph, CoR, Professor or System).
+            content (str): The message text.
+            conversation_id (str): The conversation ID.
+            turn (int): The turn number in the conversation (0 for the user problem).
+            token_count (int): Tokens in the message text.
+        """
+        self.role = role
+        self.name = name
+        self.content = content
+        self.conversation_id = conversation_id
+        self.turn = turn
+        self.token_count = token_count
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Create a message from a message record written to an output sink.
+
+        Args:
+            record (dict): The message record.
+
+        Returns:
+            Message: The message.
+        """
+        return cls(record['role'], record.get('name'), record['content'], record.get('conversation_id'), record.get('turn'), record.get('token_count'))
+
+    def to_record(self):
+        """
+        Return the message record, as written to the output files.
+
+        Returns:
+            dict: The role, name, content, conversation ID, turn and token count.
+        """
+        return {
+            "role": self.role,
+            "name": self.name,
+            "content": self.content,
+            "conversation_id": self.conversation_id,
+            "turn": self.turn,
+            "token_count": self.token_count,
+        }
+
+    def __repr__(self):
+        return f"Message({self.name}, turn {self.turn}, {self.token_count} tokens)"
+
+class MessageStream(OutputSink):
+    """
+    Output sink that queues the messages of a conversation for its consumer.
+
+    Messages are handed out by drain() after each request and dropped from the
+    queue, so only the messages of the step in progress are held. Records and
+    conversation ends are passed on to an optional sink, so the messages can
+    still be written to the usual output files.
+    """
+
+    def __init__(self, output_sink=None):
+        """
+        Initialize the stream.
+
+        Args:
+            output_sink (OutputSink, optional): Sink that receives every record as well.
+        """
+        self.output_sink = output_sink
+        self.path = output_sink.path if output_sink is not None else None
+        self._messages = deque()
+
+    def write(self, record):
+        self._messages.append(Message.from_record(record))
+        if self.output_sink is not None:
+            self.output_sink.write(record)
+
+    def write_partial(self, record):
+        if self.output_sink is not None:
+            self.output_sink.write_partial(record)
+
+    def end_conversation(self, conversation_id):
+        if self.output_sink is not None:
+            self.output_sink.end_conversation(conversation_id)
+
+    def sync(self):
+        if self.output_sink is not None:
+            self.output_sink.sync()
+
+    def drain(self):
+        """
+        Hand out the queued messages, oldest first.
+
+        Yields:
+            Message: Each message written since the last drain.
+        """
+        while self._messages:
+            yield self._messages.popleft()
+
+def _send(request, config):
+    # Requests are routed through the router set up by configure()
+    return generate_response(request.role, request.prompt, request.response_type, request.history, config,
+                             system_prompt=request.system_prompt, on_delta=request.on_delta, cache_scope=request.cache_scope)
+
+def _conversation_steps(note, config, stream, rng, checkpoint):
+    # Claude needs alternating roles whenever it may receive the request
+    alternate_roles = active_router(config).uses("claude")
+    return generate_conversation_steps(note, stream, config, alternate_roles, rng, checkpoint)
+
+def iter_conversation(note, config, output_sink=None, rng=None, checkpoint=None):
+    """
+    Generate a conversation, yielding each message as soon as it is generated.
+
+    Closing the generator early stops the conversation after the request in
+    progress; with a checkpoint, a later call resumes it. With a checkpoint,
+    the messages of a turn are yielded once the turn is saved, so a resumed
+    conversation never yields a message twice. A conversation the checkpoint
+    holds as completed yields nothing.
+
+    Args:
+        note (dict): Note content to base the conversation on: its filename, content and optional max_turns cap.
+        config (dict): Configuration settings.
+        output_sink (OutputSink, optional): Sink that receives every message record as well.
+        rng (random.Random, optional): Random generator for the conversation. A seeded generator makes the conversation ID, turn count and thoughts reproducible.
+        checkpoint (ConversationCheckpoint, optional): Checkpoint saved after every turn.
+
+    Yields:
+        Message: Each message of the conversation.
+
+    Returns:
+        list: The conversation history, or None if generation failed.
+
+    Raises:
+        CredentialsExhausted: If the API keys or the budget ran out. The checkpoint is kept.
+    """
+    stream = MessageStream(output_sink)
+    steps = _conversation_steps(note, config, stream, rng, checkpoint)
+    response = None
+    try:
+        while True:
+            try:
+                request = steps.send(response)
+            except StopIteration as stop:
+                conversation = stop.value
+                break
+            yield from stream.drain()
+            response = _send(request, config)
+    finally:
+        steps.close()
+    yield from stream.drain()
+    return conversation
+
+async def aiter_conversation(note, config, output_sink=None, rng=None, checkpoint=None):
+    """
+    Generate a conversation as an async iterator, yielding each message as soon as it is generated.
+
+    Requests run in a worker thread, so the event loop stays free and several
+    conversations can be iterated concurrently. Arguments are the same as for
+    iter_conversation().
+
+    Yields:
+        Message: Each message of the conversation.
+
+    Raises:
+        CredentialsExhausted: If the API keys or the budget ran out. The checkpoint is kept.
+    """
+    stream = MessageStream(output_sink)
+    steps = _conversation_steps(note, config, stream, rng, checkpoint)
+    response = None
+    try:
+        while True:
+            try:
+                request = steps.send(response)
+            except StopIteration:
+                break
+            for message in stream.drain():
+                yield message
+            response = await asyncio.to_thread(_send, request, config)
+    finally:
+        steps.close()
+    for message in stream.drain():
+        yield message
+
+def iter_note(note_path, config, output_sink=None, state_store=None):
+    """
+    Generate the conversations of a note, chunk by chunk, yielding each message as soon as it is generated.
+
+    Args:
+        note_path (str): Path to the note.
+        config (dict): Configuration settings. 'num_conversations' conversations are generated per chunk.
+        output_sink (OutputSink, optional): Sink that receives every message record as well.
+        state_store (str, optional): State store for conversation checkpoints. The note is marked as
+            processed in it once every chunk has a conversation that succeeded; otherwise the checkpoints
+            are kept, so the next call skips the completed conversations and retries the rest.
+
+    Yields:
+        Message: Each message of each conversation.
+
+    Raises:
+        CredentialsExhausted: If the API keys or the budget ran out. The checkpoints are kept.
+    """
+    note = read_obsidian_note(note_path)
+    if note is None:
+        return
+    chunks = chunk_note(note_path, note['content'], config)
+    if not chunks:
+        if state_store is not None:
+            save_processed_note(state_store, note_path)
+        return
+    num_conversations = config['conversation_generation']['num_conversations']
+    concurrency = config.get('concurrency', {})
+    succeeded = set()
+    for chunk in chunks:
+        for i in range(num_conversations):
+            rng = random.Random(f"{concurrency.get('seed', 0)}:{chunk}#{i}") if concurrency.get('deterministic', False) else random.Random()
+            checkpoint = ConversationCheckpoint(get_state_store(state_store), chunk.note_path, chunk.checkpoint_index(i)) if state_store is not None else None
+            conversation = yield from iter_conversation(chunk.as_note(), config, output_sink, rng, checkpoint)
+            if conversation:
+                succeeded.add(chunk.index)
+    if len(succeeded) == len(chunks) and state_store is not None:
+        save_processed_note(state_store, note_path)
+        get_state_store(state_store).delete_checkpoints(note_path)
+
+def iter_notes(note_paths, config, output_sink=None, state_store=None):
+    """
+    Generate the conversations of notes one after another, yielding each message as soon as it is generated.
+
+    Nothing is kept once a message is handed out, so memory use stays the same
+    however many notes are generated from.
+
+    Args:
+        note_paths (iterable): Note paths, read as they are reached.
+        config (dict): Configuration settings.
+        output_sink (OutputSink, optional): Sink that receives every message record as well.
+        state_store (str, optional): State store for checkpoints and processed notes, see iter_note().
+
+    Yields:
+        Message: Each message of each conversation.
+    """
+    for note_path in note_paths:
+        yield from iter_note(note_path, config, output_sink, state_store)
+
+def iter_vault(config, output_sink=None):
+    """
+    Generate the conversations of the vault notes that are new or changed since they were processed.
+
+    Args:
+        config (dict): Configuration settings. The vault and the state store come from 'file_paths'.
+        output_sink (OutputSink, optional): Sink that receives every message record as well.
+
+    Yields:
+        Message: Each message of each conversation.
+    """
+    state_store = config['file_paths'].get('state_store', 'synthgen_state.db')
+    notes = VaultIndex(get_state_store(state_store)).refresh(config['file_paths']['obsidian_vault_path'])
+    yield from iter_notes(notes, config, output_sink, state_store)
+
+def configure(config, providers=None):
+    """
+    Set up the providers, rate limits, router, API keys and budget that generation uses, as the command line does.
+
+    Args:
+        config (dict): Configuration settings, as returned by config.load_config().
+        providers (list, optional): Provider names to route over, instead of the backends in the 'routing' section.
+
+    Returns:
+        Router: The router requests are sent through.
+    """
+    configure_providers(config)
+    configure_rate_limits(config)
+    configure_endpoint_pool(config)
+    router = configure_router(config, providers)
+    state_store = get_state_store(config['file_paths'].get('state_store', 'synthgen_state.db'))
+    configure_credentials(config, state_store)
+    configure_budget(config, state_store)
+    return router
+
+def close():
+    """
+    Release the clients, caches and state stores set up by configure().
+    """
+    request_metrics.close()
+    close_endpoint_pool()
+    close_providers()
+    close_response_cache()
+    close_state_stores()
@@ -0,0 +1,141 @@
+# vault_index.py
+
+import hashlib
+import os
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """
+    Hash the content of a file.
+
+    Args:
+        file_path (str): The path to the file.
+        chunk_size (int): Number of bytes read at a time.
+
+    Returns:
+        str: The hex BLAKE2b digest of the file content.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def scan_notes(vault_path, extension=".md"):
+    """
+    Walk the vault with os.scandir and stat every note once.
+
+    Args:
+        vault_path (str): Path to the Obsidian vault.
+        extension (str): File extension of notes.
+
+    Returns:
+        dict: (size, mtime_ns) tuples keyed by note path.
+    """
+    notes = {}
+    pending = [vault_path]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.name.endswith(extension) and entry.is_file():
+                        stat = entry.stat()
+                        notes[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        except OSError as e:
+            print(f"Error scanning directory: {directory}")
+            print(f"Error details: {str(e)}")
+    return notes
+
+class VaultIndex:
+    """
+    Persistent index of the notes in a vault, kept in the state store.
+
+    Every note is recorded with its size, mtime and content hash. A note is only
+    read and hashed again when its size or mtime changes, so a warm start costs
+    one directory scan. Hashes make it possible to spot notes that were moved or
+    renamed (same content, new path) and notes that were edited after they were
+    processed.
+    """
+
+    def __init__(self, state_store):
+        """
+        Initialize the index.
+
+        Args:
+            state_store (StateStore): The state store holding the index and the processed notes.
+        """
+        self.state_store = state_store
+
+    def refresh(self, vault_path):
+        """
+        Bring the index up to date with the vault and return the notes that need generation.
+
+        Processed notes that were moved or renamed keep their processed state under
+        the new path. New notes and notes whose content changed since they were
+        processed are returned. The conversation checkpoints of a note whose
+        content changed since it was last indexed are deleted, so its conversations
+        start over from the new content instead of resuming from the old.
+
+        Args:
+            vault_path (str): Path to the Obsidian vault.
+
+        Returns:
+            list: Sorted paths of the notes to generate conversations for.
+        """
+        previous = self.state_store.load_vault_index()
+        current = scan_notes(vault_path)
+
+        upserts = []
+        hashes = {}
+        edited = []
+        for path, (size, mtime_ns) in current.items():
+            known = previous.get(path)
+            if known is not None and known[0] == size and known[1] == mtime_ns:
+                hashes[path] = known[2]
+                continue
+            try:
+                hashes[path] = hash_file(path)
+            except OSError as e:
+                print(f"Error reading file: {path}")
+                print(f"Error details: {str(e)}")
+                continue
+            upserts.append((path, size, mtime_ns, hashes[path]))
+            if known is not None and known[2] != hashes[path]:
+                edited.append(path)
+
+        deleted_paths = [path for path in previous if path not in current]
+        self.state_store.update_vault_index(upserts, deleted_paths)
+        # Checkpoints hold history generated from the old content, and chunk indexes may point at other sections now
+        for path in edited:
+            self.state_store.delete_checkpoints(path)
+
+        processed = self.state_store.processed_hashes()
+
+        # A processed note that disappeared, while a new path has the same content, was moved
+        missing_by_hash = {}
+        for path in deleted_paths:
+            if path in processed:
+                missing_by_hash.setdefault(previous[path][2], []).append(path)
+        for path, content_hash in hashes.items():
+            if path not in previous and path not in processed and missing_by_hash.get(content_hash):
+                old_path = missing_by_hash[content_hash].pop()
+                print(f"Detected moved note: {old_path} -> {path}")
+                self.state_store.move_processed(old_path, path)
+                processed[path] = processed.pop(old_path)
+
+        # Notes processed before hashes were recorded count as processed in their current state
+        backfill = [(path, hashes[path]) for path, content_hash in processed.items() if content_hash is None and path in hashes]
+        if backfill:
+            self.state_store.set_processed_hashes(backfill)
+            processed.update(backfill)
+
+        queued = []
+        for path, content_hash in hashes.items():
+            if path not in processed:
+                queued.append(path)
+            elif processed[path] != content_hash:
+                print(f"Note changed since it was processed: {path}")
+                queued.append(path)
+        return sorted(queued)